@@ -1,6 +1,8 @@
 ##### Imports #####
-from datetime import date, datetime
+from collections import namedtuple
+from datetime import date, datetime, timedelta
 import json
+import hmac
 import dateutil.parser
 import babel
 
@@ -11,29 +13,95 @@ from flask import (
     Response, 
     flash, 
     redirect, 
-    url_for)
+    url_for,
+    jsonify,
+    abort,
+    stream_with_context,
+    send_file)
 
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_wtf import Form
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 import logging
 from logging import Formatter, FileHandler
 
 # Import other *.py files of the project
 from forms import *
-from models import db, Venue, Artist, Show
+from models import db, Venue, Artist, Show, Stat, PurgeJob
+from changes import apply_changes
+import tours
+from partitions import partitions_cli
+from notify import ChangeNotifier
+from querylog import QueryLog
+from profiler import RequestProfiler
+from recommend import recommender
+import feeds
+import stats
+from stats import stats_cli
+from online_migrations import online_migrations_cli
+import purge
+import images
+from ratelimit import RateLimiter
+from sharding import Shards
+import dedupe
+import geo
+import audit
+from sessions import Sessions
+from upcoming import UpcomingShows, parse_time
 
 ##### APP CONFIG #####
 app = Flask(__name__)
 app.config.from_object('config')
+# Client addresses (rate limits, audit) from the trusted proxies' headers
+if app.config.get('PROXY_FIX_X_FOR'):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+# Stable signing keys and the session store, shared by all workers
+sessions = Sessions(app)
 moment = Moment(app)
 db.init_app(app)
 
 # Activate Migration
 migrate = Migrate(app, db)
 
+# Venues and their shows by region, when SHARDS is configured
+shards = Shards(app)
+
+# Publish committed changes to the other workers
+notifier = ChangeNotifier(app)
+
+# Who changed what, written in the background
+audit_log = audit.AuditLog(app)
+
+# The next days of shows, in memory, for /shows/upcoming
+upcoming = UpcomingShows(app)
+
+# Log slow statements with their route and sampled plans
+query_log = QueryLog(app)
+
+# Per-client rate limits and concurrency caps on searches and writes
+rate_limiter = RateLimiter(app)
+
+# Per-request profiles, only when enabled in config
+profiler = RequestProfiler(app)
+
+# Archives the shows of deleted venues and artists in the background
+purger = purge.Purger(app)
+
+# Local copies of image_link pictures
+image_cache = images.ImageCache(app)
+
+# Maintenance commands (flask partitions ...)
+app.cli.add_command(partitions_cli)
+app.cli.add_command(stats_cli)
+app.cli.add_command(online_migrations_cli)
+app.cli.add_command(dedupe.duplicates_cli)
+app.cli.add_command(geo.geo_cli)
+
 ##### FILTERS #####
 def format_datetime(value, format='medium'):
   date = dateutil.parser.parse(value)
@@ -45,6 +113,27 @@ def format_datetime(value, format='medium'):
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+##### ROWS #####
+# List and search pages get only the columns their templates show, as
+# named tuples: no ORM objects, identity map or lazy-loaded collections
+ArtistRow = namedtuple('ArtistRow', 'id name')
+VenueRow = namedtuple('VenueRow', 'id name num_upcoming_shows')
+
+def artist_rows(search_term=None):
+    query = select([Artist.id, Artist.name]).where(Artist.deleted_at.is_(None))
+    if search_term is not None:
+        query = query.where(Artist.name.ilike('%{}%'.format(search_term)))
+    return [ArtistRow._make(row) for row in db.session.execute(query)]
+
+def venue_rows(search_term):
+    # Upcoming shows counted per venue found, on the (venue_id, start_time) index
+    upcoming = select([func.count(Show.id)]).where(and_(
+        Show.venue_id == Venue.id, Show.start_time > datetime.now())).as_scalar()
+    query = select([Venue.id, Venue.name, upcoming]).where(and_(
+        Venue.deleted_at.is_(None),
+        Venue.name.ilike('%{}%'.format(search_term))))
+    return [VenueRow._make(row) for row in db.session.execute(query)]
+
 ##### CONTROLLERS #####
 @app.route('/')
 def index():
@@ -61,6 +150,14 @@ def create_artist_form():
 def create_artist_submission():
     form = ArtistForm(request.form, csrf_enabled=False)
     if form.validate():
+        # Show likely duplicates first; submitting again lists it anyway
+        if not form.allow_duplicate.data:
+            duplicates = dedupe.similar('artists', form.name.data,
+                                        form.city.data, form.state.data)
+            if duplicates:
+                form.allow_duplicate.data = '1'
+                return render_template('forms/new_artist.html', form=form,
+                                       duplicates=duplicates), 409
         try:
             # Using FlaskForm:
             artist = Artist(
@@ -81,6 +178,7 @@ def create_artist_submission():
 
             db.session.add(artist)
             db.session.commit()
+            shards.copy_artists([artist.id])
             flash('Artist ' + form.name.data + ' was successfully listed!')
         except ValueError as e:
             print(e)
@@ -100,29 +198,34 @@ def create_artist_submission():
 # 2.- Get Artist
 @app.route('/artists')
 def artists():
-    return render_template('pages/artists.html',
-                           artists=Artist.query.all())
+    return render_template('pages/artists.html', artists=artist_rows())
 
 @app.route('/artists/<int:artist_id>')
 def show_artist(artist_id):
 
-    artist = Artist.query.filter_by(id=artist_id).first_or_404()
-
-    past_shows = db.session.query(Venue, Show).join(Show).join(Artist).\
-    filter(
-        Show.venue_id == Venue.id,
-        Show.artist_id == artist_id,
-        Show.start_time < datetime.now()
-    ).\
-    all()
+    artist = Artist.active().filter_by(id=artist_id).first_or_404()
+
+    def artist_shows():
+        # (start_time, venue) pairs; runs in every shard when sharded
+        rows = db.session.query(Venue, Show).join(Show).join(Artist).\
+        filter(
+            Show.venue_id == Venue.id,
+            Show.artist_id == artist_id,
+            Venue.deleted_at.is_(None)
+        ).\
+        all()
+        return [(show.start_time, {
+            'venue_id': venue.id,
+            'venue_name': venue.name,
+            'venue_image_link': venue.image_link,
+            'start_time': show.start_time.strftime("%m/%d/%Y, %H:%M")
+        }) for venue, show in rows]
 
-    upcoming_shows = db.session.query(Venue, Show).join(Show).join(Artist).\
-    filter(
-        Show.venue_id == Venue.id,
-        Show.artist_id == artist_id,
-        Show.start_time > datetime.now()
-    ).\
-    all()
+    now = datetime.now()
+    shows = sorted((show for rows in shards.fan_out(artist_shows) for show in rows),
+                   key=lambda show: show[0])
+    past_shows = [data for start_time, data in shows if start_time < now]
+    upcoming_shows = [data for start_time, data in shows if start_time > now]
 
     data = {
         'id': artist.id,
@@ -136,18 +239,8 @@ def show_artist(artist_id):
         'facebook_link': artist.facebook_link,
         'seeking_venue': artist.seeking_venue,
         'seeking_description': artist.seeking_description,
-        'past_shows': [{
-            'venue_id': venue.id,
-            'venue_name': venue.name,
-            'venue_image_link': venue.image_link,
-            'start_time': show.start_time.strftime("%m/%d/%Y, %H:%M")
-        } for venue, show in past_shows],
-        'upcoming_shows': [{
-            'venue_id': venue.id,
-            'venue_name': venue.name,
-            'venue_image_link': venue.image_link,
-            'start_time': show.start_time.strftime("%m/%d/%Y, %H:%M")
-        } for venue, show in upcoming_shows],
+        'past_shows': past_shows,
+        'upcoming_shows': upcoming_shows,
         'past_shows_count': len(past_shows),
         'upcoming_shows_count': len(upcoming_shows)
     }
@@ -155,6 +248,9 @@ def show_artist(artist_id):
     return render_template('pages/show_artist.html', artist=data)
 
 # 3.- Update Artist
+ARTIST_FIELDS = ('name', 'city', 'seeking_venue', 'state', 'phone', 'website',
+                 'seeking_description', 'image_link', 'genres', 'facebook_link')
+
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
     # OR:
@@ -162,32 +258,38 @@ def edit_artist(artist_id):
     # artist = Artist.query.get(artist_id)
     # return render_template('forms/edit_artist.html', form=form, artist=artist)
 
-    artist = Artist.query.first_or_404(artist_id)
+    artist = Artist.active().filter_by(id=artist_id).first_or_404()
     form = ArtistForm(obj=artist)
     return render_template('forms/edit_artist.html', form=form, artist=artist)
 
 @app.route('/artists/<int:artist_id>/edit', methods=['POST'])
 def edit_artist_submission(artist_id):
-    artist = Artist.query.get(artist_id)
-    error = False
+    artist = Artist.active().filter_by(id=artist_id).first_or_404()
     form = ArtistForm(request.form, csrf_enabled=False)
     if form.validate():
         try:
-            # Using FlaskForm:
-            artist.name = form.name.data
-            artist.city = form.city.data
-            artist.seeking_venue = form.seeking_venue.data
-            artist.state = form.state.data
-            artist.phone = form.phone.data
-            artist.website = form.website.data
-            artist.seeking_description = form.seeking_description.data
-            artist.image_link = form.image_link.data
-            artist.genres = form.genres.data
-            artist.facebook_link = form.facebook_link.data
-
-            db.session.add(artist)
-            db.session.commit()
-            flash('Artist ' + artist.name + ' was successfully updated!')
+            # Someone else saved the artist after this form was rendered
+            if form.version.data and int(form.version.data) != artist.version:
+                raise StaleDataError()
+
+            # Only write the columns that actually changed
+            changed = apply_changes(artist, form, ARTIST_FIELDS)
+            if changed:
+                stats.update_artist(artist, changed)
+                db.session.commit()
+                shards.copy_artists([artist_id])
+                flash('Artist ' + artist.name + ' was successfully updated! (' +
+                    ', '.join(sorted(changed)) + ')')
+            else:
+                flash('Nothing to update for artist ' + artist.name + '.')
+        except StaleDataError:
+            db.session.rollback()
+            artist = Artist.active().filter_by(id=artist_id).first_or_404()
+            flash('Artist ' + artist.name + ' was changed by someone else. ' +
+                'Review the current values and submit again.')
+            form = ArtistForm(formdata=None, obj=artist)
+            return render_template('forms/edit_artist.html',
+                                   form=form, artist=artist), 409
         except ValueError as e:
             print(e)
             flash('An error occurred. Artist ' + artist.name + 
@@ -201,9 +303,8 @@ def edit_artist_submission(artist_id):
 @app.route('/artists/search', methods=['POST'])
 
 def search_artists():
-    search_term = request.form.get('search_term')
-    search_results = Artist.query.filter(
-        Artist.name.ilike('%{}%'.format(search_term))).all()  # search results by ilike matching partern to match every search term
+    search_term = request.form.get('search_term', '')
+    search_results = artist_rows(search_term)  # search results by ilike matching partern to match every search term
 
     response = {}
     response['count'] = len(search_results)
@@ -213,6 +314,12 @@ def search_artists():
                            results=response,
                            search_term=request.form.get('search_term', ''))
 
+@app.route('/artists/similar')
+def similar_artists():
+    # Likely duplicates of a name being typed in, for the create form
+    return jsonify(dedupe.similar('artists', request.args.get('name'),
+        request.args.get('city'), request.args.get('state')))
+
 ##### VENUES #####
 #  1.- Create Venue:
 @app.route('/venues/create', methods=['GET'])
@@ -224,6 +331,18 @@ def create_venue_form():
 def create_venue_submission():
     form = VenueForm(request.form, csrf_enabled=False)
     if form.validate():
+        # With sharding the venue goes to its region's database
+        shard = shards.shard_for_state(form.state.data)
+        shards.use_shard(shard)
+
+        # Show likely duplicates first; submitting again lists it anyway
+        if not form.allow_duplicate.data:
+            duplicates = dedupe.similar('venues', form.name.data,
+                                        form.city.data, form.state.data)
+            if duplicates:
+                form.allow_duplicate.data = '1'
+                return render_template('forms/new_venue.html', form=form,
+                                       duplicates=duplicates), 409
         try:
             # Using FlaskForm:
             venue = Venue(
@@ -242,6 +361,12 @@ def create_venue_submission():
             # Or:
             # venue = Venue()
             # form.populate_obj(venue)
+            geo.locate_venue(venue)
+
+            # Sharded venues get their id from the global database
+            if shards.enabled:
+                venue.id = shards.next_id('venues_id_seq')
+                shards.register_venue(venue.id, shard)
 
             db.session.add(venue)
             db.session.commit()
@@ -264,37 +389,50 @@ def create_venue_submission():
 # 2.- Get Venue:
 @app.route('/venues')
 def venues():
-    locals = []
-    venues = Venue.query.all()
-    places = Venue.query.distinct(Venue.city, Venue.state).all()
-        
-    for place in places:
-        locals.append({
-            'city': place.city,
-            'state': place.state,
-            'venues': [{
-                'id': venue.id,
-                'name': venue.name,
-                'num_upcoming_shows': len([show for show in venue.shows if show.start_time > datetime.now()])
-            } for venue in venues if
-                venue.city == place.city and venue.state == place.state]
-        })
+    def area_rows():
+        venues = db.session.execute(select([
+            Venue.id, Venue.name, Venue.city, Venue.state]).where(
+            Venue.deleted_at.is_(None)))
+        # One aggregate over the upcoming partitions instead of loading
+        # every venue's full show history
+        upcoming = dict(db.session.query(Show.venue_id, func.count(Show.id)).
+            filter(Show.start_time > datetime.now()).
+            group_by(Show.venue_id).all())
+        return [(venue.city, venue.state, VenueRow(
+            venue.id, venue.name, upcoming.get(venue.id, 0)))
+            for venue in venues]
+
+    # Areas in the order of a distinct (city, state), merged over shards
+    areas = {}
+    for rows in shards.fan_out(area_rows):
+        for city, state, venue in rows:
+            areas.setdefault((city, state), []).append(venue)
+    locals = [{
+        'city': city,
+        'state': state,
+        'venues': areas[city, state]
+    } for city, state in sorted(areas, key=lambda area: (area[0] or '', area[1] or ''))]
     print(locals[0])
     return render_template('pages/venues.html', areas=locals)
 
 @app.route('/venues/search', methods=['POST'])
 def search_venues():
     search_term = request.form.get('search_term')
-    venues = Venue.query.filter(
-        Venue.name.ilike('%{}%'.format(search_term))).all()
 
-    data = []
-    for venue in venues:
-        tmp = {}
-        tmp['id'] = venue.id
-        tmp['name'] = venue.name
-        tmp['num_upcoming_shows'] = len(venue.shows)
-        data.append(tmp)
+    # With a location, the venues near it whose name matches
+    if request.form.get('lat') or request.form.get('lon'):
+        try:
+            lat, lon, radius_km = near_args(request.form)
+        except ValueError:
+            abort(400)
+        data = venues_near(lat, lon, radius_km, name=search_term)
+        return render_template('pages/search_venues.html',
+                               results={'count': len(data), 'data': data},
+                               search_term=search_term or '')
+
+    found = shards.fan_out(venue_rows, search_term or '')
+    data = sorted((venue for venues in found for venue in venues),
+                  key=lambda venue: venue.name or '')
 
     response = {}
     response['count'] = len(data)
@@ -304,15 +442,55 @@ def search_venues():
                            results=response,
                            search_term=request.form.get('search_term', ''))
 
+def near_args(values):
+    # lat, lon in degrees; radius in km, optional
+    lat, lon = float(values['lat']), float(values['lon'])
+    radius_km = float(values['radius']) if values.get('radius') else None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or \
+            (radius_km is not None and not 0 < radius_km <= 20000):
+        raise ValueError('point or radius out of range')
+    return lat, lon, radius_km
+
+def venues_near(lat, lon, radius_km=None, limit=None, name=None):
+    # Within the radius, or the nearest ones without; nearest first
+    limit = min(limit or app.config['NEAR_LIMIT'], app.config['NEAR_LIMIT'])
+    if radius_km:
+        results = shards.fan_out(geo.venues_within, lat, lon, radius_km,
+                                 limit, name)
+    else:
+        results = shards.fan_out(geo.nearest, lat, lon, limit, name)
+    return sorted((venue for venues in results for venue in venues),
+                  key=lambda venue: (venue['distance_km'], venue['id']))[:limit]
+
+@app.route('/venues/near')
+def venues_near_json():
+    try:
+        lat, lon, radius_km = near_args(request.args)
+        limit = int(request.args.get('limit') or app.config['NEAR_LIMIT'])
+        if limit < 1:
+            raise ValueError('limit must be positive')
+    except (KeyError, ValueError):
+        abort(400)
+    return jsonify(venues_near(lat, lon, radius_km, limit,
+                               name=request.args.get('name')))
+
+@app.route('/venues/similar')
+def similar_venues():
+    shards.use_shard(shards.shard_for_state(request.args.get('state')))
+    return jsonify(dedupe.similar('venues', request.args.get('name'),
+        request.args.get('city'), request.args.get('state')))
+
 @app.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
-    venue = Venue.query.filter_by(id=venue_id).first_or_404()
+    shards.use_venue_shard(venue_id)
+    venue = Venue.active().filter_by(id=venue_id).first_or_404()
 
     past_shows = db.session.query(Artist, Show).join(Show).join(Venue).\
     filter(
         Show.venue_id == venue_id,
         Show.artist_id == Artist.id,
-        Show.start_time < datetime.now()
+        Show.start_time < datetime.now(),
+        Artist.deleted_at.is_(None)
     ).\
     all()
 
@@ -320,7 +498,8 @@ def show_venue(venue_id):
     filter(
         Show.venue_id == venue_id,
         Show.artist_id == Artist.id,
-        Show.start_time > datetime.now()
+        Show.start_time > datetime.now(),
+        Artist.deleted_at.is_(None)
     ).\
     all()
 
@@ -357,7 +536,21 @@ def show_venue(venue_id):
 
     return render_template('pages/show_venue.html', venue=data)
 
+@app.route('/venues/<int:venue_id>/recommendations')
+def venue_recommendations(venue_id):
+    shards.use_venue_shard(venue_id)
+    venue = Venue.active().filter_by(id=venue_id).first_or_404()
+    limit = max(1, min(request.args.get('limit', 10, type=int), 100))
+    return jsonify({
+        'venue_id': venue.id,
+        'artists': recommender.recommend(venue, limit=limit)
+    })
+
 # 3.- Update Venue:
+VENUE_FIELDS = ('name', 'city', 'state', 'address', 'phone', 'image_link',
+                'website', 'seeking_talent', 'seeking_description', 'genres',
+                'facebook_link')
+
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
 def edit_venue(venue_id):
     # OR:
@@ -365,34 +558,42 @@ def edit_venue(venue_id):
     # venue = Venue.query.get(venue_id).to_dict()
     # return render_template('forms/edit_venue.html', form=form, venue=venue)
     
-    venue = Venue.query.first_or_404(venue_id)
+    shards.use_venue_shard(venue_id)
+    venue = Venue.active().filter_by(id=venue_id).first_or_404()
     form = VenueForm(obj=venue)
     return render_template('forms/edit_venue.html', form=form, venue=venue)
 
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
 def edit_venue_submission(venue_id):
-    venue = Venue.query.get(venue_id)
-    error = False
+    shards.use_venue_shard(venue_id)
+    venue = Venue.active().filter_by(id=venue_id).first_or_404()
     form = VenueForm(request.form, csrf_enabled=False)
     if form.validate():
         try:
-            venue.name = form.name.data
-            venue.city = form.city.data
-            venue.state = form.state.data
-            venue.address = form.address.data
-            venue.phone = form.phone.data
-            venue.image_link = form.image_link.data
-            venue.website = form.website.data
-            venue.seeking_description = form.seeking_description.data
-            venue.genres = form.genres.data
-            # Revisar!!!!:
-            # tmp_genres = request.form.getlist('genres')
-            # venue.genres = ','.join(tmp_genres)  # convert list to string
-            venue.facebook_link = form.facebook_link.data
-
-            db.session.add(venue)
-            db.session.commit()
-            flash('Venue ' + venue.name + ' was successfully updated!')
+            # Someone else saved the venue after this form was rendered
+            if form.version.data and int(form.version.data) != venue.version:
+                raise StaleDataError()
+
+            # Only write the columns that actually changed
+            changed = apply_changes(venue, form, VENUE_FIELDS)
+            # Keeps the coordinates when no geocoder is configured
+            if changed & {'address', 'city', 'state'}:
+                geo.locate_venue(venue)
+            if changed:
+                stats.update_venue(venue, changed)
+                db.session.commit()
+                flash('Venue ' + venue.name + ' was successfully updated! (' +
+                    ', '.join(sorted(changed)) + ')')
+            else:
+                flash('Nothing to update for venue ' + venue.name + '.')
+        except StaleDataError:
+            db.session.rollback()
+            venue = Venue.active().filter_by(id=venue_id).first_or_404()
+            flash('Venue ' + venue.name + ' was changed by someone else. ' +
+                'Review the current values and submit again.')
+            form = VenueForm(formdata=None, obj=venue)
+            return render_template('forms/edit_venue.html',
+                                   form=form, venue=venue), 409
         except ValueError as e:
             print(e)
             flash('An error occurred. Venue ' + venue.name + 
@@ -406,21 +607,51 @@ def edit_venue_submission(venue_id):
 ##### SHOWS #####
 @app.route('/shows')
 def shows():
-    shows = Show.query.all()
-
-    data = []
-    for show in shows:
-        data.append({
-            'venue_id': show.venue.id,
-            'venue_name': show.venue.name,
-            'artist_id': show.artist.id,
-            'artist_name': show.artist.name,
-            'artist_image_link': show.artist.image_link,
-            'start_time': show.start_time.isoformat()
-        })
+    def shard_shows():
+        shows = Show.query.join(Venue, Venue.id == Show.venue_id).\
+            join(Artist, Artist.id == Show.artist_id).\
+            filter(Venue.deleted_at.is_(None), Artist.deleted_at.is_(None)).all()
+
+        data = []
+        for show in shows:
+            data.append({
+                'venue_id': show.venue.id,
+                'venue_name': show.venue.name,
+                'artist_id': show.artist.id,
+                'artist_name': show.artist.name,
+                'artist_image_link': show.artist.image_link,
+                'start_time': show.start_time.isoformat()
+            })
+        return data
+
+    data = sorted((show for shows in shards.fan_out(shard_shows) for show in shows),
+                  key=lambda show: show['start_time'])
 
     return render_template('pages/shows.html', shows=data)
 
+def upcoming_query():
+    # from/to: dates or datetimes, "to" excluded; from defaults to now
+    try:
+        start = parse_time(request.args['from']) if request.args.get('from') \
+            else datetime.now()
+        end = parse_time(request.args['to']) if request.args.get('to') \
+            else start + timedelta(days=app.config['UPCOMING_DEFAULT_DAYS'])
+    except (ValueError, OverflowError):
+        abort(400)
+    return upcoming.between(start, end, state=request.args.get('state'),
+                            genre=request.args.get('genre'),
+                            limit=app.config['UPCOMING_LIMIT'])
+
+@app.route('/shows/upcoming')
+def upcoming_shows():
+    return render_template('pages/shows.html', shows=upcoming_query(),
+                           upcoming=True, states=State.choices(),
+                           genres=Genre.choices())
+
+@app.route('/shows/upcoming.json')
+def upcoming_shows_json():
+    return jsonify(upcoming_query())
+
 @app.route('/shows/create')
 def create_shows():
     # renders form. do not touch.
@@ -432,6 +663,7 @@ def create_show_submission():
     error = False
     form = ShowForm(request.form, csrf_enabled=False)
     if form.validate():
+        shards.use_venue_shard(form.venue_id.data)
         try:
             # Using FlaskForm:
             show = Show(
@@ -442,9 +674,14 @@ def create_show_submission():
             # Or:
             # show = Show()
             # form.populate_obj(show)
+            if shards.enabled:
+                show.id = shards.next_id('shows_id_seq')
 
             db.session.add(show)
+            db.session.flush()
+            stats.add_shows([show.id])
             db.session.commit()
+            upcoming.add(show)
 
             flash('Requested show was successfully listed')
         except ValueError as e:
@@ -462,6 +699,265 @@ def create_show_submission():
         
     return render_template('pages/home.html')
 
+@app.route('/shows/tour', methods=['GET'])
+def create_tour_form():
+    form = TourForm()
+    return render_template('forms/new_tour.html', form=form)
+
+@app.route('/shows/tour', methods=['POST'])
+def create_tour_submission():
+    # Accepts either the HTML form or a JSON body:
+    # {"artist_id": 1, "dates": [{"venue_id": 2, "start_time": "..."}, ...]}
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        form = None
+        if not isinstance(payload, dict) or \
+                not isinstance(payload.get('dates'), list) or \
+                not all(isinstance(row, dict) for row in payload['dates']):
+            return jsonify({'inserted': 0, 'errors': [{'row': None, 'error':
+                'Expected {"artist_id": .., "dates": [{"venue_id": .., '
+                '"start_time": ..}, ...]}.'}]}), 400
+        artist_id = payload.get('artist_id')
+        rows = payload['dates']
+    else:
+        form = TourForm(request.form, csrf_enabled=False)
+        if not form.validate():
+            message = []
+            for field, err in form.errors.items():
+                message.append(field + ' ' + '|'.join(err))
+            flash('Errors ' + str(message))
+            return render_template('forms/new_tour.html', form=form), 400
+        artist_id = form.artist_id.data
+        rows = tours.parse_dates(form.dates.data)
+
+    if not rows:
+        if form is None:
+            return jsonify({'inserted': 0, 'errors': [
+                {'row': None, 'error': 'No dates given.'}]}), 400
+        flash('No dates given.')
+        return render_template('forms/new_tour.html', form=form), 400
+
+    try:
+        artist_id = int(artist_id)
+        # With sharding, a tour is booked in one region's database
+        if shards.use_single_shard(row.get('venue_id') for row in rows):
+            values, errors = tours.validate_tour(artist_id, rows)
+        else:
+            values, errors = [], {i: 'Tour spans several regions; book each ' +
+                'region separately.' for i in range(len(rows))}
+        if errors:
+            # All or nothing: report every bad row and insert none of them
+            inserted = 0
+            db.session.rollback()
+        else:
+            if shards.enabled:
+                for value, show_id in zip(values,
+                        shards.next_ids('shows_id_seq', len(values))):
+                    value['id'] = show_id
+            inserted = tours.book_tour(values)
+    except (TypeError, ValueError) as e:
+        print(e)
+        db.session.rollback()
+        inserted = 0
+        errors = {i: 'Invalid artist id.' for i in range(len(rows))}
+    finally:
+        db.session.close()
+
+    status = 400 if errors else 201
+    if form is None:
+        return jsonify({
+            'inserted': inserted,
+            'errors': [{'row': i, 'error': err} for i, err in sorted(errors.items())]
+        }), status
+
+    if errors:
+        return render_template('forms/new_tour.html', form=form, rows=rows,
+                               errors=errors), status
+    flash('Tour of ' + str(inserted) + ' shows was successfully listed')
+    return render_template('pages/home.html')
+
+##### DELETE #####
+def delete_entity(model, entity, entity_id):
+    # Soft delete now; the shows are archived in the background
+    if entity == 'venue':
+        shards.use_venue_shard(entity_id)
+    obj = model.active().filter_by(id=entity_id).first_or_404()
+    job = purge.soft_delete(obj, entity)
+    db.session.commit()
+    if entity == 'artist':
+        shards.copy_artists([entity_id])
+    data = job.to_dict()
+    db.session.close()
+    purger.wake()
+    return data
+
+@app.route('/venues/<int:venue_id>', methods=['DELETE'])
+def delete_venue(venue_id):
+    return jsonify(delete_entity(Venue, 'venue', venue_id)), 202
+
+@app.route('/venues/<int:venue_id>/delete', methods=['POST'])
+def delete_venue_submission(venue_id):
+    delete_entity(Venue, 'venue', venue_id)
+    flash('Venue was successfully deleted!')
+    return redirect(url_for('venues'))
+
+@app.route('/artists/<int:artist_id>', methods=['DELETE'])
+def delete_artist(artist_id):
+    return jsonify(delete_entity(Artist, 'artist', artist_id)), 202
+
+@app.route('/artists/<int:artist_id>/delete', methods=['POST'])
+def delete_artist_submission(artist_id):
+    delete_entity(Artist, 'artist', artist_id)
+    flash('Artist was successfully deleted!')
+    return redirect(url_for('artists'))
+
+@app.route('/purge-jobs/<int:job_id>')
+def purge_job(job_id):
+    return jsonify(PurgeJob.query.get_or_404(job_id).to_dict())
+
+##### STATS #####
+def stats_query():
+    query = Stat.query.filter(Stat.shows > 0)
+    if request.args.get('state'):
+        query = query.filter(Stat.state == request.args['state'])
+    if request.args.get('genre'):
+        query = query.filter(Stat.genre == request.args['genre'])
+    if request.args.get('from'):
+        query = query.filter(Stat.month >=
+            dateutil.parser.parse(request.args['from']).date())
+    if request.args.get('to'):
+        query = query.filter(Stat.month <=
+            dateutil.parser.parse(request.args['to']).date())
+    return query.order_by(Stat.month.desc(), Stat.state, Stat.genre)
+
+@app.route('/stats')
+def booking_stats():
+    return render_template('pages/stats.html',
+                           stats=[stat.to_dict() for stat in stats_query()],
+                           states=State.choices(), genres=Genre.choices())
+
+@app.route('/stats.json')
+def booking_stats_json():
+    return jsonify([stat.to_dict() for stat in stats_query()])
+
+##### FEEDS #####
+def feed_response(validator, generate, mimetype, filename):
+    # Unchanged feeds are answered from the validator query alone
+    last_modified, etag = validator
+    if etag is None:
+        abort(404)
+    if feeds.not_modified(last_modified, etag):
+        response = Response(status=304)
+    else:
+        response = Response(stream_with_context(generate()), mimetype=mimetype)
+        response.headers['Content-Disposition'] = \
+            'inline; filename="{}"'.format(filename)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/venues/<int:venue_id>/calendar.ics')
+def venue_calendar(venue_id):
+    shards.use_venue_shard(venue_id)
+
+    def generate():
+        name = db.session.query(Venue.name).filter(Venue.id == venue_id).scalar()
+        return feeds.icalendar(name, feeds.venue_shows(venue_id))
+    return feed_response(feeds.venue_validator(venue_id), generate,
+                         'text/calendar', 'venue-{}.ics'.format(venue_id))
+
+@app.route('/artists/<int:artist_id>/calendar.ics')
+def artist_calendar(artist_id):
+    def generate():
+        name = db.session.query(Artist.name).filter(Artist.id == artist_id).scalar()
+        # Merged from every shard when sharded
+        return feeds.icalendar(name, shards.merge(
+            lambda session: feeds.artist_shows(artist_id, session),
+            key=lambda show: show.start_time))
+    return feed_response(
+        feeds.combine(shards.fan_out(feeds.artist_validator, artist_id)), generate,
+                         'text/calendar', 'artist-{}.ics'.format(artist_id))
+
+@app.route('/shows.csv')
+def shows_csv():
+    def generate():
+        return feeds.shows_csv(shards.merge(
+            feeds.all_shows, key=lambda show: (show.start_time, show.id)))
+    return feed_response(feeds.combine(shards.fan_out(feeds.site_validator)),
+                         generate, 'text/csv', 'shows.csv')
+
+##### IMAGES #####
+def image_url(kind, entity_id, link, size):
+    # Proxy URL for an image_link, versioned by the link itself
+    if not link:
+        return ''
+    return url_for('proxied_image', kind=kind, entity_id=entity_id, size=size,
+                   v=images.link_version(link))
+
+app.jinja_env.globals['image_url'] = image_url
+
+@app.route('/img/<kind>/<int:entity_id>/<size>')
+def proxied_image(kind, entity_id, size):
+    model = {'artist': Artist, 'venue': Venue}.get(kind)
+    if model is None or size not in images.SIZES:
+        abort(404)
+    if model is Venue:
+        shards.use_venue_shard(entity_id)
+    link = db.session.query(model.image_link).filter(
+        model.id == entity_id, model.deleted_at.is_(None)).scalar()
+    if not link:
+        abort(404)
+    try:
+        path = image_cache.resized(link, size)
+    except Exception as e:
+        # Unreachable or undecodable source: let the browser try it directly
+        app.logger.info('image proxy failed for %s: %s', link, e)
+        return redirect(link)
+    response = send_file(path, mimetype='image/jpeg', conditional=True)
+    response.cache_control.public = True
+    if request.args.get('v') == images.link_version(link):
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = 300
+    return response
+
+##### AUDIT #####
+@app.route('/audit/<entity>/<int:entity_id>')
+def audit_history(entity, entity_id):
+    # Newest first; ?before=<id> for the next page
+    if entity not in ('artist', 'venue', 'show'):
+        abort(404)
+    try:
+        before = int(request.args['before']) if request.args.get('before') else None
+        limit = min(int(request.args.get('limit') or 50), 500)
+    except ValueError:
+        abort(400)
+    entries = audit.history(entity, entity_id, before, limit)
+    return jsonify({
+        'entries': [entry.to_dict() for entry in entries],
+        'next': entries[-1].id if len(entries) == limit else None,
+    })
+
+##### ADMIN #####
+@app.route('/admin/query-stats')
+def query_stats():
+    # Aggregates are per worker process; the dump also goes to the slow log
+    token = app.config.get('QUERY_STATS_TOKEN')
+    if not token or not hmac.compare_digest(
+            request.headers.get('X-Admin-Token', ''), token):
+        abort(404)
+    rows = query_log.dump_stats(limit=request.args.get('limit', 50, type=int))
+    if request.args.get('reset'):
+        query_log.reset()
+    return jsonify([{
+        'statement': statement,
+        'count': count,
+        'total_ms': round(total * 1000, 3),
+        'max_ms': round(worst * 1000, 3)
+    } for statement, count, total, worst in rows])
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
@@ -0,0 +1,224 @@
+##### Audit log #####
+# Every committed create, update and delete of an artist, venue or show is
+# appended to audit_log: who (client address and endpoint), when, and the
+# columns that changed with their old and new values.
+#
+# Entries are built from the session's after_flush event, held on the
+# session until it commits (dropped otherwise) and then put on an
+# in-memory queue. A background thread per worker drains the queue and
+# writes the entries in batches with one multi-row INSERT, on its own
+# connection, so requests don't wait for the audit write. The queue is
+# bounded: when it is full, committing waits up to AUDIT_PUT_TIMEOUT for
+# room and then writes its entries itself. Whatever is queued is written
+# when the process exits.
+#
+# Rows written with Core statements (e.g. tour bookings) are recorded by
+# the code that writes them, with ``record``.
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import date, datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event, inspect
+
+from models import db, Venue, Artist, Show, AuditEntry
+
+logger = logging.getLogger(__name__)
+
+ENTITIES = {Artist: 'artist', Venue: 'venue', Show: 'show'}
+
+# Bookkeeping columns, not worth an audit entry of their own
+IGNORED = {'version', 'updated_at', 'created_at', 'name_key', 'geohash'}
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return [_value(item) for item in value]
+    return value
+
+
+def _actor():
+    if has_request_context():
+        return request.remote_addr, request.endpoint
+    return None, None
+
+
+def record(session, entity, entity_id, action, changes):
+    """Add an entry to be queued when ``session`` commits. ``changes``
+    maps column names to their new value, or to [old, new] for updates."""
+    actor, endpoint = _actor()
+    session.info.setdefault('audit', []).append({
+        'entity': entity,
+        'entity_id': entity_id,
+        'action': action,
+        'changes': {name: _value(value) for name, value in changes.items()},
+        'actor': actor,
+        'endpoint': endpoint,
+        'created_at': datetime.utcnow(),
+    })
+
+
+def _changes(obj, action):
+    state = inspect(obj)
+    changes = {}
+    for attr in state.mapper.column_attrs:
+        if attr.key in IGNORED:
+            continue
+        if action == 'create':
+            value = getattr(obj, attr.key)
+            if value is not None:
+                changes[attr.key] = value
+            continue
+        history = state.attrs[attr.key].history
+        if action == 'delete':
+            changes[attr.key] = (history.unchanged or history.deleted or [None])[0]
+        elif history.has_changes():
+            old = history.deleted[0] if history.deleted else None
+            new = history.added[0] if history.added else None
+            changes[attr.key] = [_value(old), _value(new)]
+    return changes
+
+
+class AuditLog(object):
+
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.app = app
+        if not config.get('AUDIT_ENABLED', True):
+            return
+        self.batch_size = config.get('AUDIT_BATCH_SIZE', 500)
+        self.interval = config.get('AUDIT_FLUSH_INTERVAL', 1.0)
+        self.put_timeout = config.get('AUDIT_PUT_TIMEOUT', 0.5)
+        self.queue = queue.Queue(maxsize=config.get('AUDIT_QUEUE_SIZE', 10000))
+        event.listen(db.session, 'after_flush', self._after_flush)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_transaction_end', self._after_end)
+        atexit.register(self.flush)
+        os.register_at_fork(after_in_child=self._forked)
+        app.extensions['audit'] = self
+
+    def _forked(self):
+        # Entries queued before the fork belong to the parent
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    ##### Session events #####
+    def _after_flush(self, session, flush_context):
+        for objects, action in ((session.new, 'create'),
+                                (session.dirty, 'update'),
+                                (session.deleted, 'delete')):
+            for obj in objects:
+                entity = ENTITIES.get(type(obj))
+                if entity is None or obj.id is None:
+                    continue
+                changes = _changes(obj, action)
+                kind = action
+                if action == 'update':
+                    if not changes:
+                        continue
+                    # Soft delete
+                    if changes.get('deleted_at', [None, None])[1] is not None:
+                        kind = 'delete'
+                record(session, entity, obj.id, kind, changes)
+
+    def _after_commit(self, session):
+        entries = session.info.pop('audit', None)
+        if entries:
+            self.put(entries)
+
+    def _after_end(self, session, transaction):
+        # Rolled back or closed without committing: nothing happened
+        if transaction.parent is None:
+            session.info.pop('audit', None)
+
+    ##### Queue #####
+    def put(self, entries):
+        self.start()
+        for i, entry in enumerate(entries):
+            try:
+                self.queue.put(entry, timeout=self.put_timeout)
+            except queue.Full:
+                # The writer is behind: write the rest in this thread
+                logger.warning('audit queue full, writing %d entries inline',
+                               len(entries) - i)
+                self.write(entries[i:])
+                return
+
+    def start(self):
+        # Started on first use, so each forked worker gets its own thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='audit-writer',
+                                                daemon=True)
+                self._thread.start()
+
+    def _drain(self, block):
+        entries = []
+        try:
+            entries.append(self.queue.get(timeout=self.interval) if block
+                           else self.queue.get_nowait())
+            while len(entries) < self.batch_size:
+                entries.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return entries
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                entries = self._drain(block=True)
+                if entries:
+                    self.write(entries, attempts=5)
+
+    def write(self, entries, attempts=1):
+        """Insert ``entries`` with one statement; returns True when done."""
+        for attempt in range(1, attempts + 1):
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(AuditEntry.__table__.insert().values(entries))
+                return True
+            except Exception:
+                if attempt == attempts:
+                    # Last resort: keep the entries in the error log
+                    logger.exception('could not write %d audit entries: %r',
+                                     len(entries), entries)
+                    return False
+                time.sleep(min(2 ** attempt, 30))
+
+    def flush(self):
+        """Write everything queued, in this thread."""
+        if self.queue is None:
+            return
+        with self.app.app_context():
+            while True:
+                entries = self._drain(block=False)
+                if not entries:
+                    return
+                self.write(entries)
+
+
+def history(entity, entity_id, before=None, limit=50):
+    """Audit entries of one artist, venue or show, newest first."""
+    query = AuditEntry.query.filter(AuditEntry.entity == entity,
+                                    AuditEntry.entity_id == entity_id)
+    if before is not None:
+        query = query.filter(AuditEntry.id < before)
+    return query.order_by(AuditEntry.id.desc()).limit(limit).all()
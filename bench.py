@@ -0,0 +1,431 @@
+##### Benchmarks #####
+# Run against a development database, e.g.:
+#   python bench.py tour --size 200
+# Unless noted otherwise, benchmarks only write rows far in the future
+# (year 2099) and remove them again when they are done.
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from app import app, artist_rows, venue_rows
+import geo
+import warmup
+from enums import Genre
+from models import db, Venue, Artist, Show
+from partitions import ensure_partitions
+from recommend import Recommender
+
+BENCH_START = datetime(2099, 1, 1, 20, 0)
+
+
+def _cleanup_shows():
+    Show.query.filter(Show.start_time >= BENCH_START).delete()
+    db.session.commit()
+
+
+def bench_tour(args):
+    """Single-show POSTs vs one tour POST for the same number of dates."""
+    client = app.test_client()
+    artist_id = db.session.query(Artist.id).first()[0]
+    venue_ids = [venue_id for venue_id, in db.session.query(Venue.id).limit(50)]
+    dates = [(venue_ids[i % len(venue_ids)], BENCH_START + timedelta(days=i))
+             for i in range(args.size)]
+
+    _cleanup_shows()
+    started = time.perf_counter()
+    for venue_id, start_time in dates:
+        response = client.post('/shows/create', data={
+            'artist_id': artist_id,
+            'venue_id': venue_id,
+            'start_time': start_time.strftime('%Y-%m-%d %H:%M:%S'),
+        })
+        assert response.status_code == 200, response.status_code
+    single = time.perf_counter() - started
+    # The form re-renders the home page either way: count what was stored
+    stored = Show.query.filter(Show.start_time >= BENCH_START).count()
+    assert stored == args.size, '{} of {} shows stored'.format(stored, args.size)
+
+    _cleanup_shows()
+    started = time.perf_counter()
+    response = client.post('/shows/tour', json={
+        'artist_id': artist_id,
+        'dates': [{'venue_id': venue_id, 'start_time': start_time.isoformat()}
+                  for venue_id, start_time in dates],
+    })
+    tour = time.perf_counter() - started
+    _cleanup_shows()
+    assert response.status_code == 201, (response.status_code,
+                                         response.get_json())
+
+    print('single-show path: {:8.3f}s  {:10.1f} shows/s'.format(
+        single, args.size / single))
+    print('tour path:        {:8.3f}s  {:10.1f} shows/s'.format(
+        tour, args.size / tour))
+
+
+def bench_partitions(args):
+    """Load historical shows, then time the upcoming-show queries.
+    Writes --rows past shows and does not remove them: use a scratch DB."""
+    artist_id = db.session.query(Artist.id).first()[0]
+    venue_ids = [venue_id for venue_id, in db.session.query(Venue.id).limit(50)]
+    oldest = datetime.now() - timedelta(days=365 * args.years)
+    ensure_partitions(start=oldest)
+
+    loaded = 0
+    started = time.perf_counter()
+    while loaded < args.rows:
+        batch = min(args.batch, args.rows - loaded)
+        db.session.execute(text("""
+            INSERT INTO shows (artist_id, venue_id, start_time)
+            SELECT :artist_id,
+                   (:venue_ids)[1 + (n % :venue_count)],
+                   now() - random() * (:days * interval '1 day') - interval '1 hour'
+            FROM generate_series(1, :batch) AS n
+        """), {'artist_id': artist_id, 'venue_ids': venue_ids,
+               'venue_count': len(venue_ids), 'days': 365 * args.years,
+               'batch': batch})
+        db.session.commit()
+        loaded += batch
+        print('loaded {:,} rows ({:.0f}s)'.format(
+            loaded, time.perf_counter() - started))
+    db.session.execute(text('ANALYZE shows'))
+    db.session.commit()
+
+    queries = {
+        'upcoming for venue': Show.query.filter(
+            Show.venue_id == venue_ids[0], Show.start_time > datetime.now()),
+        'upcoming for artist': Show.query.filter(
+            Show.artist_id == artist_id, Show.start_time > datetime.now()),
+        'all upcoming': Show.query.filter(Show.start_time > datetime.now()),
+    }
+    for label, query in queries.items():
+        statement = query.statement.compile(dialect=db.engine.dialect)
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            query.all()
+            timings.append(time.perf_counter() - started)
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + str(statement),
+                       statement.params)
+        plan = cursor.fetchall()
+        scanned = sum(1 for line, in plan if ' on shows_' in line)
+        print('{:20s} best {:8.2f} ms  partitions scanned: {}'.format(
+            label, min(timings) * 1000, scanned))
+
+
+def bench_recommend(args):
+    """Artist recommendations over --artists synthetic artists and --shows
+    shows: full build, incremental refresh and scoring one venue."""
+    started = time.perf_counter()
+    genres = [genre.name for genre in Genre]
+    db.session.execute(text("""
+        INSERT INTO artists (name, city, state, phone, genres,
+                            seeking_venue, version)
+        SELECT 'bench-rec-' || n, 'City ' || (n % 300), 'NY', '555-0100',
+               ARRAY[g[1 + floor(random() * cardinality(g))::int],
+                     g[1 + floor(random() * cardinality(g))::int]],
+               false, 1
+        FROM generate_series(1, :count) AS n,
+             (SELECT CAST(:genres AS varchar[]) AS g) AS genres
+    """), {'count': args.artists, 'genres': genres})
+    db.session.execute(text("""
+        INSERT INTO venues (name, city, state, address, genres,
+                            seeking_talent, version)
+        SELECT 'bench-rec-' || n, 'City ' || (n % 300), 'NY', 'Main St',
+               ARRAY[g[1 + floor(random() * cardinality(g))::int]], false, 1
+        FROM generate_series(1, :count) AS n,
+             (SELECT CAST(:genres AS varchar[]) AS g) AS genres
+    """), {'count': args.venues, 'genres': genres})
+    # Every show a distinct hour, so no two clash at a venue
+    db.session.execute(text("""
+        INSERT INTO shows (artist_id, venue_id, start_time)
+        SELECT a[1 + floor(random() * cardinality(a))::int],
+               v[1 + floor(random() * cardinality(v))::int],
+               CAST(:start AS timestamp) + n * interval '1 hour'
+        FROM generate_series(1, :count) AS n,
+             (SELECT array_agg(id) AS a FROM artists
+              WHERE name LIKE 'bench-rec-%') AS artists,
+             (SELECT array_agg(id) AS v FROM venues
+              WHERE name LIKE 'bench-rec-%') AS venues
+    """), {'count': args.shows, 'start': BENCH_START})
+    db.session.commit()
+    print('loaded {:,} artists, {:,} venues, {:,} shows ({:.0f}s)'.format(
+        args.artists, args.venues, args.shows, time.perf_counter() - started))
+
+    try:
+        recommender = Recommender()
+        started = time.perf_counter()
+        recommender.refresh()
+        print('full build                {:9.1f} ms'.format(
+            (time.perf_counter() - started) * 1000))
+
+        artist_ids = [artist_id for artist_id, in db.session.query(Artist.id).
+                      filter(Artist.name.like('bench-rec-%')).limit(100)]
+        show_ids = [show_id for show_id, in db.session.query(Show.id).
+                    filter(Show.start_time >= BENCH_START).limit(100)]
+        for artist_id in artist_ids:
+            recommender.invalidate(artist_id=artist_id)
+        for show_id in show_ids:
+            recommender.invalidate(show_id=show_id)
+        started = time.perf_counter()
+        recommender.refresh()
+        print('refresh, 100+100 changed  {:9.1f} ms'.format(
+            (time.perf_counter() - started) * 1000))
+
+        venues = Venue.query.filter(Venue.name.like('bench-rec-%')).\
+            order_by(db.func.random()).limit(args.queries).all()
+        timings = []
+        for venue in venues:
+            started = time.perf_counter()
+            recommender.recommend(venue, limit=10)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        median = timings[len(timings) // 2]
+        print('recommend, limit 10       median {:7.1f} ms  p95 {:7.1f} ms  '
+              '(target < {} ms: {})'.format(
+                  median * 1000, timings[int(len(timings) * 0.95)] * 1000,
+                  args.target_ms, 'met' if median * 1000 < args.target_ms
+                  else 'MISSED'))
+    finally:
+        db.session.rollback()
+        _cleanup_shows()
+        db.session.execute(text("DELETE FROM artists WHERE name LIKE 'bench-rec-%'"))
+        db.session.execute(text("DELETE FROM venues WHERE name LIKE 'bench-rec-%'"))
+        db.session.commit()
+
+
+def _timings(label, fn, points):
+    timings, found = [], 0
+    for lat, lon in points:
+        started = time.perf_counter()
+        found += len(fn(lat, lon))
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    print('{:28s} median {:8.2f} ms  p95 {:8.2f} ms  {:.1f} venues/query'.format(
+        label, timings[len(timings) // 2] * 1000,
+        timings[int(len(timings) * 0.95)] * 1000, found / len(points)))
+
+
+def bench_geo(args):
+    """Radius and nearest-k venue searches over --venues synthetic venues,
+    through the geohash index and as a full scan."""
+    random.seed(args.seed)
+    # Spread over the continental US, with a few dense cities
+    cities = [(random.uniform(25, 49), random.uniform(-124, -67))
+              for _ in range(200)]
+
+    def point():
+        if random.random() < 0.7:
+            lat, lon = random.choice(cities)
+            return lat + random.gauss(0, 0.1), lon + random.gauss(0, 0.1)
+        return random.uniform(25, 49), random.uniform(-124, -67)
+
+    table = Venue.__table__
+    loaded = 0
+    started = time.perf_counter()
+    while loaded < args.venues:
+        rows = []
+        for i in range(loaded, min(loaded + args.batch, args.venues)):
+            lat, lon = point()
+            rows.append({'name': 'bench-geo-{}'.format(i), 'city': 'Bench',
+                         'state': 'NY', 'genres': [], 'seeking_talent': False,
+                         'version': 1, 'latitude': lat, 'longitude': lon,
+                         'geohash': geo.encode(lat, lon)})
+        db.session.execute(table.insert(), rows)
+        db.session.commit()
+        loaded += len(rows)
+        print('loaded {:,} venues ({:.0f}s)'.format(
+            loaded, time.perf_counter() - started))
+    db.session.execute(text('ANALYZE venues'))
+    db.session.commit()
+
+    try:
+        points = [point() for _ in range(args.queries)]
+        _timings('within {} km (geohash)'.format(args.radius),
+                 lambda lat, lon: geo.venues_within(lat, lon, args.radius),
+                 points)
+        _timings('nearest {} (geohash)'.format(args.k),
+                 lambda lat, lon: geo.nearest(lat, lon, args.k), points)
+        # Same results without the index, on a few points only
+        few = points[:args.scans]
+        _timings('within {} km (full scan)'.format(args.radius),
+                 lambda lat, lon: geo._query(lat, lon, None, args.radius, None),
+                 few)
+        _timings('nearest {} (full scan)'.format(args.k),
+                 lambda lat, lon: geo._query(lat, lon, None, None, args.k), few)
+    finally:
+        db.session.rollback()
+        db.session.execute(text("DELETE FROM venues WHERE name LIKE 'bench-geo-%'"))
+        db.session.commit()
+
+
+def _measure(label, fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        rows = fn()
+        timings.append(time.perf_counter() - started)
+    db.session.expunge_all()
+    tracemalloc.start()
+    rows = fn()
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:34s} {:>9,} rows  best {:9.1f} ms  peak {:8.1f} MB  held {:8.1f} MB'
+          .format(label, len(rows), min(timings) * 1000, peak / 2 ** 20,
+                  held / 2 ** 20))
+    del rows
+    db.session.expunge_all()
+
+
+def bench_projections(args):
+    """Artist list/search and venue search: full ORM objects (as the routes
+    used to load them) vs the column projections they use now."""
+    loaded = 0
+    started = time.perf_counter()
+    while loaded < args.rows:
+        batch = min(args.batch, args.rows - loaded)
+        db.session.execute(text("""
+            INSERT INTO artists (name, city, state, phone, genres,
+                                 seeking_venue, version)
+            SELECT 'bench-proj-' || n, 'Bench', 'NY', '555-0100',
+                   '{Jazz,Rock}', false, 1
+            FROM generate_series(:start, :end) AS n
+        """), {'start': loaded, 'end': loaded + batch - 1})
+        db.session.commit()
+        loaded += batch
+        print('loaded {:,} artists ({:.0f}s)'.format(
+            loaded, time.perf_counter() - started))
+    db.session.execute(text("""
+        INSERT INTO venues (name, city, state, address, genres,
+                            seeking_talent, version)
+        SELECT 'bench-proj-' || n, 'Bench', 'NY', 'Main St', '{Jazz}', false, 1
+        FROM generate_series(1, :count) AS n
+    """), {'count': args.venues})
+    db.session.commit()
+    db.session.execute(text('ANALYZE artists'))
+    db.session.execute(text('ANALYZE venues'))
+    db.session.commit()
+
+    try:
+        _measure('artists: ORM objects',
+                 lambda: Artist.active().all(), args.repeat)
+        _measure('artists: projection', artist_rows, args.repeat)
+        _measure('artist search: ORM objects', lambda: Artist.active().filter(
+            Artist.name.ilike('%bench-proj-1%')).all(), args.repeat)
+        _measure('artist search: projection',
+                 lambda: artist_rows('bench-proj-1'), args.repeat)
+        # The old venue search also loaded each venue's shows collection
+        _measure('venue search: ORM + shows', lambda: [
+            (venue, len(venue.shows)) for venue in Venue.active().filter(
+                Venue.name.ilike('%bench-proj-%')).all()], args.repeat)
+        _measure('venue search: projection',
+                 lambda: venue_rows('bench-proj-'), args.repeat)
+    finally:
+        db.session.rollback()
+        db.session.execute(text("DELETE FROM artists WHERE name LIKE 'bench-proj-%'"))
+        db.session.execute(text("DELETE FROM venues WHERE name LIKE 'bench-proj-%'"))
+        db.session.commit()
+
+
+WARMUP_PATHS = ('/', '/artists', '/venues', '/shows', '/shows/upcoming')
+
+
+def _first_requests(warm):
+    # In a fresh process: time the first request to each page, after
+    # warming up as a preloaded gunicorn master and worker would
+    timings = {}
+    if warm:
+        started = time.perf_counter()
+        warmup.preload(app)
+        warmup.prime_worker(app)
+        timings['warm-up'] = time.perf_counter() - started
+    client = app.test_client()
+    for path in WARMUP_PATHS:
+        started = time.perf_counter()
+        client.get(path)
+        timings[path] = time.perf_counter() - started
+    return timings
+
+
+def bench_warmup(args):
+    """First-request latency of a new worker, cold vs warmed up."""
+    if args.child:
+        print(json.dumps(_first_requests(args.child == 'warm')))
+        return
+    results = {'cold': [], 'warm': []}
+    for _ in range(args.repeat):
+        for mode in results:
+            output = subprocess.check_output(
+                [sys.executable, __file__, 'warmup', '--child', mode])
+            results[mode].append(json.loads(output.decode().splitlines()[-1]))
+    print('{:18s} {:>10s} {:>10s}'.format('median ms', 'cold', 'warm'))
+    for path in ('warm-up',) + WARMUP_PATHS:
+        medians = []
+        for mode in ('cold', 'warm'):
+            values = sorted(run[path] for run in results[mode] if path in run)
+            medians.append('{:10.1f}'.format(values[len(values) // 2] * 1000)
+                           if values else '{:>10s}'.format('-'))
+        print('{:18s} {} {}'.format(path, *medians))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fyyur benchmarks')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    tour = commands.add_parser('tour', help=bench_tour.__doc__)
+    tour.add_argument('--size', type=int, default=200)
+    tour.set_defaults(func=bench_tour)
+
+    partitions = commands.add_parser('partitions', help=bench_partitions.__doc__)
+    partitions.add_argument('--rows', type=int, default=50000000)
+    partitions.add_argument('--years', type=int, default=10)
+    partitions.add_argument('--batch', type=int, default=1000000)
+    partitions.add_argument('--repeat', type=int, default=5)
+    partitions.set_defaults(func=bench_partitions)
+
+    recommend = commands.add_parser('recommend', help=bench_recommend.__doc__)
+    recommend.add_argument('--artists', type=int, default=100000)
+    recommend.add_argument('--venues', type=int, default=5000)
+    recommend.add_argument('--shows', type=int, default=500000)
+    recommend.add_argument('--queries', type=int, default=200)
+    recommend.add_argument('--target-ms', type=float, default=50)
+    recommend.set_defaults(func=bench_recommend)
+
+    near = commands.add_parser('geo', help=bench_geo.__doc__)
+    near.add_argument('--venues', type=int, default=1000000)
+    near.add_argument('--batch', type=int, default=10000)
+    near.add_argument('--queries', type=int, default=500)
+    near.add_argument('--scans', type=int, default=5)
+    near.add_argument('--radius', type=float, default=10.0)
+    near.add_argument('--k', type=int, default=10)
+    near.add_argument('--seed', type=int, default=1)
+    near.set_defaults(func=bench_geo)
+
+    projections = commands.add_parser('projections',
+                                      help=bench_projections.__doc__)
+    projections.add_argument('--rows', type=int, default=1000000)
+    projections.add_argument('--venues', type=int, default=10000)
+    projections.add_argument('--batch', type=int, default=100000)
+    projections.add_argument('--repeat', type=int, default=3)
+    projections.set_defaults(func=bench_projections)
+
+    warm = commands.add_parser('warmup', help=bench_warmup.__doc__)
+    warm.add_argument('--repeat', type=int, default=5)
+    warm.add_argument('--child', choices=('cold', 'warm'), help=argparse.SUPPRESS)
+    warm.set_defaults(func=bench_warmup)
+
+    args = parser.parse_args()
+    # Benchmarks send far more requests than any client may
+    app.config['RATE_LIMIT_ENABLED'] = False
+    with app.app_context():
+        args.func(args)
@@ -0,0 +1,17 @@
+##### Change tracking #####
+# Helpers used by the edit handlers so that only the columns that actually
+# changed are written. The changed columns reach the caches of every worker
+# with the change notification (see notify.py), so caches can ignore edits
+# to columns they don't hold.
+
+
+def apply_changes(obj, form, fields):
+    """Copy the form data onto ``obj`` for the given fields, but only assign
+    the attributes whose value differs. Returns the set of changed fields."""
+    changed = set()
+    for name in fields:
+        value = getattr(form, name).data
+        if getattr(obj, name) != value:
+            setattr(obj, name, value)
+            changed.add(name)
+    return changed
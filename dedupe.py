@@ -0,0 +1,158 @@
+##### Duplicate venues and artists #####
+# Names are compared by their name_key: the name lowercased, with "&" as
+# "and", punctuation and the articles the/a/an removed ("The Musical Hop"
+# and "Musical Hop, The" both become "musical hop"). The key is computed
+# by the normalize_name() SQL function and kept up to date by a trigger
+# (see migration b3f7d1c05e62).
+#
+# On create, similar names in the same city and state are looked up with
+# pg_trgm through a GIN index on (state, lower(city), name_key), so the
+# check reads a few index pages rather than scanning the table, and shown
+# to the user before anything is inserted.
+#
+# ``flask duplicates cluster venues`` groups existing duplicates offline:
+# MinHash signatures of each name_key's trigrams are bucketed with LSH
+# bands per city/state, and candidate pairs whose estimated similarity
+# passes the threshold are joined into clusters.
+import csv
+import sys
+import zlib
+from collections import defaultdict
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from models import db
+
+duplicates_cli = AppGroup('duplicates', help='Find duplicate venues/artists.')
+
+TABLES = ('venues', 'artists')
+
+# pg_trgm similarity from which a name counts as a likely duplicate
+SIMILARITY = 0.5
+
+
+def similar(table, name, city, state, limit=5, threshold=SIMILARITY):
+    """Likely duplicates of a new ``name`` in ``city``/``state``, best
+    match first, as dicts with id, name, city, state and score."""
+    if table not in TABLES or not name:
+        return []
+    db.session.execute(text(
+        "SELECT set_config('pg_trgm.similarity_threshold', :threshold, true)"),
+        {'threshold': str(threshold)})
+    rows = db.session.execute(text("""
+        SELECT id, name, city, state,
+               similarity(name_key, normalize_name(:name)) AS score
+        FROM {table}
+        WHERE deleted_at IS NULL
+          AND state = :state AND lower(city) = lower(:city)
+          AND name_key % normalize_name(:name)
+        ORDER BY score DESC, id
+        LIMIT :limit
+    """.format(table=table)), {'name': name, 'city': city or '',
+                               'state': state, 'limit': limit})
+    return [{'id': row.id, 'name': row.name, 'city': row.city,
+             'state': row.state, 'score': round(row.score, 2)} for row in rows]
+
+
+##### MinHash clustering #####
+PRIME = (1 << 61) - 1
+
+
+def shingles(key):
+    padded = ' {} '.format(key)
+    return {zlib.crc32(padded[i:i + 3].encode())
+            for i in range(max(len(padded) - 2, 1))}
+
+
+class MinHasher(object):
+
+    def __init__(self, permutations=64, seed=1):
+        random = np.random.RandomState(seed)
+        self.a = random.randint(1, 1 << 31, size=permutations).astype(np.uint64)
+        self.b = random.randint(0, 1 << 31, size=permutations).astype(np.uint64)
+
+    def signature(self, key):
+        values = np.fromiter(shingles(key), dtype=np.uint64)
+        # (a * x + b) mod p for every permutation and shingle at once
+        hashed = (values[:, None] * self.a[None, :] + self.b[None, :]) % PRIME
+        return hashed.min(axis=0)
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def cluster_block(rows, hasher, bands, threshold):
+    """Clusters (lists of rows) of likely duplicates within one block."""
+    if len(rows) < 2:
+        return []
+    signatures = np.vstack([hasher.signature(row.name_key or '') for row in rows])
+    width = signatures.shape[1] // bands
+    parent = list(range(len(rows)))
+    for band in range(bands):
+        buckets = defaultdict(list)
+        chunk = signatures[:, band * width:(band + 1) * width]
+        for i, values in enumerate(chunk):
+            buckets[values.tobytes()].append(i)
+        for members in buckets.values():
+            first = members[0]
+            for other in members[1:]:
+                # Fraction of equal minhashes estimates the Jaccard similarity
+                if (signatures[first] == signatures[other]).mean() >= threshold:
+                    parent[_find(parent, other)] = _find(parent, first)
+
+    clusters = defaultdict(list)
+    for i, row in enumerate(rows):
+        clusters[_find(parent, i)].append(row)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def clusters(table, threshold=0.6, bands=16, permutations=64):
+    """Yield clusters of likely duplicates in ``table``, one city at a time."""
+    hasher = MinHasher(permutations)
+    result = db.session.execute(text("""
+        SELECT id, name, name_key, city, state, lower(city) AS city_key
+        FROM {} WHERE deleted_at IS NULL
+        ORDER BY state, lower(city), id
+    """.format(table)))
+    block, current = [], None
+    for row in result:
+        if (row.state, row.city_key) != current:
+            yield from cluster_block(block, hasher, bands, threshold)
+            block, current = [], (row.state, row.city_key)
+        block.append(row)
+    yield from cluster_block(block, hasher, bands, threshold)
+
+
+@duplicates_cli.command('cluster')
+@click.argument('table', type=click.Choice(TABLES))
+@click.option('--threshold', default=0.6, show_default=True,
+              help='Estimated trigram Jaccard similarity to link two names.')
+@click.option('--bands', default=16, show_default=True,
+              help='LSH bands; more bands find more (and weaker) pairs.')
+@click.option('--shard', default=None, help='Shard to read (venues only).')
+@click.option('--csv', 'as_csv', is_flag=True, help='Write CSV to stdout.')
+def cluster_command(table, threshold, bands, shard, as_csv):
+    """Cluster likely duplicate venues or artists."""
+    if shard:
+        current_app.extensions['shards'].use_shard(shard)
+    writer = csv.writer(sys.stdout) if as_csv else None
+    if writer:
+        writer.writerow(('cluster', 'id', 'name', 'city', 'state'))
+    count = 0
+    for count, members in enumerate(clusters(table, threshold, bands), 1):
+        for row in members:
+            if writer:
+                writer.writerow((count, row.id, row.name, row.city, row.state))
+        if not writer:
+            click.echo('{}, {}: {}'.format(members[0].city, members[0].state,
+                '; '.join('{} {}'.format(row.id, row.name) for row in members)))
+    if not writer:
+        click.echo('{} clusters'.format(count))
@@ -0,0 +1,197 @@
+##### Schedule feeds #####
+# iCalendar feeds per venue and per artist plus a site-wide CSV of shows.
+# Rows are streamed from a server-side cursor (yield_per), so memory use
+# does not depend on the number of shows. Each feed has a validator
+# (Last-Modified and an ETag) computed from indexed timestamp columns, the
+# show count and the time shows were last archived (purge jobs, detached
+# partitions), so polling an unchanged feed costs two small queries.
+import csv
+import hashlib
+import io
+from datetime import datetime
+
+from flask import request
+from sqlalchemy import func, text
+
+from models import db, Venue, Artist, Show
+import partitions
+
+BATCH_SIZE = 500
+
+
+def _validator(last_modified, *parts):
+    if last_modified is None:
+        return None, None
+    etag = hashlib.sha1(
+        repr((last_modified.isoformat(),) + parts).encode()).hexdigest()
+    return last_modified, etag
+
+
+def _archived():
+    # Archiving removes shows without touching any of the timestamps above:
+    # a purge job moving shows, or a whole partition detached
+    return db.session.execute(text(
+        'SELECT greatest((SELECT max(updated_at) FROM purge_jobs), ({}))'.format(
+            partitions.ARCHIVED_AT))).scalar()
+
+
+def _latest(*stamps):
+    stamps = [value for value in stamps if value is not None]
+    return max(stamps) if stamps else datetime(1970, 1, 1)
+
+
+def venue_validator(venue_id):
+    """``(last_modified, etag)`` for a venue feed, ``(None, None)`` if the
+    venue does not exist. Artist renames and deletes show up through
+    artists.updated_at, archived shows through the count and _archived()."""
+    row = db.session.query(
+        Venue.updated_at, func.max(Show.created_at),
+        func.max(Artist.updated_at), func.count(Show.id)).\
+        outerjoin(Show, Show.venue_id == Venue.id).\
+        outerjoin(Artist, Artist.id == Show.artist_id).\
+        filter(Venue.id == venue_id, Venue.deleted_at.is_(None)).\
+        group_by(Venue.updated_at).first()
+    if row is None:
+        return None, None
+    return _validator(_latest(*row[:3], _archived()), 'venue', venue_id, row[3])
+
+
+def artist_validator(artist_id):
+    row = db.session.query(
+        Artist.updated_at, func.max(Show.created_at),
+        func.max(Venue.updated_at), func.count(Show.id)).\
+        outerjoin(Show, Show.artist_id == Artist.id).\
+        outerjoin(Venue, Venue.id == Show.venue_id).\
+        filter(Artist.id == artist_id, Artist.deleted_at.is_(None)).\
+        group_by(Artist.updated_at).first()
+    if row is None:
+        return None, None
+    return _validator(_latest(*row[:3], _archived()), 'artist', artist_id, row[3])
+
+
+def site_validator():
+    # Three index-only max() lookups; soft deletes bump updated_at. Shows
+    # archived (whose ids may all be older than the newest show) come in
+    # through _archived().
+    row = db.session.query(
+        db.session.query(func.max(Show.created_at)).as_scalar(),
+        db.session.query(func.max(Venue.updated_at)).as_scalar(),
+        db.session.query(func.max(Artist.updated_at)).as_scalar()).one()
+    return _validator(_latest(*row, _archived()), 'site')
+
+
+def combine(validators):
+    """One validator for a feed whose rows come from several shards."""
+    found = [validator for validator in validators if validator[1] is not None]
+    if len(found) < 2:
+        return found[0] if found else (None, None)
+    return _validator(max(last_modified for last_modified, _ in found),
+                      *sorted(etag for _, etag in found))
+
+
+def not_modified(last_modified, etag):
+    """True when the client's cached copy is still current. If-None-Match
+    wins over If-Modified-Since, as HTTP requires."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    if since is not None:
+        # HTTP dates have whole seconds and the parsed value is tz-aware
+        return last_modified.replace(microsecond=0) <= since.replace(tzinfo=None)
+    return False
+
+
+def _shows_query(session=None):
+    return (session or db.session).query(
+        Show.id, Show.start_time, Show.created_at,
+        Artist.id.label('artist_id'), Artist.name.label('artist_name'),
+        Venue.id.label('venue_id'), Venue.name.label('venue_name'),
+        Venue.address, Venue.city, Venue.state).\
+        join(Artist, Artist.id == Show.artist_id).\
+        join(Venue, Venue.id == Show.venue_id).\
+        filter(Artist.deleted_at.is_(None), Venue.deleted_at.is_(None))
+
+
+def venue_shows(venue_id, session=None):
+    return _shows_query(session).filter(Show.venue_id == venue_id).\
+        order_by(Show.start_time).yield_per(BATCH_SIZE)
+
+
+def artist_shows(artist_id, session=None):
+    return _shows_query(session).filter(Show.artist_id == artist_id).\
+        order_by(Show.start_time).yield_per(BATCH_SIZE)
+
+
+def all_shows(session=None):
+    return _shows_query(session).order_by(Show.start_time, Show.id).\
+        yield_per(BATCH_SIZE)
+
+
+##### iCalendar #####
+def _escape(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').\
+        replace(',', '\\,').replace('\n', '\\n')
+
+
+def _fold(line):
+    # Content lines are folded at 75 octets (RFC 5545, 3.1)
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line + '\r\n'
+    parts = []
+    while data:
+        limit = 75 if not parts else 74
+        cut = min(limit, len(data))
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+            cut -= 1  # don't split a UTF-8 sequence
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def _stamp(value):
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def icalendar(name, shows):
+    """Generate the calendar line by line."""
+    yield _fold('BEGIN:VCALENDAR')
+    yield _fold('VERSION:2.0')
+    yield _fold('PRODID:-//Fyyur//Schedule//EN')
+    yield _fold('X-WR-CALNAME:' + _escape(name))
+    for show in shows:
+        location = ', '.join(part for part in (
+            show.venue_name, show.address, show.city, show.state) if part)
+        yield ''.join([
+            _fold('BEGIN:VEVENT'),
+            _fold('UID:show-{}@fyyur'.format(show.id)),
+            _fold('DTSTAMP:' + _stamp(show.created_at) + 'Z'),
+            # Start times are stored as local venue time
+            _fold('DTSTART:' + _stamp(show.start_time)),
+            _fold('SUMMARY:' + _escape('{} at {}'.format(
+                show.artist_name, show.venue_name))),
+            _fold('LOCATION:' + _escape(location)),
+            _fold('URL:' + request.host_url + 'venues/{}'.format(show.venue_id)),
+            _fold('END:VEVENT'),
+        ])
+    yield _fold('END:VCALENDAR')
+
+
+##### CSV #####
+CSV_COLUMNS = ('show_id', 'start_time', 'artist_id', 'artist_name',
+               'venue_id', 'venue_name', 'city', 'state')
+
+
+def shows_csv(shows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for show in shows:
+        writer.writerow((show.id, show.start_time.isoformat(), show.artist_id,
+                         show.artist_name, show.venue_id, show.venue_name,
+                         show.city, show.state))
+        if buffer.tell() > 16384:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
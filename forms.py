@@ -5,7 +5,9 @@ from wtforms import (
     SelectField, 
     SelectMultipleField, 
     DateTimeField,
-    BooleanField
+    BooleanField,
+    TextAreaField,
+    HiddenField
     )
 from wtforms.fields.core import BooleanField
 from wtforms.validators import DataRequired, URL
@@ -53,6 +55,14 @@ class VenueForm(Form):
     facebook_link = StringField(
         'facebook_link',
     )
+    # Row version the form was rendered from (optimistic locking on edit)
+    version = HiddenField(
+        'version',
+    )
+    # Set once the user has seen the likely duplicates (create only)
+    allow_duplicate = HiddenField(
+        'allow_duplicate',
+    )
 
     def validate(self):
         """Define a custom validate method in your Form:"""
@@ -106,6 +116,14 @@ class ArtistForm(Form):
     facebook_link = StringField(
         'facebook_link',
     )
+    # Row version the form was rendered from (optimistic locking on edit)
+    version = HiddenField(
+        'version',
+    )
+    # Set once the user has seen the likely duplicates (create only)
+    allow_duplicate = HiddenField(
+        'allow_duplicate',
+    )
 
     def validate(self):
         """Define a custom validate method in your Form:"""
@@ -134,4 +152,15 @@ class ShowForm(Form):
         'start_time',
         validators=[DataRequired()],
         default= datetime.today()
-    )
\ No newline at end of file
+    )
+
+class TourForm(Form):
+    artist_id = StringField(
+        'artist_id', 
+        validators=[DataRequired()]
+    )
+    # One "venue_id, start_time" pair per line
+    dates = TextAreaField(
+        'dates',
+        validators=[DataRequired()]
+    )
@@ -0,0 +1,238 @@
+##### Venues near a point #####
+# Venues have a latitude/longitude and the geohash of that point, looked up
+# offline in a CSV file (GEOCODE_FILE, see ``Geocoder``): on create and
+# edit when the file is configured, and in bulk by
+#   flask geo geocode places.csv [--all]
+#
+# Proximity search uses the geohash B-tree index instead of a spatial
+# extension. Every cell of a geohash shares its prefix, so the 3 x 3 block
+# of cells around a point is nine index range scans, and any venue within
+# one cell size of the point lies inside that block:
+#   venues_within(lat, lon, km)  the cells just large enough for the
+#                                radius, then the exact haversine distance
+#   nearest(lat, lon, k)         blocks of ever larger cells until k
+#                                venues lie within the distance the block
+#                                is known to cover
+import csv
+import math
+import re
+from functools import lru_cache
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, or_, text
+
+from models import db, Venue
+
+geo_cli = AppGroup('geo', help='Venue coordinates.')
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Stored geohash length, cells of about 5 x 5 m
+PRECISION = 9
+# First cell size tried by nearest(), about 1 x 0.6 km
+NEAREST_START_PRECISION = 6
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+##### Geohash #####
+def encode(lat, lon, precision=PRECISION):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits, value, even = 0, 0, True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, longitude first
+        span, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (span[0] + span[1]) / 2
+        if coordinate >= middle:
+            value = value * 2 + 1
+            span[0] = middle
+        else:
+            value *= 2
+            span[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+def cell_degrees(precision):
+    """(height, width) of a cell in degrees."""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def reach_km(lat, precision):
+    """Distance from any point of a cell that the 3 x 3 block of cells
+    around it is sure to cover."""
+    height, width = cell_degrees(precision)
+    # Cells narrow towards the poles; use the block's poleward edge
+    edge = min(90.0, abs(lat) + 2 * height)
+    return min(height * KM_PER_DEGREE,
+               width * KM_PER_DEGREE * math.cos(math.radians(edge)))
+
+
+def block(lat, lon, precision):
+    """The cell of the point and its (up to) eight neighbours."""
+    height, width = cell_degrees(precision)
+    # Centre of the point's cell, then step one cell each way
+    centre_lat = (math.floor((lat + 90) / height) + 0.5) * height - 90
+    centre_lon = (math.floor((lon + 180) / width) + 0.5) * width - 180
+    cells = set()
+    for dlat in (-height, 0, height):
+        cell_lat = centre_lat + dlat
+        if not -90 < cell_lat < 90:
+            continue
+        for dlon in (-width, 0, width):
+            cell_lon = (centre_lon + dlon + 180) % 360 - 180
+            cells.add(encode(cell_lat, cell_lon, precision))
+    return sorted(cells)
+
+
+##### Queries #####
+def distance_km(lat, lon):
+    """Haversine distance of a venue from the point, as SQL."""
+    dlat = func.radians(Venue.latitude - lat) / 2
+    dlon = func.radians(Venue.longitude - lon) / 2
+    a = func.power(func.sin(dlat), 2) + \
+        math.cos(math.radians(lat)) * func.cos(func.radians(Venue.latitude)) * \
+        func.power(func.sin(dlon), 2)
+    return 2 * EARTH_RADIUS_KM * func.asin(func.sqrt(func.least(1.0, a)))
+
+
+def _query(lat, lon, cells, within_km, limit, name=None):
+    distance = distance_km(lat, lon)
+    query = db.session.query(
+        Venue.id, Venue.name, Venue.address, Venue.city, Venue.state,
+        Venue.latitude, Venue.longitude, distance.label('distance_km')).\
+        filter(Venue.deleted_at.is_(None), Venue.geohash.isnot(None))
+    if cells is not None:
+        # geohash is "C"-collated, so '~' sorts after every base32 digit
+        query = query.filter(or_(*[Venue.geohash.between(cell, cell + '~')
+                                   for cell in cells]))
+    if within_km is not None:
+        query = query.filter(distance <= within_km)
+    if name:
+        query = query.filter(Venue.name.ilike('%{}%'.format(name)))
+    query = query.order_by(distance, Venue.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return [dict(row._asdict(), distance_km=round(row.distance_km, 3))
+            for row in query]
+
+
+def venues_within(lat, lon, radius_km, limit=None, name=None):
+    """Venues within ``radius_km`` of the point, nearest first."""
+    for precision in range(PRECISION, 0, -1):
+        if reach_km(lat, precision) >= radius_km:
+            return _query(lat, lon, block(lat, lon, precision), radius_km,
+                          limit, name)
+    # Larger than the coarsest cells: every venue is a candidate
+    return _query(lat, lon, None, radius_km, limit, name)
+
+
+def nearest(lat, lon, k, name=None):
+    """The ``k`` venues nearest to the point, nearest first."""
+    for precision in range(NEAREST_START_PRECISION, 0, -1):
+        reach = reach_km(lat, precision)
+        rows = _query(lat, lon, block(lat, lon, precision), reach, k, name)
+        if len(rows) >= k:
+            return rows
+    return _query(lat, lon, None, None, k, name)
+
+
+##### Offline geocoding #####
+def _key(value):
+    return re.sub(r'[\W_]+', ' ', (value or '').lower()).strip()
+
+
+class Geocoder(object):
+    """Coordinates from a CSV file with a header row and the columns
+    state, city, address, latitude, longitude. Rows with an empty address
+    give the city's coordinates, used when a venue's address is unknown."""
+
+    def __init__(self, path):
+        self.places = {}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                key = (_key(row['state']), _key(row['city']),
+                       _key(row.get('address')))
+                self.places[key] = (float(row['latitude']),
+                                    float(row['longitude']))
+
+    def locate(self, address, city, state):
+        """``((latitude, longitude), 'address' or 'city')`` or
+        ``(None, None)``."""
+        state, city = _key(state), _key(city)
+        point = self.places.get((state, city, _key(address)))
+        if point is not None and address:
+            return point, 'address'
+        point = self.places.get((state, city, ''))
+        if point is not None:
+            return point, 'city'
+        return None, None
+
+
+@lru_cache(maxsize=4)
+def geocoder(path):
+    return Geocoder(path)
+
+
+def locate_venue(venue):
+    """Set the venue's coordinates from GEOCODE_FILE; they are cleared
+    when the file has no match. Without the file they are left alone, so
+    coordinates filled in by ``flask geo geocode`` survive edits."""
+    path = current_app.config.get('GEOCODE_FILE')
+    if not path:
+        return
+    point, _ = geocoder(path).locate(venue.address, venue.city, venue.state)
+    venue.latitude, venue.longitude = point or (None, None)
+    venue.geohash = encode(*point) if point else None
+
+
+@geo_cli.command('geocode')
+@click.argument('lookup', type=click.Path(exists=True, dir_okay=False))
+@click.option('--all', 'everything', is_flag=True,
+              help='Also venues that already have coordinates.')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--shard', default=None, help='Shard to geocode.')
+def geocode_command(lookup, everything, batch_size, shard):
+    """Fill in venue coordinates from a CSV lookup file."""
+    if shard:
+        current_app.extensions['shards'].use_shard(shard)
+    places = Geocoder(lookup)
+    counts = {'address': 0, 'city': 0, None: 0}
+    last_id = 0
+    while True:
+        venues = db.session.execute(text("""
+            SELECT id, address, city, state FROM venues
+            WHERE id > :last AND deleted_at IS NULL {}
+            ORDER BY id LIMIT :limit
+        """.format('' if everything else 'AND latitude IS NULL')),
+            {'last': last_id, 'limit': batch_size}).fetchall()
+        if not venues:
+            break
+        updates = []
+        for venue in venues:
+            point, match = places.locate(venue.address, venue.city, venue.state)
+            counts[match] += 1
+            if point is not None:
+                updates.append({'id': venue.id, 'latitude': point[0],
+                                'longitude': point[1],
+                                'geohash': encode(*point)})
+        if updates:
+            # Not an edit: version and updated_at stay as they are
+            db.session.execute(text("""
+                UPDATE venues
+                SET latitude = :latitude, longitude = :longitude,
+                    geohash = :geohash
+                WHERE id = :id
+            """), updates)
+        db.session.commit()
+        last_id = venues[-1].id
+    click.echo('{} by address, {} by city, {} not found'.format(
+        counts['address'], counts['city'], counts[None]))
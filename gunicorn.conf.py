@@ -0,0 +1,27 @@
+# gunicorn -c gunicorn.conf.py app:app
+#
+# The app is built once in the master and warmed there (warmup.preload)
+# before the workers are forked; each worker then opens its connections
+# and loads its caches (warmup.prime_worker) before it accepts requests.
+# FYYUR_PRELOAD=0 turns both off.
+import multiprocessing
+import os
+
+bind = os.environ.get('FYYUR_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('FYYUR_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+preload_app = os.environ.get('FYYUR_PRELOAD', '1') != '0'
+
+
+def when_ready(server):
+    # Runs in the master once the app is loaded, before any fork
+    if preload_app:
+        from app import app
+        import warmup
+        warmup.preload(app)
+
+
+def post_worker_init(worker):
+    # Runs in the worker after the fork, before its accept loop starts
+    if preload_app:
+        import warmup
+        warmup.prime_worker(worker.wsgi)
@@ -0,0 +1,344 @@
+##### Image proxy #####
+# Serves Artist/Venue image_link pictures from our own origin, resized to
+# the sizes the templates show them at. Each source URL is fetched once;
+# the original and every resized variant are stored in a content-addressed
+# disk cache (file names are SHA-256 hashes of the image bytes) that is
+# trimmed least-recently-used first when it grows past its size cap.
+#
+# image_link is user input, so sources are only fetched from public
+# addresses: every connection, redirects included, goes to an address the
+# host name was resolved to and checked against (no loopback, private,
+# link-local or other reserved ranges), and IMAGE_ALLOWED_HOSTS can
+# restrict the hosts further. With IMAGE_ALLOW_PRIVATE_HOSTS (development,
+# tests) the hosts of IMAGE_ALLOWED_HOSTS may also be private addresses,
+# such as a stand-in image server on 127.0.0.1. Concurrent misses for one URL, in any worker
+# of this host, wait for a single fetch.
+#
+# Layout of IMAGE_CACHE_DIR:
+#   urls/<sha256(url)>           -> text file with the content hash
+#   orig/<content hash>          -> original bytes
+#   sized/<content hash>-<size>  -> resized JPEG
+#   locks/<n>                    -> fetch locks, one per stripe of URLs
+import errno
+import fcntl
+import functools
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from urllib.parse import urlparse
+
+from PIL import Image
+
+# Bounding boxes (width, height) of the places images are shown at:
+# .tile img is capped at 200px high in a col-sm-4, the detail image at
+# 500px high in a col-sm-6 (see static/css/main.css)
+SIZES = {
+    'tile': (400, 200),
+    'detail': (600, 500),
+}
+
+JPEG_QUALITY = 85
+
+# Fetch locks are striped over this many files, so they never pile up
+LOCK_STRIPES = 64
+# A worker rescans the cache at least this often (seconds) while writing,
+# since its byte counter doesn't see what other workers write
+SCAN_INTERVAL = 60
+
+
+def link_version(link):
+    """Short hash of the source URL, used as ?v= so a changed image_link
+    gets a new proxy URL and old ones can be cached forever."""
+    return hashlib.sha256(link.encode()).hexdigest()[:12]
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+##### Fetching from public addresses only #####
+def _public(address):
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def _public_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                       source_address=None, private_ok=None):
+    """socket.create_connection() that refuses hosts resolving to a
+    non-public address (unless ``private_ok(host)``), and connects to the
+    address it checked (so a second DNS answer can't point elsewhere)."""
+    host, port = address
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    if not infos:
+        raise ValueError('image host {} has no address'.format(host))
+    if not (private_ok and private_ok(host)) and \
+            not all(_public(info[4][0]) for info in infos):
+        raise ValueError('image host {} is not a public address'.format(host))
+    error = None
+    for family, kind, proto, _, sockaddr in infos:
+        sock = socket.socket(family, kind, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error
+
+
+class _HTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, *args, private_ok=None, **kwargs):
+        super(_HTTPConnection, self).__init__(*args, **kwargs)
+        self._create_connection = functools.partial(_public_connection,
+                                                    private_ok=private_ok)
+
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+
+    def __init__(self, *args, private_ok=None, **kwargs):
+        super(_HTTPSConnection, self).__init__(*args, **kwargs)
+        self._create_connection = functools.partial(_public_connection,
+                                                    private_ok=private_ok)
+
+
+class _HTTPHandler(urllib.request.HTTPHandler):
+
+    def __init__(self, private_ok):
+        super(_HTTPHandler, self).__init__()
+        self.private_ok = private_ok
+
+    def http_open(self, req):
+        return self.do_open(_HTTPConnection, req, private_ok=self.private_ok)
+
+
+class _HTTPSHandler(urllib.request.HTTPSHandler):
+
+    def __init__(self, private_ok):
+        super(_HTTPSHandler, self).__init__()
+        self.private_ok = private_ok
+
+    def https_open(self, req):
+        return self.do_open(_HTTPSConnection, req, context=self._context,
+                            private_ok=self.private_ok)
+
+
+class _RedirectHandler(urllib.request.HTTPRedirectHandler):
+    max_redirections = 3
+
+    def __init__(self, check):
+        self.check = check
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        self.check(newurl)
+        return super(_RedirectHandler, self).redirect_request(
+            req, fp, code, msg, headers, newurl)
+
+
+class ImageCache(object):
+
+    def __init__(self, app=None):
+        self.root = None
+        self.max_bytes = None
+        self.timeout = None
+        self.max_source_bytes = None
+        self.allowed_hosts = None
+        self.allow_private = False
+        self.opener = None
+        self._bytes = None
+        self._scanned = 0
+        self._trim_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config.get('IMAGE_CACHE_DIR', 'image_cache')
+        self.max_bytes = app.config.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+        self.timeout = app.config.get('IMAGE_FETCH_TIMEOUT', 5)
+        self.max_source_bytes = app.config.get('IMAGE_MAX_SOURCE_BYTES',
+                                               10 * 1024 * 1024)
+        hosts = app.config.get('IMAGE_ALLOWED_HOSTS')
+        self.allowed_hosts = [host.lower() for host in hosts] if hosts else None
+        # Only ever for allowlisted hosts, never for any host
+        self.allow_private = bool(app.config.get('IMAGE_ALLOW_PRIVATE_HOSTS')
+                                  and self.allowed_hosts)
+        # No proxies from the environment: connections go where we checked
+        self.opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({}), _HTTPHandler(self.private_ok),
+            _HTTPSHandler(self.private_ok), _RedirectHandler(self.check_url))
+        for sub in ('urls', 'orig', 'sized', 'locks'):
+            os.makedirs(os.path.join(self.root, sub), exist_ok=True)
+        app.extensions['image_cache'] = self
+
+    def _path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def _write(self, path, data):
+        # Write to a temp file and rename, so readers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self._grew(len(data))
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _allowed(self, host):
+        host = host.lower()
+        return any(host == allowed or
+                   (allowed.startswith('.') and host.endswith(allowed))
+                   for allowed in self.allowed_hosts)
+
+    def private_ok(self, host):
+        """Whether ``host`` may resolve to a non-public address."""
+        return self.allow_private and self._allowed(host)
+
+    def check_url(self, url):
+        """Raise ValueError unless ``url`` may be fetched. The address is
+        checked when connecting."""
+        parts = urlparse(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('unsupported image URL')
+        if self.allowed_hosts is not None and not self._allowed(parts.hostname):
+            raise ValueError('image host {} is not allowed'.format(parts.hostname))
+
+    def fetch(self, url):
+        self.check_url(url)
+        request = urllib.request.Request(url, headers={'User-Agent': 'fyyur'})
+        with self.opener.open(request, timeout=self.timeout) as response:
+            data = response.read(self.max_source_bytes + 1)
+        if len(data) > self.max_source_bytes:
+            raise ValueError('image too large')
+        return data
+
+    def _url_file(self, url):
+        return self._path('urls', _sha256(url.encode()))
+
+    def _lookup(self, url):
+        try:
+            with open(self._url_file(url)) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _cached(self, url):
+        digest = self._lookup(url)
+        if digest and os.path.exists(self._path('orig', digest)):
+            return digest
+        return None
+
+    def _fetch_lock(self, url):
+        # flock locks exclude other processes and other threads alike
+        stripe = int(_sha256(url.encode())[:8], 16) % LOCK_STRIPES
+        fd = os.open(self._path('locks', str(stripe)), os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = time.monotonic() + 2 * self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+            if time.monotonic() > deadline:
+                os.close(fd)
+                raise ValueError('timed out waiting for another fetch')
+            time.sleep(0.05)
+
+    def _original(self, url):
+        """Content hash of the source image, fetching it on a cache miss."""
+        digest = self._cached(url)
+        if digest:
+            return digest
+        fd = self._fetch_lock(url)
+        try:
+            # Whoever held the lock may have just fetched it
+            digest = self._cached(url)
+            if digest:
+                return digest
+            data = self.fetch(url)
+            digest = _sha256(data)
+            self._write(self._path('orig', digest), data)
+            self._write(self._url_file(url), digest.encode())
+        finally:
+            os.close(fd)
+        return digest
+
+    def resized(self, url, size):
+        """Path of ``url`` resized to ``size``, creating it if needed."""
+        digest = self._lookup(url)
+        if digest:
+            path = self._path('sized', '{}-{}'.format(digest, size))
+            if os.path.exists(path):
+                self._touch(path)
+                self._touch(self._url_file(url))
+                return path
+        digest = self._original(url)
+        path = self._path('sized', '{}-{}'.format(digest, size))
+        original = self._path('orig', digest)
+        self._touch(original)
+        image = Image.open(original)
+        image = image.convert('RGB')
+        image.thumbnail(SIZES[size], Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        self._write(path, buffer.getvalue())
+        return path
+
+    def _grew(self, size):
+        # Scanning is only worth it once the cap may have been crossed
+        if self._bytes is not None:
+            self._bytes += size
+            if self._bytes <= self.max_bytes and \
+                    time.monotonic() - self._scanned < SCAN_INTERVAL:
+                return
+        self.trim()
+
+    def trim(self):
+        """Delete least recently used files until the cache fits its cap."""
+        if not self._trim_lock.acquire(blocking=False):
+            return
+        try:
+            entries = []
+            total = 0
+            for sub in ('urls', 'orig', 'sized'):
+                for entry in os.scandir(self._path(sub)):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # removed by another worker
+                    # Disk usage, so the many tiny urls/ files count too
+                    size = stat.st_blocks * 512
+                    entries.append((stat.st_mtime, size, entry.path))
+                    total += size
+            if total > self.max_bytes:
+                # Down to 90%, leaving room before the next scan
+                for _, size, path in sorted(entries):
+                    if total <= self.max_bytes * 0.9:
+                        break
+                    try:
+                        os.remove(path)
+                        total -= size
+                    except OSError:
+                        pass
+            self._bytes = total
+            self._scanned = time.monotonic()
+        finally:
+            self._trim_lock.release()
@@ -0,0 +1,221 @@
+##### DDL helpers for revisions #####
+# Shared by the revisions under versions/ and by online_migrations.py (the
+# "flask online-migrations" backfills). Applied revisions import these, so
+# what a helper does must not change: fix bugs, but add new behaviour as a
+# new function or a keyword argument whose default keeps the old one.
+# Imports nothing from the app, so revisions keep working as models change.
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+LOCK_TIMEOUT_MS = 2000
+ATTEMPTS = 10
+# SQLSTATE lock_not_available, raised when lock_timeout expires
+LOCK_NOT_AVAILABLE = '55P03'
+BATCH_SIZE = 1000
+PAUSE = 0.1
+
+
+def _statement(statement):
+    return text(statement) if isinstance(statement, str) else statement
+
+
+def lock_timed_out(error):
+    return getattr(error.orig, 'pgcode', None) == LOCK_NOT_AVAILABLE
+
+
+@contextmanager
+def atomic(conn):
+    # A savepoint inside a migration's transaction, otherwise (autocommit
+    # connections, see autocommit_block) a transaction of our own
+    if conn.in_transaction():
+        with conn.begin_nested():
+            yield
+        return
+    conn.execute(text('BEGIN'))
+    try:
+        yield
+    except Exception:
+        conn.execute(text('ROLLBACK'))
+        raise
+    conn.execute(text('COMMIT'))
+
+
+def locked_ddl(conn, *statements, lock_timeout_ms=LOCK_TIMEOUT_MS,
+               attempts=ATTEMPTS, pause=1.0):
+    """Run ``statements`` atomically, waiting at most ``lock_timeout_ms``
+    for locks; on a lock timeout the whole group is retried."""
+    for attempt in range(1, attempts + 1):
+        try:
+            with atomic(conn):
+                conn.execute(text("SELECT set_config('lock_timeout', :timeout, true)"),
+                             timeout='{}ms'.format(lock_timeout_ms))
+                for statement in statements:
+                    conn.execute(_statement(statement))
+            return
+        except OperationalError as e:
+            if not lock_timed_out(e) or attempt == attempts:
+                raise
+            time.sleep(pause * attempt)
+
+
+def create_sync_trigger(conn, table, column, expression, source):
+    """Keep ``column`` equal to ``expression`` (SQL over ``NEW.``) for rows
+    written through ``source`` while old code still writes only ``source``."""
+    name = '{}_{}_sync'.format(table, column)
+    locked_ddl(
+        conn,
+        """
+        CREATE OR REPLACE FUNCTION {name}() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.{column} := {expression};
+            RETURN NEW;
+        END
+        $$
+        """.format(name=name, column=column, expression=expression),
+        'CREATE TRIGGER {name} BEFORE INSERT OR UPDATE OF {source} ON {table} '
+        'FOR EACH ROW EXECUTE PROCEDURE {name}()'.format(
+            name=name, source=source, table=table))
+
+
+def drop_sync_trigger_statements(table, column):
+    """Statements dropping the trigger, to be run with the column swap."""
+    name = '{}_{}_sync'.format(table, column)
+    return ('DROP TRIGGER IF EXISTS {} ON {}'.format(name, table),
+            'DROP FUNCTION IF EXISTS {}()'.format(name))
+
+
+def create_index_concurrently(conn, name, definition, attempts=3):
+    """CREATE INDEX CONCURRENTLY ``name`` ON ``definition``, on an
+    autocommit connection. A failed build leaves an invalid index behind,
+    which is dropped before trying again."""
+    for attempt in range(1, attempts + 1):
+        try:
+            conn.execute(text('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {}'
+                              .format(name, definition)))
+        except OperationalError:
+            if attempt == attempts:
+                raise
+        valid = conn.execute(text("""
+            SELECT i.indisvalid FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name
+        """), name=name).scalar()
+        if valid:
+            return
+        conn.execute(text('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name)))
+    raise RuntimeError('could not build index {}'.format(name))
+
+
+def existing_partitions(conn, table='shows'):
+    """Names of the partitions currently attached to ``table``."""
+    rows = conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table
+    """), table=table)
+    return {name for name, in rows}
+
+
+##### Backfills #####
+# Progress is saved in the online_migrations table under ``name``, so a
+# backfill started by a revision and one started by "flask
+# online-migrations backfill" resume each other.
+def _progress(conn, name):
+    conn.execute(text("""
+        INSERT INTO online_migrations (name) VALUES (:name)
+        ON CONFLICT (name) DO NOTHING
+    """), name=name)
+    return conn.execute(text(
+        'SELECT last_id, rows, done FROM online_migrations WHERE name = :name'),
+        name=name).first()
+
+
+def run_backfill(conn, name, table, column, expression, pending, key='id',
+                 batch_size=BATCH_SIZE, pause=PAUSE,
+                 lock_timeout_ms=LOCK_TIMEOUT_MS, echo=print):
+    """Set ``column`` to ``expression`` in the rows of ``table`` matching
+    ``pending``, in ``key`` ranges, resuming from saved progress.
+
+    ``conn`` must be in autocommit mode (``autocommit_block()`` inside a
+    migration): each batch is one statement that updates the rows and the
+    progress row together, and commits on its own.
+    """
+    last_id, rows, done = _progress(conn, name)
+    if done:
+        echo('{}: already done ({} rows)'.format(name, rows))
+        return
+    # Rows inserted after this are filled by the sync trigger
+    high = conn.execute(text('SELECT max({}) FROM {}'.format(key, table))).scalar() or 0
+    batch = text("""
+        WITH batch AS (
+            UPDATE {table} SET {column} = {expression}
+            WHERE {key} > :low AND {key} <= :high AND ({pending})
+            RETURNING 1
+        )
+        UPDATE online_migrations
+        SET last_id = :high, rows = rows + (SELECT count(*) FROM batch),
+            done = :done, updated_at = timezone('utc', now())
+        WHERE name = :name
+        RETURNING (SELECT count(*) FROM batch)
+    """.format(table=table, column=column, key=key, expression=expression,
+               pending=pending))
+
+    conn.execute(text("SELECT set_config('lock_timeout', :timeout, false)"),
+                 timeout='{}ms'.format(lock_timeout_ms))
+    started = time.time()
+    start_id = last_id
+    try:
+        while True:
+            upto = min(last_id + batch_size, high)
+            try:
+                count = conn.execute(batch, low=last_id, high=upto, name=name,
+                                     done=upto >= high).scalar()
+            except OperationalError as e:
+                if not lock_timed_out(e):
+                    raise
+                echo('{}: lock timeout at id {}, retrying'.format(name, last_id))
+                time.sleep(pause * 10 or 1)
+                continue
+            rows += count
+            last_id = upto
+            elapsed = max(time.time() - started, 1e-6)
+            echo('{}: id {}/{} ({:.1f}%), {} rows updated, {:.0f} ids/s'.format(
+                name, last_id, high, 100.0 * last_id / high if high else 100.0,
+                rows, (last_id - start_id) / elapsed))
+            if last_id >= high:
+                break
+            if pause:
+                time.sleep(pause)
+    finally:
+        conn.execute(text('RESET lock_timeout'))
+
+
+def require_backfilled(conn, name, table, pending):
+    """Raise unless backfill ``name`` ran to completion and no row of
+    ``table`` matches ``pending``."""
+    done = conn.execute(text(
+        'SELECT done FROM online_migrations WHERE name = :name'),
+        name=name).scalar()
+    left = conn.execute(text('SELECT EXISTS (SELECT 1 FROM {} WHERE {})'.format(
+        table, pending))).scalar()
+    if not done or left:
+        raise RuntimeError(
+            'backfill {} is not complete; run '
+            '"flask online-migrations backfill {}" first'.format(name, name))
+
+
+##### Expressions #####
+# artists.genres was a string holding the array literal Postgres made of the
+# submitted list ('{Jazz,Pop}'), or a plain comma-separated list
+def artist_genres_array(row):
+    """``artists.genres`` as varchar[]; ``row`` prefixes the column."""
+    return """CASE
+        WHEN {g} LIKE '{{%' THEN CAST({g} AS varchar[])
+        WHEN btrim({g}) = '' THEN CAST('{{}}' AS varchar[])
+        ELSE CAST(regexp_split_to_array(btrim({g}), '\\s*,\\s*') AS varchar[])
+    END""".format(g=row + 'genres')
@@ -22,9 +22,13 @@ logger = logging.getLogger('alembic.env')
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
-config.set_main_option(
-    'sqlalchemy.url',
-    str(current_app.extensions['migrate'].db.engine.url).replace('%', '%%'))
+# "flask db upgrade -x shard=<name>" migrates one of the SHARDS instead
+shard = context.get_x_argument(as_dictionary=True).get('shard')
+if shard:
+    url = current_app.config['SHARDS'][shard]
+else:
+    url = str(current_app.extensions['migrate'].db.engine.url)
+config.set_main_option('sqlalchemy.url', url.replace('%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
 # other values from the config, defined by the needs of env.py,
@@ -0,0 +1,38 @@
+"""rename the shows_archive table to archived_shows, apart from the
+shows_archive schema detached partitions are moved to
+
+Revision ID: 1b6f0d9c3a25
+Revises: f8c1a5e3b270
+Create Date: 2026-10-20 09:12:37.514820
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1b6f0d9c3a25'
+down_revision = 'f8c1a5e3b270'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Catalog-only renames
+    op.rename_table('shows_archive', 'archived_shows')
+    op.execute('ALTER TABLE archived_shows RENAME CONSTRAINT shows_archive_pkey '
+               'TO archived_shows_pkey')
+    op.execute('ALTER INDEX ix_shows_archive_artist_id '
+               'RENAME TO ix_archived_shows_artist_id')
+    op.execute('ALTER INDEX ix_shows_archive_venue_id '
+               'RENAME TO ix_archived_shows_venue_id')
+
+
+def downgrade():
+    op.execute('ALTER INDEX ix_archived_shows_venue_id '
+               'RENAME TO ix_shows_archive_venue_id')
+    op.execute('ALTER INDEX ix_archived_shows_artist_id '
+               'RENAME TO ix_shows_archive_artist_id')
+    op.execute('ALTER TABLE archived_shows RENAME CONSTRAINT archived_shows_pkey '
+               'TO shows_archive_pkey')
+    op.rename_table('archived_shows', 'shows_archive')
@@ -0,0 +1,34 @@
+"""artists.genres as an array, step 2 (backfill)
+
+Fills genres_array in batches outside the migration transaction. It can
+also be run ahead of the deploy with
+"flask online-migrations backfill artists_genres"; either way an
+interrupted run resumes from the saved progress.
+
+Revision ID: 2f8d5b0c9e17
+Revises: 7c2e9a41d6b3
+Create Date: 2026-10-19 18:03:12.084531
+
+"""
+from alembic import op
+
+from migrations.ddl import artist_genres_array, run_backfill
+
+
+# revision identifiers, used by Alembic.
+revision = '2f8d5b0c9e17'
+down_revision = '7c2e9a41d6b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        # Same progress row as "flask online-migrations backfill
+        # artists_genres", so either one resumes what the other started
+        run_backfill(op.get_bind(), 'artists_genres', 'artists', 'genres_array',
+                     artist_genres_array(''), 'genres_array IS NULL')
+
+
+def downgrade():
+    op.execute("DELETE FROM online_migrations WHERE name = 'artists_genres'")
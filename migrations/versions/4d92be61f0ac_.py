@@ -0,0 +1,38 @@
+"""add modification timestamps for feed validators
+
+Revision ID: 4d92be61f0ac
+Revises: e81b47c0a5d3
+Create Date: 2026-10-19 14:02:51.730114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d92be61f0ac'
+down_revision = 'e81b47c0a5d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    utc_now = sa.text("timezone('utc', now())")
+    op.add_column('artists', sa.Column('updated_at', sa.DateTime(),
+                  nullable=False, server_default=utc_now))
+    op.add_column('venues', sa.Column('updated_at', sa.DateTime(),
+                  nullable=False, server_default=utc_now))
+    op.add_column('shows', sa.Column('created_at', sa.DateTime(),
+                  nullable=False, server_default=utc_now))
+    op.create_index(op.f('ix_artists_updated_at'), 'artists', ['updated_at'])
+    op.create_index(op.f('ix_venues_updated_at'), 'venues', ['updated_at'])
+    op.create_index(op.f('ix_shows_created_at'), 'shows', ['created_at'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_shows_created_at'), table_name='shows')
+    op.drop_index(op.f('ix_venues_updated_at'), table_name='venues')
+    op.drop_index(op.f('ix_artists_updated_at'), table_name='artists')
+    op.drop_column('shows', 'created_at')
+    op.drop_column('venues', 'updated_at')
+    op.drop_column('artists', 'updated_at')
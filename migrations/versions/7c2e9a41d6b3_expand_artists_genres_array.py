@@ -0,0 +1,47 @@
+"""artists.genres as an array, step 1 (expand): genres_array column kept in
+sync by a trigger, online_migrations progress table
+
+Revision ID: 7c2e9a41d6b3
+Revises: f5a3c8e19d40
+Create Date: 2026-10-19 18:02:41.610275
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.ddl import (artist_genres_array, create_sync_trigger,
+                            drop_sync_trigger_statements, locked_ddl)
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2e9a41d6b3'
+down_revision = 'f5a3c8e19d40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    utc_now = sa.text("timezone('utc', now())")
+    op.create_table('online_migrations',
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('last_id', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('rows', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('done', sa.Boolean(), server_default=sa.false(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=utc_now, nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+    conn = op.get_bind()
+    # Nullable and without a default: a catalog-only change
+    locked_ddl(conn, 'ALTER TABLE artists ADD COLUMN genres_array varchar[]')
+    # Fills genres_array on every write through genres
+    create_sync_trigger(conn, 'artists', 'genres_array',
+                        artist_genres_array('NEW.'), 'genres')
+
+
+def downgrade():
+    conn = op.get_bind()
+    locked_ddl(conn,
+               *drop_sync_trigger_statements('artists', 'genres_array'),
+               'ALTER TABLE artists DROP COLUMN genres_array')
+    op.drop_table('online_migrations')
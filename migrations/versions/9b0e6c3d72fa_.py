@@ -0,0 +1,31 @@
+"""add stats rollup table
+
+Revision ID: 9b0e6c3d72fa
+Revises: 4d92be61f0ac
+Create Date: 2026-10-19 15:26:13.084467
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b0e6c3d72fa'
+down_revision = '4d92be61f0ac'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stats',
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('state', sa.String(length=120), nullable=False),
+    sa.Column('genre', sa.String(length=120), nullable=False),
+    sa.Column('shows', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('month', 'state', 'genre')
+    )
+    # Fill with `flask stats backfill` after upgrading
+
+
+def downgrade():
+    op.drop_table('stats')
@@ -0,0 +1,28 @@
+"""venue_shards directory for region sharding
+
+Revision ID: a9e4c7b21f08
+Revises: d06a3e7f4b52
+Create Date: 2026-10-19 19:12:05.338120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9e4c7b21f08'
+down_revision = 'd06a3e7f4b52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('venue_shards',
+    sa.Column('venue_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('shard', sa.String(length=50), nullable=False),
+    sa.PrimaryKeyConstraint('venue_id')
+    )
+
+
+def downgrade():
+    op.drop_table('venue_shards')
@@ -0,0 +1,68 @@
+"""name_key on venues and artists with trigram indexes for duplicate
+detection
+
+Revision ID: b3f7d1c05e62
+Revises: a9e4c7b21f08
+Create Date: 2026-10-19 20:21:47.902316
+
+"""
+from alembic import op
+
+from migrations.ddl import (create_index_concurrently, create_sync_trigger,
+                            drop_sync_trigger_statements, locked_ddl,
+                            run_backfill)
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f7d1c05e62'
+down_revision = 'a9e4c7b21f08'
+branch_labels = None
+depends_on = None
+
+TABLES = ('venues', 'artists')
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # Lets the GIN index also hold the plain state/city columns
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+    # "The Musical Hop", "Musical Hop, The" and "musical-hop" -> "musical hop"
+    op.execute(r"""
+        CREATE OR REPLACE FUNCTION normalize_name(name text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT btrim(regexp_replace(regexp_replace(regexp_replace(
+                replace(lower(name), '&', ' and '),
+                '(\W|_)+', ' ', 'g'),
+                '\m(the|a|an)\M', ' ', 'g'),
+                ' +', ' ', 'g'))
+        $$
+    """)
+
+    conn = op.get_bind()
+    for table in TABLES:
+        locked_ddl(conn, 'ALTER TABLE {} ADD COLUMN name_key varchar'.format(table))
+        # Kept for good: the trigger is what maintains name_key
+        create_sync_trigger(conn, table, 'name_key', 'normalize_name(NEW.name)',
+                            'name')
+
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            # The progress row "flask online-migrations backfill" also uses
+            run_backfill(conn, '{}_name_key'.format(table), table, 'name_key',
+                         'normalize_name(name)',
+                         'name_key IS NULL AND name IS NOT NULL')
+            create_index_concurrently(
+                conn, 'ix_{}_name_key_trgm'.format(table),
+                '{} USING gin (state, lower(city), name_key gin_trgm_ops) '
+                'WHERE deleted_at IS NULL'.format(table))
+
+
+def downgrade():
+    conn = op.get_bind()
+    for table in TABLES:
+        op.drop_index('ix_{}_name_key_trgm'.format(table), table_name=table)
+        locked_ddl(conn, *drop_sync_trigger_statements(table, 'name_key'),
+                   'ALTER TABLE {} DROP COLUMN name_key'.format(table))
+        op.execute("DELETE FROM online_migrations WHERE name = '{}_name_key'"
+                   .format(table))
+    op.execute('DROP FUNCTION IF EXISTS normalize_name(text)')
@@ -0,0 +1,28 @@
+"""add version columns for optimistic locking
+
+Revision ID: c3f1a9d2e4b7
+Revises: 53b6718fde15
+Create Date: 2026-10-19 09:12:04.118230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f1a9d2e4b7'
+down_revision = '53b6718fde15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('artists', sa.Column('version', sa.Integer(),
+                  nullable=False, server_default='1'))
+    op.add_column('venues', sa.Column('version', sa.Integer(),
+                  nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('venues', 'version')
+    op.drop_column('artists', 'version')
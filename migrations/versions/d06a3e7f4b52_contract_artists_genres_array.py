@@ -0,0 +1,59 @@
+"""artists.genres as an array, step 3 (contract): genres_array replaces
+genres
+
+Revision ID: d06a3e7f4b52
+Revises: 2f8d5b0c9e17
+Create Date: 2026-10-19 18:03:40.927163
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.ddl import (artist_genres_array, create_sync_trigger,
+                            drop_sync_trigger_statements, locked_ddl,
+                            require_backfilled)
+
+
+# revision identifiers, used by Alembic.
+revision = 'd06a3e7f4b52'
+down_revision = '2f8d5b0c9e17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Each step commits on its own so no lock outlives its statement
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        require_backfilled(conn, 'artists_genres', 'artists',
+                           'genres_array IS NULL')
+
+        # SET NOT NULL would scan the table under an exclusive lock; a
+        # validated CHECK constraint lets Postgres (12+) skip that scan, and
+        # VALIDATE only takes a lock that doesn't block reads or writes.
+        locked_ddl(conn,
+                   'ALTER TABLE artists ADD CONSTRAINT artists_genres_array_not_null '
+                   'CHECK (genres_array IS NOT NULL) NOT VALID')
+        conn.execute(sa.text(
+            'ALTER TABLE artists VALIDATE CONSTRAINT artists_genres_array_not_null'))
+
+        locked_ddl(conn,
+                   *drop_sync_trigger_statements('artists', 'genres_array'),
+                   'ALTER TABLE artists ALTER COLUMN genres_array SET NOT NULL',
+                   'ALTER TABLE artists DROP CONSTRAINT artists_genres_array_not_null',
+                   'ALTER TABLE artists DROP COLUMN genres',
+                   'ALTER TABLE artists RENAME COLUMN genres_array TO genres')
+
+
+def downgrade():
+    # Back to the state after the backfill; the UPDATE rewrites the table
+    conn = op.get_bind()
+    locked_ddl(conn,
+               'ALTER TABLE artists RENAME COLUMN genres TO genres_array',
+               'ALTER TABLE artists ALTER COLUMN genres_array DROP NOT NULL',
+               'ALTER TABLE artists ADD COLUMN genres varchar(120)')
+    op.execute('UPDATE artists SET genres = CAST(genres_array AS text)')
+    op.alter_column('artists', 'genres', existing_type=sa.VARCHAR(length=120),
+                    nullable=False)
+    create_sync_trigger(conn, 'artists', 'genres_array',
+                        artist_genres_array('NEW.'), 'genres')
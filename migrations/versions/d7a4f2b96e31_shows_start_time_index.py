@@ -0,0 +1,43 @@
+"""covering index on shows.start_time for upcoming-show ranges
+
+Revision ID: d7a4f2b96e31
+Revises: c5d2e8f1a7b4
+Create Date: 2026-10-19 21:36:12.418305
+
+"""
+from alembic import op
+
+from migrations.ddl import (create_index_concurrently, existing_partitions,
+                            locked_ddl)
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a4f2b96e31'
+down_revision = 'c5d2e8f1a7b4'
+branch_labels = None
+depends_on = None
+
+COLUMNS = '(start_time, venue_id, artist_id, id)'
+
+
+def upgrade():
+    # CONCURRENTLY can't build an index on a partitioned table: the parent
+    # index is created empty (ON ONLY), each partition's index is built
+    # concurrently and attached, and the parent index becomes valid once
+    # every partition has one. Partitions created later get it from the
+    # parent.
+    conn = op.get_bind()
+    locked_ddl(conn, 'CREATE INDEX IF NOT EXISTS ix_shows_start_time '
+                     'ON ONLY shows {}'.format(COLUMNS))
+    with op.get_context().autocommit_block():
+        for partition in sorted(existing_partitions(conn)):
+            name = 'ix_{}_start_time'.format(partition)
+            create_index_concurrently(conn, name,
+                                      '{} {}'.format(partition, COLUMNS))
+            locked_ddl(conn, 'ALTER INDEX ix_shows_start_time '
+                             'ATTACH PARTITION {}'.format(name))
+
+
+def downgrade():
+    # Drops the partitions' indexes with it
+    op.drop_index('ix_shows_start_time', table_name='shows')
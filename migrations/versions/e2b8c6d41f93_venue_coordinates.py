@@ -0,0 +1,37 @@
+"""venue coordinates with a geohash index
+
+Revision ID: e2b8c6d41f93
+Revises: d7a4f2b96e31
+Create Date: 2026-10-19 22:14:05.630817
+
+"""
+from alembic import op
+
+from migrations.ddl import create_index_concurrently, locked_ddl
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b8c6d41f93'
+down_revision = 'd7a4f2b96e31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Nullable without defaults: only the catalog changes. The columns are
+    # filled in by "flask geo geocode".
+    conn = op.get_bind()
+    locked_ddl(conn,
+               'ALTER TABLE venues ADD COLUMN latitude double precision',
+               'ALTER TABLE venues ADD COLUMN longitude double precision',
+               'ALTER TABLE venues ADD COLUMN geohash varchar(12) COLLATE "C"')
+    with op.get_context().autocommit_block():
+        create_index_concurrently(conn, 'ix_venues_geohash',
+                                  'venues (geohash) WHERE deleted_at IS NULL')
+
+
+def downgrade():
+    op.drop_index('ix_venues_geohash', table_name='venues')
+    op.drop_column('venues', 'geohash')
+    op.drop_column('venues', 'longitude')
+    op.drop_column('venues', 'latitude')
@@ -0,0 +1,100 @@
+"""partition shows by start_time
+
+Revision ID: e81b47c0a5d3
+Revises: c3f1a9d2e4b7
+Create Date: 2026-10-19 11:40:27.502913
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e81b47c0a5d3'
+down_revision = 'c3f1a9d2e4b7'
+branch_labels = None
+depends_on = None
+
+# Partitions created up front, counted from the current month
+MONTHS_AHEAD = 12
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return datetime(value.year + month // 12, month % 12 + 1, 1)
+
+
+def create_partition(conn, start):
+    # shows_default is still empty here, so the range can be created in place
+    conn.execute(sa.text(
+        'CREATE TABLE shows_y{:04d}m{:02d} PARTITION OF shows '
+        'FOR VALUES FROM (:start) TO (:end)'.format(start.year, start.month)),
+        start=start, end=add_months(start, 1))
+
+
+def upgrade():
+    conn = op.get_bind()
+    op.rename_table('shows', 'shows_unpartitioned')
+    op.execute('ALTER SEQUENCE shows_id_seq OWNED BY NONE')
+    op.execute('ALTER TABLE shows_unpartitioned DROP CONSTRAINT shows_pkey')
+
+    # The partition key has to be part of the primary key
+    op.execute("""
+        CREATE TABLE shows (
+            id integer NOT NULL DEFAULT nextval('shows_id_seq'),
+            artist_id integer NOT NULL REFERENCES artists (id),
+            venue_id integer NOT NULL REFERENCES venues (id),
+            start_time timestamp without time zone NOT NULL,
+            CONSTRAINT shows_pkey PRIMARY KEY (id, start_time)
+        ) PARTITION BY RANGE (start_time)
+    """)
+    op.execute('CREATE TABLE shows_default PARTITION OF shows DEFAULT')
+    op.execute('ALTER SEQUENCE shows_id_seq OWNED BY shows.id')
+
+    first = conn.execute(
+        sa.text('SELECT min(start_time) FROM shows_unpartitioned')).scalar()
+    month = month_start(first or datetime.now())
+    end = add_months(month_start(datetime.now()), MONTHS_AHEAD)
+    while month <= end:
+        create_partition(conn, month)
+        month = add_months(month, 1)
+
+    op.execute("""
+        INSERT INTO shows (id, artist_id, venue_id, start_time)
+        SELECT id, artist_id, venue_id, start_time FROM shows_unpartitioned
+    """)
+    op.drop_table('shows_unpartitioned')
+    op.create_index('ix_shows_venue_id_start_time', 'shows',
+                    ['venue_id', 'start_time'])
+    op.create_index('ix_shows_artist_id_start_time', 'shows',
+                    ['artist_id', 'start_time'])
+
+
+def downgrade():
+    op.rename_table('shows', 'shows_partitioned')
+    # Free the name, or the new key becomes shows_pkey1 and upgrade can't
+    # drop shows_pkey again
+    op.execute('ALTER TABLE shows_partitioned '
+               'RENAME CONSTRAINT shows_pkey TO shows_partitioned_pkey')
+    op.execute('ALTER SEQUENCE shows_id_seq OWNED BY NONE')
+    op.execute("""
+        CREATE TABLE shows (
+            id integer NOT NULL DEFAULT nextval('shows_id_seq'),
+            artist_id integer NOT NULL REFERENCES artists (id),
+            venue_id integer NOT NULL REFERENCES venues (id),
+            start_time timestamp without time zone NOT NULL,
+            CONSTRAINT shows_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute("""
+        INSERT INTO shows (id, artist_id, venue_id, start_time)
+        SELECT id, artist_id, venue_id, start_time FROM shows_partitioned
+    """)
+    op.execute('ALTER SEQUENCE shows_id_seq OWNED BY shows.id')
+    op.execute('DROP TABLE shows_partitioned CASCADE')
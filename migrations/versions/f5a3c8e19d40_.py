@@ -0,0 +1,64 @@
+"""soft delete for venues and artists, shows archive and purge jobs
+
+Revision ID: f5a3c8e19d40
+Revises: 9b0e6c3d72fa
+Create Date: 2026-10-19 16:48:55.291730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5a3c8e19d40'
+down_revision = '9b0e6c3d72fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    utc_now = sa.text("timezone('utc', now())")
+    op.add_column('venues', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.add_column('artists', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_venues_active', 'venues', ['state', 'city', 'name'],
+                    postgresql_where=sa.text('deleted_at IS NULL'))
+    op.create_index('ix_artists_active', 'artists', ['name'],
+                    postgresql_where=sa.text('deleted_at IS NULL'))
+
+    op.create_table('shows_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.Column('venue_id', sa.Integer(), nullable=False),
+    sa.Column('start_time', sa.DateTime(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), server_default=utc_now, nullable=False),
+    sa.PrimaryKeyConstraint('id', 'start_time')
+    )
+    op.create_index(op.f('ix_shows_archive_artist_id'), 'shows_archive', ['artist_id'])
+    op.create_index(op.f('ix_shows_archive_venue_id'), 'shows_archive', ['venue_id'])
+
+    op.create_table('purge_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('entity', sa.String(length=20), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('moved', sa.Integer(), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), server_default=utc_now, nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=utc_now, nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_purge_jobs_status'), 'purge_jobs', ['status'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_purge_jobs_status'), table_name='purge_jobs')
+    op.drop_table('purge_jobs')
+    op.drop_index(op.f('ix_shows_archive_venue_id'), table_name='shows_archive')
+    op.drop_index(op.f('ix_shows_archive_artist_id'), table_name='shows_archive')
+    op.drop_table('shows_archive')
+    op.drop_index('ix_artists_active', table_name='artists')
+    op.drop_index('ix_venues_active', table_name='venues')
+    op.drop_column('artists', 'deleted_at')
+    op.drop_column('venues', 'deleted_at')
@@ -0,0 +1,52 @@
+"""append-only audit log
+
+Revision ID: f8c1a5e3b270
+Revises: e2b8c6d41f93
+Create Date: 2026-10-19 22:48:51.207436
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8c1a5e3b270'
+down_revision = 'e2b8c6d41f93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('audit_log',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('entity', sa.String(length=20), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('action', sa.String(length=10), nullable=False),
+    sa.Column('changes', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('actor', sa.String(length=120), nullable=True),
+    sa.Column('endpoint', sa.String(length=120), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_audit_log_entity', 'audit_log',
+                    ['entity', 'entity_id', 'id'])
+    # Entries are never changed once written
+    op.execute("""
+        CREATE FUNCTION audit_log_append_only() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            RAISE EXCEPTION 'audit_log is append-only';
+        END
+        $$
+    """)
+    op.execute('CREATE TRIGGER audit_log_append_only '
+               'BEFORE UPDATE OR DELETE ON audit_log '
+               'FOR EACH STATEMENT EXECUTE PROCEDURE audit_log_append_only()')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER audit_log_append_only ON audit_log')
+    op.execute('DROP FUNCTION audit_log_append_only()')
+    op.drop_index('ix_audit_log_entity', table_name='audit_log')
+    op.drop_table('audit_log')
@@ -1,18 +1,42 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import JSONB
 
 db = SQLAlchemy()
 
+# Timestamps are stored as naive UTC, set by the database
+utc_now = db.func.timezone('utc', db.func.now())
+
 
 ##### MODELS #####
 
 class Venue(db.Model):
   __tablename__ = 'venues'
+  # Listings and searches only look at venues that are not deleted
+  __table_args__ = (
+      db.Index('ix_venues_active', 'state', 'city', 'name',
+               postgresql_where=db.text('deleted_at IS NULL')),
+      # Duplicate lookups by trigram similarity within a city (dedupe.py)
+      db.Index('ix_venues_name_key_trgm', 'state', db.text('lower(city)'),
+               'name_key', postgresql_using='gin',
+               postgresql_ops={'name_key': 'gin_trgm_ops'},
+               postgresql_where=db.text('deleted_at IS NULL')),
+      # Proximity searches by geohash prefix (geo.py)
+      db.Index('ix_venues_geohash', 'geohash',
+               postgresql_where=db.text('deleted_at IS NULL')),
+  )
 
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String)
+  # normalize_name(name), maintained by a trigger
+  name_key = db.Column(db.String, server_default=db.FetchedValue(),
+                       server_onupdate=db.FetchedValue())
   city = db.Column(db.String(120))
   state = db.Column(db.String(120))
   address = db.Column(db.String(120))
+  # From the offline geocoder; geohash of (latitude, longitude)
+  latitude = db.Column(db.Float)
+  longitude = db.Column(db.Float)
+  geohash = db.Column(db.String(12, collation='C'))
   phone = db.Column(db.String(120))
   image_link = db.Column(db.String(500))
   website = db.Column(db.String(120))
@@ -20,12 +44,24 @@ class Venue(db.Model):
   seeking_description = db.Column(db.String(120))
   genres = db.Column(db.ARRAY(db.String), nullable=False)
   facebook_link = db.Column(db.String(120))
+  version = db.Column(db.Integer, nullable=False, default=1)
+  updated_at = db.Column(db.DateTime, nullable=False, index=True,
+                         server_default=utc_now, onupdate=utc_now)
+  # Soft delete: set at once, related shows are archived by purge.py
+  deleted_at = db.Column(db.DateTime)
+
+  # Optimistic locking: UPDATEs check and bump the version column
+  __mapper_args__ = {'version_id_col': version}
 
   # Relationships
   artists = db.relationship('Artist', secondary='shows')
   shows = db.relationship('Show', backref=('venues'))
 
   # Functions
+  @classmethod
+  def active(cls):
+      return cls.query.filter(cls.deleted_at.is_(None))
+
   def to_dict(self):
 
       # Returns a dictionary of venues        
@@ -36,7 +72,7 @@ class Venue(db.Model):
           'state': self.state,
           'address': self.address,
           'phone': self.phone,
-          'genres': self.genres.split(','),  # convert string to list
+          'genres': list(self.genres),
           'image_link': self.image_link,
           'facebook_link': self.facebook_link,
           'website': self.website,
@@ -49,9 +85,21 @@ class Venue(db.Model):
 
 class Artist(db.Model):
   __tablename__ = 'artists'
+  # Listings and searches only look at artists that are not deleted
+  __table_args__ = (
+      db.Index('ix_artists_active', 'name',
+               postgresql_where=db.text('deleted_at IS NULL')),
+      db.Index('ix_artists_name_key_trgm', 'state', db.text('lower(city)'),
+               'name_key', postgresql_using='gin',
+               postgresql_ops={'name_key': 'gin_trgm_ops'},
+               postgresql_where=db.text('deleted_at IS NULL')),
+  )
 
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String)
+  # normalize_name(name), maintained by a trigger
+  name_key = db.Column(db.String, server_default=db.FetchedValue(),
+                       server_onupdate=db.FetchedValue())
   city = db.Column(db.String(120))
   seeking_venue = db.Column(db.Boolean, nullable=False, default=False)
   state = db.Column(db.String(120))
@@ -59,14 +107,27 @@ class Artist(db.Model):
   website = db.Column(db.String(120))
   seeking_description = db.Column(db.String(120))
   image_link = db.Column(db.String(500))
-  genres = db.Column(db.String(120))
+  # varchar[] like Venue.genres (was a string, see online_migrations.py)
+  genres = db.Column(db.ARRAY(db.String), nullable=False)
   facebook_link = db.Column(db.String(120))
+  version = db.Column(db.Integer, nullable=False, default=1)
+  updated_at = db.Column(db.DateTime, nullable=False, index=True,
+                         server_default=utc_now, onupdate=utc_now)
+  # Soft delete: set at once, related shows are archived by purge.py
+  deleted_at = db.Column(db.DateTime)
+
+  # Optimistic locking: UPDATEs check and bump the version column
+  __mapper_args__ = {'version_id_col': version}
 
   # Relationships:
   venues = db.relationship('Venue', secondary='shows')
   shows = db.relationship('Show', backref=('artists'))
   
   # Functions:    
+  @classmethod
+  def active(cls):
+      return cls.query.filter(cls.deleted_at.is_(None))
+
   def to_dict(self):
       """ Returns a dictionary of artists """
       return {
@@ -75,7 +136,7 @@ class Artist(db.Model):
           'city': self.city,
           'state': self.state,
           'phone': self.phone,
-          'genres': self.genres.split(','),  # convert string to list
+          'genres': list(self.genres),
           'image_link': self.image_link,
           'facebook_link': self.facebook_link,
           'website': self.website,
@@ -88,11 +149,22 @@ class Artist(db.Model):
 
 class Show(db.Model):
   __tablename__ = 'shows'
+  # Range-partitioned by month on start_time (see partitions.py), so the
+  # partition key is part of the primary key.
+  __table_args__ = (
+      db.Index('ix_shows_venue_id_start_time', 'venue_id', 'start_time'),
+      db.Index('ix_shows_artist_id_start_time', 'artist_id', 'start_time'),
+      # Covers the upcoming-shows range scans (upcoming.py)
+      db.Index('ix_shows_start_time', 'start_time', 'venue_id', 'artist_id', 'id'),
+      {'postgresql_partition_by': 'RANGE (start_time)'},
+  )
 
-  id = db.Column(db.Integer, primary_key=True)
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
   artist_id = db.Column(db.Integer, db.ForeignKey('artists.id'), nullable=False) # Child
   venue_id = db.Column(db.Integer, db.ForeignKey('venues.id'), nullable=False) # Child
-  start_time = db.Column(db.DateTime, nullable=False)
+  start_time = db.Column(db.DateTime, primary_key=True, nullable=False)
+  created_at = db.Column(db.DateTime, nullable=False, index=True,
+                         server_default=utc_now)
 
   # Relationships:
   venue = db.relationship('Venue')
@@ -118,4 +190,119 @@ class Show(db.Model):
 
           # convert datetime to string
           'start_time': self.start_time.strftime('%Y-%m-%d %H:%M:%S')
-      }
\ No newline at end of file
+      }
+
+class ArchivedShow(db.Model):
+  # Shows of deleted venues and artists, moved here in batches by purge.py
+  __tablename__ = 'archived_shows'
+
+  id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+  artist_id = db.Column(db.Integer, nullable=False, index=True)
+  venue_id = db.Column(db.Integer, nullable=False, index=True)
+  start_time = db.Column(db.DateTime, primary_key=True)
+  created_at = db.Column(db.DateTime, nullable=False)
+  archived_at = db.Column(db.DateTime, nullable=False, server_default=utc_now)
+
+class PurgeJob(db.Model):
+  # Progress of archiving the shows of one deleted venue or artist
+  __tablename__ = 'purge_jobs'
+
+  id = db.Column(db.Integer, primary_key=True)
+  entity = db.Column(db.String(20), nullable=False)
+  entity_id = db.Column(db.Integer, nullable=False)
+  status = db.Column(db.String(20), nullable=False, default='pending',
+                     index=True)
+  total = db.Column(db.Integer, nullable=False, default=0)
+  moved = db.Column(db.Integer, nullable=False, default=0)
+  error = db.Column(db.String)
+  created_at = db.Column(db.DateTime, nullable=False, server_default=utc_now)
+  updated_at = db.Column(db.DateTime, nullable=False, server_default=utc_now,
+                         onupdate=utc_now)
+
+  def to_dict(self):
+      return {
+          'id': self.id,
+          'entity': self.entity,
+          'entity_id': self.entity_id,
+          'status': self.status,
+          'total': self.total,
+          'moved': self.moved,
+          'error': self.error,
+      }
+
+class Stat(db.Model):
+  # Rollup of shows per month, venue state and artist genre, kept up to
+  # date by stats.py as shows and their artists/venues are written
+  __tablename__ = 'stats'
+
+  month = db.Column(db.Date, primary_key=True)
+  state = db.Column(db.String(120), primary_key=True)
+  genre = db.Column(db.String(120), primary_key=True)
+  shows = db.Column(db.Integer, nullable=False, default=0)
+
+  def to_dict(self):
+      return {
+          'month': self.month.strftime('%Y-%m'),
+          'state': self.state,
+          'genre': self.genre,
+          'shows': self.shows,
+      }
+
+class MigrationProgress(db.Model):
+  # Saved position of a resumable backfill (see online_migrations.py)
+  __tablename__ = 'online_migrations'
+
+  name = db.Column(db.String(100), primary_key=True)
+  last_id = db.Column(db.BigInteger, nullable=False, server_default='0')
+  rows = db.Column(db.BigInteger, nullable=False, server_default='0')
+  done = db.Column(db.Boolean, nullable=False, server_default=db.false())
+  updated_at = db.Column(db.DateTime, nullable=False, server_default=utc_now)
+
+class VenueShard(db.Model):
+  # Directory of the shard holding each venue, in the global database
+  # (see sharding.py)
+  __tablename__ = 'venue_shards'
+
+  venue_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+  shard = db.Column(db.String(50), nullable=False)
+
+class StoredSession(db.Model):
+  # Server-side session data when SESSION_STORE = 'postgres' (sessions.py)
+  __tablename__ = 'sessions'
+
+  id = db.Column(db.String(64), primary_key=True)
+  data = db.Column(db.Text, nullable=False)
+  expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class AuditEntry(db.Model):
+  # Append-only history of writes to artists, venues and shows, written in
+  # batches by audit.py
+  __tablename__ = 'audit_log'
+  __table_args__ = (
+      db.Index('ix_audit_log_entity', 'entity', 'entity_id', 'id'),
+  )
+
+  id = db.Column(db.BigInteger, primary_key=True)
+  entity = db.Column(db.String(20), nullable=False)
+  entity_id = db.Column(db.Integer, nullable=False)
+  # create, update or delete
+  action = db.Column(db.String(10), nullable=False)
+  # column -> new value, or [old, new] for updates
+  changes = db.Column(JSONB, nullable=False)
+  # Client address and endpoint of the request, None from the CLI
+  actor = db.Column(db.String(120))
+  endpoint = db.Column(db.String(120))
+  # When the change was committed, not when the entry was written
+  created_at = db.Column(db.DateTime, nullable=False)
+
+  def to_dict(self):
+      return {
+          'id': self.id,
+          'entity': self.entity,
+          'entity_id': self.entity_id,
+          'action': self.action,
+          'changes': self.changes,
+          'actor': self.actor,
+          'endpoint': self.endpoint,
+          'created_at': self.created_at.isoformat(),
+      }
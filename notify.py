@@ -0,0 +1,199 @@
+##### Cross-worker change notifications #####
+# Every committed change to an artist, venue or show is published on a
+# Postgres NOTIFY channel as
+#   {"entity": .., "id": .., "version": .., "changed": [column, ...]}
+# where "changed" lists the columns an update wrote and is null for
+# inserts, deletes and Core writes (anything may have changed). Each worker
+# runs a background thread that LISTENs on that channel and calls the
+# invalidation callbacks registered with ``on_invalidate``, which can skip
+# changes to columns they don't cache. With sharding on, shows and venues
+# are written (and notified) in the shards, so there is one such thread per
+# database: the global one and every shard.
+#
+# NOTIFY is transactional: notifications are only delivered when the
+# transaction commits and are dropped on rollback, so listeners never see
+# changes that did not happen. Whenever a listening connection is
+# (re)established, every callback is called with ``entity_id=None`` ("drop
+# everything"), because notifications sent while it was down are gone.
+import json
+import logging
+import select
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event, inspect, text
+
+from models import db, Venue, Artist, Show
+
+logger = logging.getLogger(__name__)
+
+ENTITIES = {Artist: 'artist', Venue: 'venue', Show: 'show'}
+
+_callbacks = {}
+
+
+def on_invalidate(entity):
+    """Register ``fn(entity_id, version, changed)`` for changes to
+    ``entity`` ('artist', 'venue' or 'show'). ``entity_id`` is None when
+    everything cached for that entity has to be dropped; ``changed`` is the
+    set of columns an update wrote, or None when it is not known."""
+    def decorator(fn):
+        _callbacks.setdefault(entity, []).append(fn)
+        return fn
+    return decorator
+
+
+def dispatch(entity, entity_id, version=None, changed=None):
+    if changed is not None:
+        changed = frozenset(changed)
+    for fn in _callbacks.get(entity, ()):
+        try:
+            fn(entity_id, version, changed)
+        except Exception:
+            logger.exception('invalidation callback failed for %s %s',
+                             entity, entity_id)
+
+
+def dispatch_all():
+    for entity in _callbacks:
+        dispatch(entity, None)
+
+
+def publish(connection, channel, changes):
+    """Queue NOTIFYs for ``(entity, id, version)`` or ``(entity, id,
+    version, changed columns)`` tuples on ``connection``. They are sent when
+    its transaction commits."""
+    payloads = []
+    for change in changes:
+        entity, entity_id, version = change[:3]
+        changed = change[3] if len(change) > 3 else None
+        payloads.append(json.dumps({
+            'entity': entity, 'id': entity_id, 'version': version,
+            'changed': sorted(changed) if changed is not None else None}))
+    if payloads:
+        connection.execute(
+            text('SELECT pg_notify(:channel, payload) '
+                 'FROM unnest(CAST(:payloads AS text[])) AS payload'),
+            {'channel': channel, 'payloads': payloads})
+
+
+def publish_changes(changes):
+    """Publish changes written outside the ORM unit of work (e.g. Core
+    multi-row inserts) on the current session's transaction."""
+    publish(db.session.connection(),
+            current_app.config.get('CHANGE_NOTIFY_CHANNEL', 'fyyur_changes'),
+            changes)
+
+
+def _changed_columns(obj):
+    # Still available in after_flush: the history of the flushed update
+    state = inspect(obj)
+    return {attr.key for attr in state.mapper.column_attrs
+            if state.attrs[attr.key].history.has_changes()}
+
+
+class ChangeNotifier(object):
+
+    def __init__(self, app=None):
+        self.channel = None
+        self.heartbeat = None
+        self._threads = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.channel = app.config.get('CHANGE_NOTIFY_CHANNEL', 'fyyur_changes')
+        self.heartbeat = app.config.get('CHANGE_LISTENER_HEARTBEAT', 5)
+        event.listen(db.session, 'after_flush', self._after_flush)
+        app.extensions['change_notifier'] = self
+        if app.config.get('CHANGE_LISTENER_ENABLED', True):
+            # Started lazily so that each forked worker gets its own thread
+            app.before_request(self.start)
+
+    def _after_flush(self, session, flush_context):
+        changes = []
+        for objects, updated in ((session.new, False), (session.dirty, True),
+                                 (session.deleted, False)):
+            for obj in objects:
+                entity = ENTITIES.get(type(obj))
+                if entity is None or obj.id is None:
+                    continue
+                changed = _changed_columns(obj) if updated else None
+                # Dirty only through a relationship: no row was written
+                if changed is not None and not changed:
+                    continue
+                changes.append((entity, obj.id, getattr(obj, 'version', None),
+                                changed))
+        publish(session.connection(), self.channel,
+                sorted(changes, key=lambda change: change[:2]))
+
+    def start(self):
+        if self._threads is not None:
+            return
+        with self._lock:
+            if self._threads is None:
+                engines = {'global': db.engine}
+                shards = current_app.extensions.get('shards')
+                if shards is not None and shards.enabled:
+                    engines.update((name, shards.engine(name))
+                                   for name in shards.names)
+                threads = []
+                for name, engine in sorted(engines.items()):
+                    thread = threading.Thread(
+                        target=self._run, args=(engine,),
+                        name='change-listener-' + name, daemon=True)
+                    thread.start()
+                    threads.append(thread)
+                self._threads = threads
+
+    def _connect(self, engine):
+        fairy = engine.raw_connection()
+        fairy.detach()  # keep this connection out of the pool for good
+        conn = fairy.connection
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('LISTEN ' + self.channel)
+        return conn
+
+    def _run(self, engine):
+        backoff = 1
+        while True:
+            try:
+                conn = self._connect(engine)
+            except Exception:
+                logger.exception('change listener could not connect')
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            # Anything cached before this point may have missed notifications
+            dispatch_all()
+            backoff = 1
+            try:
+                self._listen(conn)
+            except Exception:
+                logger.exception('change listener lost its connection')
+            finally:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+    def _listen(self, conn):
+        while True:
+            readable, _, _ = select.select([conn], [], [], self.heartbeat)
+            if not readable:
+                # Detect a dead connection within one heartbeat
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            conn.poll()
+            while conn.notifies:
+                notification = conn.notifies.pop(0)
+                try:
+                    change = json.loads(notification.payload)
+                except ValueError:
+                    logger.warning('bad change payload %r', notification.payload)
+                    continue
+                dispatch(change['entity'], change['id'], change.get('version'),
+                         change.get('changed'))
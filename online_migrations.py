@@ -0,0 +1,101 @@
+##### Online schema changes #####
+# Migrations that change large tables without taking long exclusive
+# locks. A change is split in three steps:
+#   expand    add the new column (nullable and without a default, so only
+#             the catalog changes) and a trigger that fills it on every
+#             write through the old column
+#   backfill  fill the new column of existing rows in primary-key ranges,
+#             one short transaction per batch with a pause in between;
+#             progress is saved in online_migrations so an interrupted run
+#             picks up where it stopped
+#   contract  check the backfill finished, then swap the columns and drop
+#             the trigger in one quick transaction
+# DDL runs under a short lock_timeout and is retried when it times out, so
+# a migration stuck behind a long query doesn't make every other query
+# queue up behind its lock request. The DDL and backfill helpers live in
+# migrations/ddl.py, which revisions import; this module names the
+# backfills and runs them from the command line.
+#
+#   flask online-migrations status
+#   flask online-migrations backfill artists_genres --batch-size 5000
+from collections import namedtuple
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from migrations import ddl
+from migrations.ddl import LOCK_TIMEOUT_MS
+from models import db
+
+online_migrations_cli = AppGroup('online-migrations',
+                                 help='Resumable backfills for schema changes.')
+
+
+##### Backfills #####
+# table, key (integer primary key), column to fill, expression(row prefix)
+# giving its value, pending (SQL condition of rows still to do)
+Backfill = namedtuple('Backfill', 'table key column expression pending')
+
+BACKFILLS = {}
+
+
+def register(name, table, column, expression, key='id', pending=None):
+    BACKFILLS[name] = Backfill(table, key, column, expression,
+                               pending or '{} IS NULL'.format(column))
+
+
+def run_backfill(conn, name, batch_size=1000, pause=0.1,
+                 lock_timeout_ms=LOCK_TIMEOUT_MS, echo=print):
+    """Run (or resume) backfill ``name``; see ``ddl.run_backfill``."""
+    backfill = BACKFILLS[name]
+    ddl.run_backfill(conn, name, backfill.table, backfill.column,
+                     backfill.expression(''), backfill.pending, key=backfill.key,
+                     batch_size=batch_size, pause=pause,
+                     lock_timeout_ms=lock_timeout_ms, echo=echo)
+
+
+##### artists.genres: string -> array #####
+# Artist.genres was a string (see ddl.artist_genres_array); venues keep
+# genres as an array. genres_array holds the same data as varchar[].
+register('artists_genres', 'artists', 'genres_array', ddl.artist_genres_array)
+
+
+##### name_key of venues and artists #####
+# Duplicate detection key, see dedupe.py and the normalize_name() function
+def _name_key(row):
+    return 'normalize_name({}name)'.format(row)
+
+
+for _table in ('venues', 'artists'):
+    register('{}_name_key'.format(_table), _table, 'name_key', _name_key,
+             pending='name_key IS NULL AND name IS NOT NULL')
+
+
+##### CLI #####
+@online_migrations_cli.command('backfill')
+@click.argument('name', type=click.Choice(sorted(BACKFILLS)))
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--pause', default=0.1, show_default=True,
+              help='Seconds to sleep between batches.')
+@click.option('--lock-timeout', default=LOCK_TIMEOUT_MS, show_default=True,
+              help='Milliseconds to wait for row locks per batch.')
+def backfill_command(name, batch_size, pause, lock_timeout):
+    """Run (or resume) a backfill."""
+    conn = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        run_backfill(conn, name, batch_size=batch_size, pause=pause,
+                     lock_timeout_ms=lock_timeout, echo=click.echo)
+    finally:
+        conn.close()
+
+
+@online_migrations_cli.command('status')
+def status_command():
+    """Show the progress of every backfill."""
+    rows = db.session.execute(text(
+        'SELECT name, last_id, rows, done, updated_at FROM online_migrations '
+        'ORDER BY name'))
+    for name, last_id, count, done, updated_at in rows:
+        click.echo('{:<20} {:<8} last id {:<10} {} rows  {}'.format(
+            name, 'done' if done else 'running', last_id, count, updated_at))
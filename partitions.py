@@ -0,0 +1,135 @@
+##### Show partitions #####
+# The shows table is range-partitioned by start_time, one partition per
+# month (see migration e81b47c0a5d3). These helpers keep partitions created
+# ahead of time and detach old ones so that the "upcoming shows" queries
+# only ever touch a few small partitions.
+#
+#   flask partitions ensure --months-ahead 12
+#   flask partitions archive --keep-months 36
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from models import db
+
+ARCHIVE_SCHEMA = 'shows_archive'
+
+partitions_cli = AppGroup('partitions', help='Manage shows table partitions.')
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return datetime(value.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(start):
+    return 'shows_y{:04d}m{:02d}'.format(start.year, start.month)
+
+
+def existing_partitions(conn):
+    """Names of the partitions currently attached to shows."""
+    rows = conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'shows'
+    """))
+    return {name for name, in rows}
+
+
+# Latest time (UTC) a partition was moved to the archive schema, or NULL
+ARCHIVED_AT = """
+    SELECT max(CAST(obj_description(c.oid, 'pg_class') AS timestamp))
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = '{}' AND c.relkind = 'r'
+      AND obj_description(c.oid, 'pg_class') ~ '^\\d{{4}}-\\d\\d-\\d\\dT'
+""".format(ARCHIVE_SCHEMA)
+
+
+def create_partition(conn, start):
+    """Create the partition for the month starting at ``start``.
+
+    Rows for that month may already sit in shows_default (shows booked far
+    ahead); they are moved into the new table before it is attached, since
+    Postgres refuses to attach a range the default partition still holds.
+    """
+    name = partition_name(start)
+    end = add_months(start, 1)
+    params = {'start': start, 'end': end}
+    conn.execute(text(
+        'CREATE TABLE {} (LIKE shows INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+        .format(name)))
+    conn.execute(text("""
+        WITH moved AS (
+            DELETE FROM shows_default
+            WHERE start_time >= :start AND start_time < :end
+            RETURNING *
+        )
+        INSERT INTO {} SELECT * FROM moved
+    """.format(name)), params)
+    conn.execute(text(
+        'ALTER TABLE shows ATTACH PARTITION {} '
+        'FOR VALUES FROM (:start) TO (:end)'.format(name)), params)
+    return name
+
+
+def ensure_partitions(start=None, months_ahead=12):
+    """Create every missing monthly partition from ``start`` (default: the
+    current month) up to ``months_ahead`` months in the future."""
+    now = month_start(datetime.now())
+    month = month_start(start) if start else now
+    end = add_months(now, months_ahead)
+    created = []
+    with db.engine.begin() as conn:
+        existing = existing_partitions(conn)
+        while month <= end:
+            if partition_name(month) not in existing:
+                created.append(create_partition(conn, month))
+            month = add_months(month, 1)
+    return created
+
+
+def archive_partitions(keep_months=36):
+    """Detach monthly partitions older than ``keep_months`` and move them to
+    the archive schema. Archived shows no longer appear on any page but
+    stay queryable as ``shows_archive.shows_yYYYYmMM``."""
+    cutoff = add_months(month_start(datetime.now()), -keep_months)
+    archived = []
+    with db.engine.begin() as conn:
+        conn.execute(text('CREATE SCHEMA IF NOT EXISTS ' + ARCHIVE_SCHEMA))
+        for name in sorted(existing_partitions(conn)):
+            if name == 'shows_default':
+                continue
+            start = datetime.strptime(name, 'shows_y%Ym%m')
+            if add_months(start, 1) > cutoff:
+                continue
+            conn.execute(text('ALTER TABLE shows DETACH PARTITION ' + name))
+            conn.execute(text('ALTER TABLE {} SET SCHEMA {}'.format(
+                name, ARCHIVE_SCHEMA)))
+            # When it left shows; the feed validators read it back
+            conn.execute(text('COMMENT ON TABLE {}.{} IS :archived_at'.format(
+                ARCHIVE_SCHEMA, name)), archived_at=datetime.utcnow().isoformat())
+            archived.append(name)
+    return archived
+
+
+@partitions_cli.command('ensure')
+@click.option('--months-ahead', default=12, show_default=True)
+def ensure_command(months_ahead):
+    """Create future monthly partitions."""
+    for name in ensure_partitions(months_ahead=months_ahead):
+        click.echo('created ' + name)
+
+
+@partitions_cli.command('archive')
+@click.option('--keep-months', default=36, show_default=True)
+def archive_command(keep_months):
+    """Detach old partitions into the archive schema."""
+    for name in archive_partitions(keep_months=keep_months):
+        click.echo('archived ' + name)
@@ -0,0 +1,174 @@
+##### Request profiler #####
+# Samples the stack of the request thread while a view runs (ORM work,
+# filters and template rendering included) and writes one file per request
+# in the "folded stacks" format read by flamegraph.pl and speedscope.
+#
+# A request is profiled when it carries a valid X-Profile-Signature header
+# (hex HMAC-SHA256 of the request path with PROFILE_SECRET, see
+# ``flask profiler sign /venues/1``) or is picked by PROFILE_SAMPLE_RATE.
+# With neither configured no hooks are installed at all. The directory
+# keeps at most PROFILE_MAX_FILES files and PROFILE_MAX_BYTES bytes; the
+# oldest profiles are deleted first.
+import hashlib
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import click
+from flask import (abort, current_app, g, render_template, request,
+                   send_from_directory)
+from flask.cli import AppGroup
+
+profiler_cli = AppGroup('profiler', help='Request profiler helpers.')
+
+
+def sign(secret, path):
+    return hmac.new(secret.encode(), path.encode(), hashlib.sha256).hexdigest()
+
+
+def frame_label(frame):
+    code = frame.f_code
+    module = frame.f_globals.get('__name__', '?')
+    return '{}:{}:{}'.format(module, code.co_name, code.co_firstlineno)
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of ``thread_id`` every ``interval`` seconds."""
+
+    def __init__(self, thread_id, interval):
+        super(StackSampler, self).__init__(name='request-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        return self.stacks
+
+
+class RequestProfiler(object):
+
+    def __init__(self, app=None):
+        self.secret = None
+        self.sample_rate = None
+        self.directory = None
+        self.interval = None
+        self.max_files = None
+        self.max_bytes = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.secret = app.config.get('PROFILE_SECRET')
+        self.sample_rate = app.config.get('PROFILE_SAMPLE_RATE', 0.0)
+        self.directory = app.config.get('PROFILE_DIR', 'profiles')
+        self.interval = app.config.get('PROFILE_INTERVAL_MS', 1) / 1000.0
+        self.max_files = app.config.get('PROFILE_MAX_FILES', 500)
+        self.max_bytes = app.config.get('PROFILE_MAX_BYTES', 100 * 1024 * 1024)
+        app.cli.add_command(profiler_cli)
+        if not self.secret and not self.sample_rate:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        app.before_request(self._start)
+        app.after_request(self._stop)
+        app.teardown_request(self._teardown)
+        app.add_url_rule('/admin/profiles', 'profiles', self.index)
+        app.add_url_rule('/admin/profiles/<path:name>', 'profile', self.download)
+
+    def _signed(self, path):
+        signature = (request.headers.get('X-Profile-Signature')
+                     or request.args.get('profile_signature', ''))
+        return bool(self.secret) and hmac.compare_digest(
+            signature, sign(self.secret, path))
+
+    def _start(self):
+        if request.endpoint in ('profiles', 'profile', 'static'):
+            return
+        if not (self._signed(request.path)
+                or random.random() < self.sample_rate):
+            return
+        g.profiler_started = time.perf_counter()
+        g.profiler = StackSampler(threading.get_ident(), self.interval)
+        g.profiler.start()
+
+    def _stop(self, response):
+        sampler = g.pop('profiler', None)
+        if sampler is None:
+            return response
+        stacks = sampler.stop()
+        elapsed = time.perf_counter() - g.pop('profiler_started')
+        name = '{}-{}-{}-{:.0f}ms.folded'.format(
+            datetime.now().strftime('%Y%m%dT%H%M%S%f'), request.endpoint,
+            os.getpid(), elapsed * 1000)
+        with open(os.path.join(self.directory, name), 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        self._trim()
+        response.headers['X-Profile'] = name
+        return response
+
+    def _trim(self):
+        # Names start with the time the profile was taken: oldest first
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.folded'):
+                files.append((entry.name, entry.stat().st_size))
+        files.sort()
+        total = sum(size for _, size in files)
+        while files and (len(files) > self.max_files or total > self.max_bytes):
+            name, size = files.pop(0)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass  # trimmed by another worker
+            total -= size
+
+    def _teardown(self, exc):
+        # after_request is skipped when the view raised
+        sampler = g.pop('profiler', None)
+        if sampler is not None:
+            sampler.stop()
+
+    def index(self):
+        if not self._signed('/admin/profiles'):
+            abort(404)
+        profiles = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            path = os.path.join(self.directory, name)
+            profiles.append({'name': name, 'size': os.path.getsize(path)})
+        return render_template('pages/profiles.html', profiles=profiles,
+                               signature=sign(self.secret, '/admin/profiles'))
+
+    def download(self, name):
+        if not self._signed('/admin/profiles'):
+            abort(404)
+        return send_from_directory(os.path.abspath(self.directory), name,
+                                   mimetype='text/plain')
+
+
+@profiler_cli.command('sign')
+@click.argument('path')
+def sign_command(path):
+    """Print the X-Profile-Signature value for PATH."""
+    secret = current_app.config.get('PROFILE_SECRET')
+    if not secret:
+        raise click.UsageError('PROFILE_SECRET is not configured.')
+    click.echo(sign(secret, path))
@@ -0,0 +1,241 @@
+##### Deleting venues and artists #####
+# Deleting is two-phase. The venue or artist is soft-deleted at once
+# (deleted_at is set, which hides it from listings and searches), and a
+# purge job is queued. A background thread then moves the related shows
+# to archived_shows in small batches, each in its own short transaction
+# with a lock timeout and a pause in between, so the shows table is never
+# locked long enough to stall other pages. Progress is kept on the
+# purge_jobs row; jobs left behind by a dead worker, or whose last shows
+# stayed locked by other transactions, are picked up again once stale.
+#
+# With sharding on, purge jobs live in the global database and each job
+# archives the shows of every shard (an artist's shows are spread over all
+# of them) into that shard's archived_shows.
+#
+#   flask purge run    drains the queue in the foreground (e.g. from cron)
+import logging
+import threading
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from models import db, Venue, Artist, Show, PurgeJob
+from notify import publish_changes
+import stats
+
+logger = logging.getLogger(__name__)
+
+ENTITIES = {'venue': (Venue, 'venue_id'), 'artist': (Artist, 'artist_id')}
+
+# SQLSTATE lock_not_available, raised when lock_timeout expires
+LOCK_NOT_AVAILABLE = '55P03'
+
+purge_cli = AppGroup('purge', help='Archive shows of deleted venues/artists.')
+
+
+def _count_shows(column, entity_id):
+    return Show.query.filter(getattr(Show, column) == entity_id).count()
+
+
+def soft_delete(obj, entity):
+    """Mark ``obj`` deleted and queue the job that archives its shows.
+    The caller commits. A venue in a shard is committed here, and the job
+    added to the global database, where db.session points afterwards."""
+    column = ENTITIES[entity][1]
+    shards = current_app.extensions['shards']
+    obj.deleted_at = datetime.utcnow()
+    entity_id = obj.id
+    total = sum(shards.fan_out(_count_shows, column, entity_id))
+    if shards.enabled and entity == 'venue':
+        db.session.commit()
+        shards.use_global()
+    job = PurgeJob(entity=entity, entity_id=entity_id, total=total)
+    db.session.add(job)
+    return job
+
+
+def claim_job(stale_after):
+    """Take the oldest pending job, or a running one whose worker stopped
+    reporting progress. Returns the job id or None."""
+    job_id = db.session.execute(text("""
+        UPDATE purge_jobs SET status = 'running', updated_at = timezone('utc', now())
+        WHERE id = (
+            SELECT id FROM purge_jobs
+            WHERE status = 'pending'
+               OR (status = 'running' AND
+                   updated_at < timezone('utc', now()) - :stale * interval '1 second')
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id
+    """), {'stale': stale_after}).scalar()
+    db.session.commit()
+    return job_id
+
+
+def run_batch(job, batch_size, lock_timeout_ms, session=None):
+    """Archive up to ``batch_size`` shows of the job's entity from
+    ``session``'s database (default db.session, which holds the job).
+    Returns the number moved; 0 means there are none left to take."""
+    session = session or db.session
+    column = ENTITIES[job.entity][1]
+    session.execute(text("SELECT set_config('lock_timeout', :timeout, true)"),
+                    {'timeout': '{}ms'.format(lock_timeout_ms)})
+    show_ids = [show_id for show_id, in session.execute(text("""
+        SELECT id FROM shows WHERE {} = :entity_id
+        ORDER BY id LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    """.format(column)), {'entity_id': job.entity_id, 'limit': batch_size})]
+    if not show_ids:
+        return 0
+    stats.remove_shows(show_ids, session=session)
+    session.execute(text("""
+        WITH moved AS (
+            DELETE FROM shows WHERE id = ANY(:ids)
+            RETURNING id, artist_id, venue_id, start_time, created_at
+        )
+        INSERT INTO archived_shows (id, artist_id, venue_id, start_time, created_at)
+        SELECT id, artist_id, venue_id, start_time, created_at FROM moved
+    """), {'ids': show_ids})
+    if session is not db.session:
+        # The shard commits on its own; job progress is only informative
+        session.commit()
+    job.moved += len(show_ids)
+    db.session.commit()
+    return len(show_ids)
+
+
+def shows_left(job, session=None):
+    """True while the entity still has shows, locked ones included (which
+    run_batch skips)."""
+    column = ENTITIES[job.entity][1]
+    return (session or db.session).execute(text(
+        'SELECT 1 FROM shows WHERE {} = :entity_id LIMIT 1'.format(column)),
+        {'entity_id': job.entity_id}).first() is not None
+
+
+def _archive(job, session, batch_size, pause, lock_timeout_ms, max_retries):
+    """Archive the job's shows in ``session``'s database. Returns False
+    when some stayed locked through ``max_retries`` attempts."""
+    retries = 0
+    while True:
+        try:
+            moved = run_batch(job, batch_size, lock_timeout_ms, session)
+        except OperationalError as e:
+            session.rollback()
+            if getattr(e.orig, 'pgcode', None) != LOCK_NOT_AVAILABLE:
+                raise
+            moved = None
+        if moved:
+            retries = 0
+            time.sleep(pause)
+            continue
+        if moved == 0 and not shows_left(job, session):
+            session.commit()
+            return True
+        # Lock timeout, or the shows left are locked by an edit or a
+        # booking: back off and try again
+        retries += 1
+        if retries > max_retries:
+            session.rollback()
+            return False
+        time.sleep(pause * 10)
+
+
+def _shard_sessions():
+    # Where the shows are: db.session itself, or a session per shard
+    shards = current_app.extensions['shards']
+    if not shards.enabled:
+        return [(None, db.session)]
+    return [(name, shards.session(name)) for name in shards.names]
+
+
+def run_job(job_id, batch_size=500, pause=0.2, lock_timeout_ms=2000,
+            max_retries=20):
+    job = PurgeJob.query.get(job_id)
+    sessions = _shard_sessions()
+    try:
+        for name, session in sessions:
+            if not _archive(job, session, batch_size, pause, lock_timeout_ms,
+                            max_retries):
+                # Still 'running': taken over again once PURGE_STALE_AFTER passes
+                db.session.rollback()
+                logger.warning('purge job %s: shows still locked after %d '
+                               'retries%s, leaving it for a later run',
+                               job_id, max_retries,
+                               ' in shard ' + name if name else '')
+                return
+        job.status = 'done'
+        # Cached show data in every worker needs a reload
+        publish_changes([('show', None, None)])
+        db.session.commit()
+    except Exception as e:
+        for _, session in sessions:
+            session.rollback()
+        db.session.rollback()
+        logger.exception('purge job %s failed', job_id)
+        job = PurgeJob.query.get(job_id)
+        job.status = 'failed'
+        job.error = str(e)
+        db.session.commit()
+    finally:
+        for _, session in sessions:
+            if session is not db.session:
+                session.close()
+
+
+def run_pending(app, echo=None):
+    config = app.config
+    while True:
+        job_id = claim_job(config.get('PURGE_STALE_AFTER', 300))
+        if job_id is None:
+            return
+        if echo:
+            echo('running purge job {}'.format(job_id))
+        run_job(job_id,
+                batch_size=config.get('PURGE_BATCH_SIZE', 500),
+                pause=config.get('PURGE_PAUSE', 0.2),
+                lock_timeout_ms=config.get('PURGE_LOCK_TIMEOUT_MS', 2000),
+                max_retries=config.get('PURGE_MAX_RETRIES', 20))
+
+
+class Purger(object):
+    """Runs pending purge jobs on a background thread of this worker."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._thread = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.cli.add_command(purge_cli)
+
+    def wake(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='purge',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        with self.app.app_context():
+            try:
+                run_pending(self.app)
+            finally:
+                db.session.remove()
+
+
+@purge_cli.command('run')
+def run_command():
+    """Run all pending purge jobs."""
+    run_pending(current_app._get_current_object(), echo=click.echo)
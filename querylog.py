@@ -0,0 +1,163 @@
+##### Slow-query log #####
+# Times every statement sent to the database. Statements slower than
+# SLOW_QUERY_THRESHOLD_MS are written to a rotating log together with the
+# route that issued them and their (redacted) bind parameters; a sampled
+# fraction of slow SELECTs also gets its EXPLAIN (ANALYZE, BUFFERS) plan
+# logged (EXPLAIN ANALYZE runs the statement again, so only plain SELECTs
+# are explained, and always rolled back). Per-statement aggregates are kept
+# in memory and can be dumped with ``dump_stats``.
+import logging
+import random
+import re
+import threading
+import time
+from datetime import date, datetime
+from logging import Formatter
+from logging.handlers import RotatingFileHandler
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('fyyur.slow_query')
+
+_whitespace = re.compile(r'\s+')
+
+MAX_STATEMENTS = 2000
+
+# Statements whose second run (by EXPLAIN ANALYZE) would lock rows or have
+# effects outside the rolled back savepoint, such as sequences and NOTIFY
+_not_plain = re.compile(
+    r'\bFOR\s+(NO\s+KEY\s+)?UPDATE\b|\bFOR\s+(KEY\s+)?SHARE\b|\bINTO\b|'
+    r'\b(nextval|setval|pg_notify|pg_advisory\w*|dblink\w*)\s*\(',
+    re.IGNORECASE)
+
+# psycopg2's TRANSACTION_STATUS_INTRANS: idle inside a transaction block
+_IN_TRANSACTION = 2
+
+
+def plain_select(statement):
+    return statement[:6].upper() == 'SELECT' and not _not_plain.search(statement)
+
+
+def redact(value):
+    """Keep values that say something about the plan (numbers, dates, None)
+    and hide anything that may carry user data."""
+    if value is None or isinstance(value, (bool, int, float, date, datetime)):
+        return value
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if len(value) > 10:
+            return '<{} items>'.format(len(value))
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        return '<str len={}>'.format(len(value))
+    return '<{}>'.format(type(value).__name__)
+
+
+class QueryLog(object):
+
+    def __init__(self, app=None):
+        self.threshold = None
+        self.sample_rate = None
+        self._stats = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.threshold = app.config.get('SLOW_QUERY_THRESHOLD_MS', 200) / 1000.0
+        self.sample_rate = app.config.get('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 0.0)
+
+        handler = RotatingFileHandler(
+            app.config.get('SLOW_QUERY_LOG', 'slow_query.log'),
+            maxBytes=app.config.get('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024),
+            backupCount=app.config.get('SLOW_QUERY_LOG_BACKUPS', 5))
+        handler.setFormatter(Formatter('%(asctime)s %(process)d %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+        # Listening on the Engine class covers every engine the app creates
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        app.extensions['query_log'] = self
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        # Kept per execution, so a statement that fails (and never reaches
+        # _after_execute) leaves nothing behind for the next one
+        if context is not None:
+            context.query_start = time.perf_counter()
+        else:
+            conn.info['query_start'] = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        start = context.query_start if context is not None \
+            else conn.info.pop('query_start')
+        duration = time.perf_counter() - start
+        key = _whitespace.sub(' ', statement).strip()
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                # IN lists of varying length make distinct statements; cap
+                # the table so they can't grow it without bound
+                if len(self._stats) >= MAX_STATEMENTS:
+                    key = '<other statements>'
+                stats = self._stats.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+        if duration < self.threshold:
+            return
+        route = request.endpoint if has_request_context() else '-'
+        logger.info('slow query %.1f ms route=%s params=%r sql=%s',
+                    duration * 1000, route, redact(parameters), key)
+        if (self.sample_rate and not executemany
+                and plain_select(key)
+                and random.random() < self.sample_rate):
+            self._explain(cursor, statement, parameters, route)
+
+    def _explain(self, cursor, statement, parameters, route):
+        # Only inside an open transaction, under a savepoint that is always
+        # rolled back: nothing the second run does is kept, and a failing
+        # EXPLAIN can't abort the request's transaction
+        status = getattr(cursor.connection, 'get_transaction_status', None)
+        if status is None or status() != _IN_TRANSACTION:
+            return
+        try:
+            with cursor.connection.cursor() as explain:
+                explain.execute('SAVEPOINT slow_query_explain')
+                try:
+                    explain.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement,
+                                    parameters)
+                    plan = '\n'.join(line for line, in explain.fetchall())
+                finally:
+                    explain.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                    explain.execute('RELEASE SAVEPOINT slow_query_explain')
+        except Exception as e:
+            logger.info('explain failed route=%s: %s', route, e)
+            return
+        logger.info('explain route=%s\n%s', route, plan)
+
+    def stats(self):
+        """``[(statement, count, total_seconds, max_seconds)]`` sorted by
+        total time, for this process."""
+        with self._lock:
+            rows = [(key, count, total, worst)
+                    for key, (count, total, worst) in self._stats.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def dump_stats(self, limit=50):
+        rows = self.stats()[:limit]
+        for statement, count, total, worst in rows:
+            logger.info('stats count=%d total=%.1f ms max=%.1f ms sql=%s',
+                        count, total * 1000, worst * 1000, statement)
+        return rows
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
@@ -0,0 +1,202 @@
+##### Admission control #####
+# Two limits, both configured per endpoint (the view function name):
+#   RATE_LIMITS         token bucket per client address: requests per
+#                       minute and burst size; over the limit gets a 429
+#   CONCURRENCY_LIMITS  requests of the endpoint allowed to run at once on
+#                       this host; when all slots are taken the request is
+#                       turned away with a 503 at once instead of queueing
+#                       for a database connection
+#
+# The client address is request.remote_addr, which is only the real client
+# behind a proxy when PROXY_FIX_X_FOR is set (see app.py).
+#
+# State is shared by all workers on the host through a small memory-mapped
+# file (in /dev/shm where available) guarded by flock. Buckets live in a
+# fixed-size open-addressing table; when a probe window is full the bucket
+# refilled longest ago is evicted, which at worst gives that client a fresh
+# burst. Concurrency slots hold the pid of the worker using them, so slots
+# of a worker that died mid-request are reclaimed.
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, request
+
+BUCKET = struct.Struct('Qdd')  # key, tokens, last refill
+SLOT = struct.Struct('i')      # pid, 0 when free
+PROBES = 8
+
+
+def _default_path():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'fyyur-ratelimit')
+
+
+def _key(endpoint, client):
+    digest = hashlib.blake2b('{}|{}'.format(endpoint, client).encode(),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RateLimiter(object):
+
+    def __init__(self, app=None):
+        self.rates = {}
+        self.caps = {}
+        self._offsets = {}
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        if not config.get('RATE_LIMIT_ENABLED', True):
+            return
+        self.rates = {endpoint: (per_minute / 60.0, burst) for endpoint,
+                      (per_minute, burst) in config.get('RATE_LIMITS', {}).items()}
+        self.caps = dict(config.get('CONCURRENCY_LIMITS', {}))
+        if not self.rates and not self.caps:
+            return
+        self.buckets = config.get('RATE_LIMIT_BUCKETS', 65536)
+
+        # Slot arrays follow the bucket table, one per capped endpoint
+        offset = self.buckets * BUCKET.size
+        for endpoint, limit in sorted(self.caps.items()):
+            self._offsets[endpoint] = offset
+            offset += limit * SLOT.size
+        self.size = offset
+
+        # Workers with a different layout (e.g. during a deploy that changed
+        # the limits) get their own file rather than misreading this one
+        layout = repr((self.buckets, sorted(self.caps.items())))
+        self.path = '{}-{}'.format(
+            config.get('RATE_LIMIT_FILE') or _default_path(),
+            hashlib.sha1(layout.encode()).hexdigest()[:8])
+
+        app.before_request(self._admit)
+        app.teardown_request(self._release)
+
+    def _open(self):
+        # flock locks belong to the open file, which forked workers would
+        # share with their parent: every process opens the file itself
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < self.size:
+                os.ftruncate(fd, self.size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(fd, self.size)
+        self._fd = fd
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        # flock doesn't exclude threads sharing the descriptor, hence both
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    ##### Token buckets #####
+    def take(self, endpoint, client):
+        """Take a token from the client's bucket. Returns 0 when allowed,
+        else the seconds until a token is available."""
+        rate, burst = self.rates[endpoint]
+        key = _key(endpoint, client)
+        now = time.time()
+        with self._locked() as shared:
+            start = key % self.buckets
+            position = None
+            oldest = None
+            for i in range(PROBES):
+                offset = ((start + i) % self.buckets) * BUCKET.size
+                entry_key, tokens, stamp = BUCKET.unpack_from(shared, offset)
+                if entry_key == key:
+                    position = offset
+                    tokens = min(burst, tokens + max(0.0, now - stamp) * rate)
+                    break
+                if entry_key == 0:
+                    position, tokens = offset, burst
+                    break
+                if oldest is None or stamp < oldest[1]:
+                    oldest = (offset, stamp)
+            else:
+                position, tokens = oldest[0], burst
+
+            if tokens >= 1:
+                BUCKET.pack_into(shared, position, key, tokens - 1, now)
+                return 0
+            BUCKET.pack_into(shared, position, key, tokens, now)
+            return (1 - tokens) / rate
+
+    ##### Concurrency slots #####
+    def acquire(self, endpoint):
+        """Claim a slot for ``endpoint``. Returns its offset or None."""
+        pid = os.getpid()
+        with self._locked() as shared:
+            base = self._offsets[endpoint]
+            for i in range(self.caps[endpoint]):
+                offset = base + i * SLOT.size
+                holder, = SLOT.unpack_from(shared, offset)
+                if holder == 0 or (holder != pid and not _pid_alive(holder)):
+                    SLOT.pack_into(shared, offset, pid)
+                    return offset
+        return None
+
+    def release(self, offset):
+        with self._locked() as shared:
+            SLOT.pack_into(shared, offset, 0)
+
+    ##### Request hooks #####
+    def _admit(self):
+        # Also checked per request, so tools can switch it off (bench.py)
+        if not current_app.config.get('RATE_LIMIT_ENABLED', True):
+            return
+        endpoint = request.endpoint
+        if endpoint in self.rates:
+            wait = self.take(endpoint, request.remote_addr or '')
+            if wait:
+                return self._reject(429, 'Too many requests, slow down.', wait)
+        if endpoint in self.caps:
+            slot = self.acquire(endpoint)
+            if slot is None:
+                return self._reject(503, 'Server busy, try again shortly.', 1)
+            g.ratelimit_slot = slot
+
+    def _release(self, exc):
+        slot = g.pop('ratelimit_slot', None)
+        if slot is not None:
+            self.release(slot)
+
+    def _reject(self, status, message, retry_after):
+        response = current_app.response_class(message, status=status,
+                                              mimetype='text/plain')
+        response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return response
+
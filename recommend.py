@@ -0,0 +1,277 @@
+##### Artist recommendations for venues #####
+# Ranks every artist for a venue by
+#   - genre overlap, from an artists x genres 0/1 matrix,
+#   - location, same state and same city, from interned city/state codes,
+#   - co-booking: artists who played at venues that share artists with this
+#     venue, from the venues x artists booking matrix, which is kept in
+#     sparse (coordinate) form as one (venue, artist) pair per show.
+# Scores for all artists are computed with NumPy array operations; the
+# matrices live in process memory and are refreshed incrementally. The
+# artists and shows notify.py reports as written are reloaded by id, so
+# edits, removed shows and rows committed out of id order are all picked
+# up; rows above the highest id seen are also read on each refresh, which
+# covers new rows when the change listener is off. A full invalidation
+# (the listener reconnecting, shows archived) rebuilds everything.
+#
+# With sharding on, artists are read from the global database and shows
+# from every shard, each shard with its own highest id seen.
+import threading
+
+import numpy as np
+from flask import current_app
+
+from enums import Genre
+from models import db, Artist, Show
+from notify import on_invalidate
+
+GENRES = [genre.name for genre in Genre]
+GENRE_INDEX = {name: i for i, name in enumerate(GENRES)}
+
+WEIGHT_GENRE = 0.5
+WEIGHT_LOCATION = 0.3
+WEIGHT_COBOOKING = 0.2
+
+# Columns the matrices are built from
+ARTIST_COLUMNS = {'name', 'city', 'state', 'genres', 'deleted_at'}
+SHOW_COLUMNS = {'venue_id', 'artist_id'}
+
+
+def genre_vector(genres):
+    vector = np.zeros(len(GENRES), dtype=np.float32)
+    for name in genres or ():
+        if name in GENRE_INDEX:
+            vector[GENRE_INDEX[name]] = 1.0
+    return vector
+
+
+class Recommender(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty_lock = threading.Lock()
+        self._loaded = False
+        self._stale = True
+        self._dirty_artists = set()
+        self._dirty_shows = set()
+        self._codes = {}
+
+    def _code(self, value):
+        # Intern city/state strings as small integers for vector compares
+        return self._codes.setdefault((value or '').strip().lower(),
+                                      len(self._codes))
+
+    def _reset(self):
+        self.artist_ids = np.zeros(0, dtype=np.int64)
+        self.names = []
+        self.row = {}
+        self.genres = np.zeros((0, len(GENRES)), dtype=np.float32)
+        self.city = np.zeros(0, dtype=np.int32)
+        self.state = np.zeros(0, dtype=np.int32)
+        self.deleted = np.zeros(0, dtype=bool)
+        self.venue_index = {}
+        self.show_ids = np.zeros(0, dtype=np.int64)
+        self.show_venue = np.zeros(0, dtype=np.int32)
+        self.show_artist = np.zeros(0, dtype=np.int32)
+        self.last_artist_id = 0
+        self.last_show_ids = {}
+
+    def _artist_columns(self, session):
+        return session.query(Artist.id, Artist.name, Artist.city,
+                                Artist.state, Artist.genres, Artist.deleted_at)
+
+    def _append_artists(self, rows):
+        rows = [row for row in rows if row.id not in self.row]
+        if not rows:
+            return
+        start = len(self.names)
+        self.artist_ids = np.concatenate(
+            [self.artist_ids, np.array([row.id for row in rows], dtype=np.int64)])
+        self.genres = np.vstack(
+            [self.genres] + [genre_vector(row.genres)[None, :] for row in rows])
+        self.city = np.concatenate([self.city, np.array(
+            [self._code(row.city) for row in rows], dtype=np.int32)])
+        self.state = np.concatenate([self.state, np.array(
+            [self._code(row.state) for row in rows], dtype=np.int32)])
+        self.deleted = np.concatenate([self.deleted, np.array(
+            [row.deleted_at is not None for row in rows], dtype=bool)])
+        for i, row in enumerate(rows):
+            self.row[row.id] = start + i
+            self.names.append(row.name)
+        self.last_artist_id = max(self.last_artist_id,
+                                  max(int(row.id) for row in rows))
+
+    def _load_artists(self, session, artist_ids):
+        # Known artists are updated in place, the others appended
+        rows = self._artist_columns(session).filter(
+            Artist.id.in_(artist_ids)).order_by(Artist.id).all()
+        for row in rows:
+            i = self.row.get(row.id)
+            if i is None:
+                continue
+            self.names[i] = row.name
+            self.genres[i] = genre_vector(row.genres)
+            self.city[i] = self._code(row.city)
+            self.state[i] = self._code(row.state)
+            self.deleted[i] = row.deleted_at is not None
+        self._append_artists(rows)
+
+    def _append_shows(self, session, rows):
+        if not len(rows):
+            return
+        # A show's artist may have committed after the last artist refresh
+        missing = {row.artist_id for row in rows} - set(self.row)
+        if missing:
+            self._load_artists(session, missing)
+        rows = [row for row in rows if row.artist_id in self.row]
+        if not rows:
+            return
+        self.show_ids = np.concatenate([self.show_ids, np.array(
+            [row.id for row in rows], dtype=np.int64)])
+        self.show_venue = np.concatenate([self.show_venue, np.array(
+            [self.venue_index.setdefault(row.venue_id, len(self.venue_index))
+             for row in rows], dtype=np.int32)])
+        self.show_artist = np.concatenate([self.show_artist, np.array(
+            [self.row[row.artist_id] for row in rows], dtype=np.int32)])
+
+    def _show_columns(self):
+        return db.session.query(Show.id, Show.venue_id, Show.artist_id)
+
+    def _new_shows(self, shard, last_ids):
+        return self._show_columns().filter(
+            Show.id > last_ids.get(shard, 0)).order_by(Show.id).all()
+
+    def _shows_by_id(self, shard, show_ids):
+        return self._show_columns().filter(Show.id.in_(show_ids)).all()
+
+    def _reload_shows(self, session, show_ids):
+        # Drop the pairs of these shows, then add back the ones that exist
+        keep = ~np.isin(self.show_ids, list(show_ids))
+        self.show_ids = self.show_ids[keep]
+        self.show_venue = self.show_venue[keep]
+        self.show_artist = self.show_artist[keep]
+        found = current_app.extensions['shards'].fan_out_by_name(
+            self._shows_by_id, list(show_ids))
+        self._append_shows(session, [row for rows in found.values()
+                                     for row in rows])
+
+    def refresh(self):
+        """Bring the matrices up to date; a no-op when nothing changed."""
+        with self._lock:
+            with self._dirty_lock:
+                full = not self._loaded
+                if not full and not self._stale:
+                    return
+                # Invalidations arriving from here on apply to the next refresh
+                self._loaded, self._stale = True, False
+                artists, self._dirty_artists = self._dirty_artists, set()
+                shows, self._dirty_shows = self._dirty_shows, set()
+            try:
+                self._update(full, artists, shows)
+            except Exception:
+                self._loaded = False
+                raise
+
+    def _update(self, full, artists, shows):
+        if full:
+            self._reset()
+            artists, shows = (), ()
+        shards = current_app.extensions['shards']
+        # Artists are global; db.session may be pointing at a shard
+        session = shards.global_session() if shards.enabled else db.session
+        try:
+            self._append_artists(self._artist_columns(session).filter(
+                Artist.id > self.last_artist_id).order_by(Artist.id).all())
+            if artists:
+                self._load_artists(session, artists)
+            new = shards.fan_out_by_name(self._new_shows,
+                                         dict(self.last_show_ids))
+            for shard, rows in new.items():
+                if rows:
+                    self.last_show_ids[shard] = max(int(row.id)
+                                                    for row in rows)
+            new = [row for rows in new.values() for row in rows]
+            if new and len(self.show_ids):
+                # Some may have been loaded already by id
+                seen = np.isin([row.id for row in new], self.show_ids)
+                new = [row for row, loaded in zip(new, seen) if not loaded]
+            self._append_shows(session, new)
+            if shows:
+                self._reload_shows(session, shows)
+        finally:
+            if session is not db.session:
+                session.close()
+
+    def invalidate(self, artist_id=None, show_id=None, full=False):
+        # Called from the change listener thread: only note what to reload
+        with self._dirty_lock:
+            if full:
+                self._loaded = False
+            elif artist_id is not None:
+                self._dirty_artists.add(artist_id)
+            elif show_id is not None:
+                self._dirty_shows.add(show_id)
+            self._stale = True
+
+    def recommend(self, venue, limit=10):
+        """Top ``limit`` artists for ``venue`` as a list of dicts."""
+        self.refresh()
+        with self._lock:
+            if not len(self.artist_ids):
+                return []
+            wanted = genre_vector(venue.genres)
+            genre = self.genres @ wanted / max(wanted.sum(), 1.0)
+
+            same_state = self.state == self._code(venue.state)
+            same_city = same_state & (self.city == self._code(venue.city))
+            location = 0.5 * same_state + 0.5 * same_city
+
+            # Two hops through the booking matrix: venues sharing artists
+            # with this venue, then the artists those venues booked.
+            v = self.venue_index.get(venue.id)
+            booked = np.zeros(0, dtype=np.int32)
+            cobooking = np.zeros(len(self.artist_ids), dtype=np.float64)
+            if v is not None:
+                booked = np.unique(self.show_artist[self.show_venue == v])
+                shared = np.isin(self.show_artist, booked)
+                similar = np.bincount(self.show_venue[shared],
+                                      minlength=len(self.venue_index))
+                similar[v] = 0
+                cobooking = np.bincount(self.show_artist,
+                                        weights=similar[self.show_venue],
+                                        minlength=len(self.artist_ids))
+                if cobooking.max() > 0:
+                    cobooking /= cobooking.max()
+
+            score = (WEIGHT_GENRE * genre + WEIGHT_LOCATION * location +
+                     WEIGHT_COBOOKING * cobooking)
+            # Artists already booked here are not news to the venue
+            score[booked] = -np.inf
+            score[self.deleted] = -np.inf
+
+            limit = max(1, min(limit, len(score)))
+            top = np.argpartition(-score, limit - 1)[:limit]
+            top = top[np.argsort(-score[top])]
+            return [{
+                'id': int(self.artist_ids[i]),
+                'name': self.names[i],
+                'score': round(float(score[i]), 4),
+                'genre_overlap': round(float(genre[i]), 4),
+                'same_state': bool(same_state[i]),
+                'same_city': bool(same_city[i]),
+                'co_booking': round(float(cobooking[i]), 4),
+            } for i in top if np.isfinite(score[i])]
+
+
+recommender = Recommender()
+
+
+@on_invalidate('artist')
+def _artist_changed(artist_id, version, changed):
+    if changed is None or changed & ARTIST_COLUMNS:
+        recommender.invalidate(artist_id, full=artist_id is None)
+
+
+@on_invalidate('show')
+def _show_changed(show_id, version, changed):
+    if changed is None or changed & SHOW_COLUMNS:
+        recommender.invalidate(show_id=show_id, full=show_id is None)
@@ -0,0 +1,289 @@
+##### Secret keys and sessions #####
+# Every worker on every host must sign cookies (sessions, flashes, CSRF
+# tokens) with the same key, so keys are loaded from outside the process:
+#   FYYUR_SECRET_KEY            the current key
+#   FYYUR_SECRET_KEY_FALLBACKS  older keys, comma separated, still accepted
+#   FYYUR_SECRET_KEY_FILE       a file with the current key on its first
+#                               line and older keys on the following ones
+# To rotate, make the new key current and keep the old one as a fallback
+# until the sessions it signed have expired. Sessions signed with a
+# fallback are signed again with the current key on the next request.
+# With no key configured, one is generated once into SECRET_KEY_PATH and
+# shared by all workers of this host.
+#
+# Session data lives in the signed cookie unless SESSION_STORE keeps it on
+# the server, with only a signed random id in the cookie:
+#   'redis'     SESSION_REDIS_URL, any Redis-compatible server; entries
+#               expire by TTL
+#   'postgres'  the sessions table; expired rows are deleted in batches by
+#               ``flask sessions sweep`` and, with SESSION_SWEEP_PROBABILITY,
+#               after some requests
+import logging
+import os
+import random
+import secrets
+import tempfile
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import (SecureCookieSession, SecureCookieSessionInterface,
+                            SessionInterface, total_seconds)
+from itsdangerous import BadSignature, Signer, URLSafeTimedSerializer
+from sqlalchemy import text
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+sessions_cli = AppGroup('sessions', help='Server-side session store.')
+
+
+##### Keys #####
+def _read_key_file(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def _generated_key(path):
+    # The first worker to get here writes the key; the others read it. The
+    # key is written to a temp file and hard-linked into place, so the file
+    # never exists without its key.
+    key = secrets.token_hex(32)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(key + '\n')
+        os.link(tmp, path)
+    except FileExistsError:
+        return _read_key_file(path)[0]
+    finally:
+        os.unlink(tmp)
+    logger.warning('generated a secret key in %s; set FYYUR_SECRET_KEY to '
+                   'share one key between hosts', path)
+    return key
+
+
+def load_keys(config):
+    """``[current, fallback, ...]`` from config, the key file or, failing
+    both, a key generated into SECRET_KEY_PATH."""
+    keys = []
+    if config.get('SECRET_KEY'):
+        keys.append(config['SECRET_KEY'])
+    if config.get('SECRET_KEY_FILE'):
+        keys.extend(_read_key_file(config['SECRET_KEY_FILE']))
+    keys.extend(config.get('SECRET_KEY_FALLBACKS') or [])
+    if not keys:
+        keys.append(_generated_key(config.get('SECRET_KEY_PATH', '.secret_key')))
+    # Drop repeats, keeping the order
+    return list(dict.fromkeys(keys))
+
+
+##### Cookie sessions #####
+class RotatingCookieSessionInterface(SecureCookieSessionInterface):
+    """Flask's cookie session, also accepting cookies signed with one of
+    the fallback keys."""
+
+    def __init__(self, fallbacks):
+        self.fallbacks = fallbacks
+
+    def _serializer(self, key):
+        return URLSafeTimedSerializer(key, salt=self.salt,
+            serializer=self.serializer,
+            signer_kwargs={'key_derivation': self.key_derivation,
+                           'digest_method': self.digest_method})
+
+    def open_session(self, app, request):
+        value = request.cookies.get(app.session_cookie_name)
+        if not value:
+            return self.session_class()
+        max_age = total_seconds(app.permanent_session_lifetime)
+        for i, key in enumerate([app.secret_key] + self.fallbacks):
+            try:
+                data = self._serializer(key).loads(value, max_age=max_age)
+            except BadSignature:
+                continue
+            session = self.session_class(data)
+            # Signed with an old key: write it back with the current one
+            session.modified = i > 0
+            return session
+        return self.session_class()
+
+
+##### Server-side sessions #####
+class ServerSession(SecureCookieSession):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        super(ServerSession, self).__init__(initial)
+        self.sid = sid
+        self.new = new
+
+
+class RedisStore(object):
+
+    def __init__(self, url, prefix='fyyur:session:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SESSION_STORE = 'redis' needs the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def load(self, sid):
+        data = self.client.get(self.prefix + sid)
+        return data.decode() if data is not None else None
+
+    def save(self, sid, data, lifetime):
+        self.client.setex(self.prefix + sid, lifetime, data)
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+    def sweep(self, batch_size):
+        return 0
+
+
+class PostgresStore(object):
+    # Its own connection and transaction, apart from the request's db.session
+
+    def load(self, sid):
+        return db.engine.execute(text("""
+            SELECT data FROM sessions
+            WHERE id = :id AND expires_at > timezone('utc', now())
+        """), id=sid).scalar()
+
+    def save(self, sid, data, lifetime):
+        db.engine.execute(text("""
+            INSERT INTO sessions (id, data, expires_at)
+            VALUES (:id, :data, timezone('utc', now()) + :lifetime * interval '1 second')
+            ON CONFLICT (id) DO UPDATE
+            SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+        """), id=sid, data=data, lifetime=lifetime)
+
+    def delete(self, sid):
+        db.engine.execute(text('DELETE FROM sessions WHERE id = :id'), id=sid)
+
+    def sweep(self, batch_size):
+        """Delete up to ``batch_size`` expired sessions; returns the count."""
+        return db.engine.execute(text("""
+            DELETE FROM sessions WHERE id IN (
+                SELECT id FROM sessions
+                WHERE expires_at < timezone('utc', now())
+                LIMIT :limit
+                FOR UPDATE SKIP LOCKED
+            )
+        """), limit=batch_size).rowcount
+
+
+class ServerSessionInterface(SessionInterface):
+    session_class = ServerSession
+    serializer = TaggedJSONSerializer()
+    salt = 'fyyur-session-id'
+
+    def __init__(self, store, fallbacks, sweep_probability=0.0, sweep_batch=1000):
+        self.store = store
+        self.fallbacks = fallbacks
+        self.sweep_probability = sweep_probability
+        self.sweep_batch = sweep_batch
+
+    def _unsign(self, app, value):
+        """``(session id, signed with a fallback key)`` or ``(None, False)``."""
+        for i, key in enumerate([app.secret_key] + self.fallbacks):
+            try:
+                return Signer(key, salt=self.salt).unsign(value).decode(), i > 0
+            except BadSignature:
+                continue
+        return None, False
+
+    def open_session(self, app, request):
+        value = request.cookies.get(app.session_cookie_name)
+        sid, old_key = self._unsign(app, value) if value else (None, False)
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                session = self.session_class(self.serializer.loads(data), sid=sid)
+                session.modified = old_key
+                return session
+        return self.session_class(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+
+        lifetime = int(total_seconds(app.permanent_session_lifetime))
+        self.store.save(session.sid, self.serializer.dumps(dict(session)),
+                        lifetime)
+        response.set_cookie(
+            app.session_cookie_name,
+            Signer(app.secret_key, salt=self.salt).sign(session.sid.encode()).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+
+        if self.sweep_probability and random.random() < self.sweep_probability:
+            self.store.sweep(self.sweep_batch)
+
+
+##### Extension #####
+class Sessions(object):
+
+    def __init__(self, app=None):
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        keys = load_keys(config)
+        app.secret_key = keys[0]
+        fallbacks = keys[1:]
+
+        kind = config.get('SESSION_STORE')
+        if kind == 'redis':
+            self.store = RedisStore(config.get('SESSION_REDIS_URL',
+                                               'redis://localhost:6379/0'))
+        elif kind == 'postgres':
+            self.store = PostgresStore()
+        elif kind:
+            raise RuntimeError('unknown SESSION_STORE {!r}'.format(kind))
+
+        if self.store is None:
+            app.session_interface = RotatingCookieSessionInterface(fallbacks)
+        else:
+            app.session_interface = ServerSessionInterface(
+                self.store, fallbacks,
+                sweep_probability=config.get('SESSION_SWEEP_PROBABILITY', 0.0),
+                sweep_batch=config.get('SESSION_SWEEP_BATCH', 1000))
+        app.extensions['sessions'] = self
+        app.cli.add_command(sessions_cli)
+
+
+@sessions_cli.command('sweep')
+@click.option('--batch-size', default=1000, show_default=True)
+def sweep_command(batch_size):
+    """Delete expired server-side sessions."""
+    store = current_app.extensions['sessions'].store
+    if store is None:
+        raise click.ClickException('SESSION_STORE is not configured')
+    total = 0
+    while True:
+        deleted = store.sweep(batch_size)
+        total += deleted
+        if deleted < batch_size:
+            break
+    click.echo('{} expired sessions deleted'.format(total))
@@ -0,0 +1,311 @@
+##### Region sharding #####
+# Optional; off while SHARDS is empty. When on, every venue and its shows
+# live in one shard, picked from the venue's state through STATE_SHARDS
+# when the venue is created. The global database (SQLALCHEMY_DATABASE_URI)
+# keeps:
+#   - the artists; each shard holds a copy that is refreshed whenever an
+#     artist is written, so shard queries can join shows to artists,
+#   - the venue directory (venue_shards: venue id -> shard),
+#   - the id sequences of venues and shows, so ids are unique everywhere.
+#
+# Views choose the database explicitly:
+#   shards.use_venue_shard(venue_id)   db.session is the venue's shard for
+#                                      the rest of the request (404 if the
+#                                      venue is unknown)
+#   shards.fan_out(fn, *args)          fn run in every shard in parallel,
+#                                      each with its own app context; the
+#                                      results come back as a list
+#   shards.fan_out_by_name(fn, *args)  the same, as {shard: fn(shard, *args)}
+#   shards.merge(query, key)           rows of a query in every shard,
+#                                      streamed in ``key`` order
+#   shards.use_global()                db.session back on the global database
+# With sharding off they all act on the one database.
+#
+# Stats rollups and purge jobs live in the global database: shard writes
+# queue their stats changes until the shard commits (see stats.py), and a
+# purge job archives its entity's shows shard by shard. Every worker
+# LISTENs for change notifications on all shards, and the recommender reads
+# new shows from each shard. `flask partitions` still only acts on the
+# global database.
+#
+#   flask db upgrade -x shard=west     migrate one shard
+#   flask shards sync-artists          refresh every shard's artist copies
+#   flask shards assign-venues         move venues missing from the venue
+#                                      directory, and their shows, from the
+#                                      global database to their shards
+#
+# Turning sharding on for an existing database: migrate every shard, then,
+# with SHARDS set for the flask command only, run sync-artists and
+# assign-venues *before* the web workers get SHARDS (venues missing from the
+# directory 404 once they have it). Run assign-venues once more right after
+# the switch to move the venues created in between. Stats, archived shows
+# and purge jobs stay in the global database.
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import abort, current_app
+from flask.cli import AppGroup
+from sqlalchemy import create_engine, exists, text
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Artist, Show, Venue, VenueShard
+
+shards_cli = AppGroup('shards', help='Region shards.')
+
+# Venue -> shard entries remembered per process; they never change
+VENUE_CACHE_SIZE = 100000
+
+
+def _upsert(table):
+    # INSERT that overwrites the row with the same primary key
+    statement = insert(table)
+    keys = [column.name for column in table.primary_key.columns]
+    return statement.on_conflict_do_update(
+        index_elements=keys,
+        set_={column.name: statement.excluded[column.name]
+              for column in table.columns if column.name not in keys})
+
+
+class Shards(object):
+
+    def __init__(self, app=None):
+        self.app = None
+        self.uris = {}
+        self.state_shards = {}
+        self.default = None
+        self._engines = {}
+        self._executor = None
+        self._venues = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.uris = dict(app.config.get('SHARDS') or {})
+        self.state_shards = dict(app.config.get('STATE_SHARDS') or {})
+        self.default = app.config.get('DEFAULT_SHARD') or \
+            (sorted(self.uris)[0] if self.uris else None)
+        app.extensions['shards'] = self
+        app.cli.add_command(shards_cli)
+        if self.uris:
+            # Engines connect lazily, on first use
+            self._engines = {name: create_engine(uri, pool_pre_ping=True)
+                             for name, uri in self.uris.items()}
+            self._threads = app.config.get('SHARD_FAN_OUT_THREADS',
+                                           2 * len(self.uris))
+            self._new_executor()
+            # Threads don't survive a fork: forked workers get their own
+            os.register_at_fork(after_in_child=self._new_executor)
+
+    def _new_executor(self):
+        self._executor = ThreadPoolExecutor(max_workers=self._threads,
+                                            thread_name_prefix='shard')
+
+    @property
+    def enabled(self):
+        return bool(self.uris)
+
+    @property
+    def names(self):
+        return sorted(self.uris)
+
+    def engine(self, name):
+        return self._engines[name]
+
+    def session(self, name):
+        # Same session class as db.session, so its event listeners apply
+        return db.session.session_factory(bind=self.engine(name), binds={})
+
+    ##### Routing #####
+    def shard_for_state(self, state):
+        return self.state_shards.get(state, self.default)
+
+    def use_shard(self, name):
+        """Point db.session at shard ``name`` for the current context."""
+        if not self.enabled:
+            return
+        db.session.remove()
+        db.session.registry.set(self.session(name))
+
+    def venue_shard(self, venue_id):
+        shard = self._venues.get(venue_id)
+        if shard is None:
+            shard = db.engine.execute(
+                text('SELECT shard FROM venue_shards WHERE venue_id = :id'),
+                id=venue_id).scalar()
+            if shard is not None:
+                if len(self._venues) >= VENUE_CACHE_SIZE:
+                    self._venues.clear()
+                self._venues[venue_id] = shard
+        return shard
+
+    def use_global(self):
+        """Point db.session back at the global database."""
+        if not self.enabled:
+            return
+        db.session.remove()
+
+    def global_session(self):
+        """A new session on the global database, whatever db.session is
+        pointing at; the caller closes it."""
+        return db.session.session_factory()
+
+    def use_venue_shard(self, venue_id):
+        if not self.enabled:
+            return
+        shard = self.venue_shard(venue_id)
+        if shard is None:
+            abort(404)
+        self.use_shard(shard)
+
+    def next_id(self, sequence):
+        """Next value of a global id sequence (e.g. 'shows_id_seq')."""
+        return db.engine.execute(
+            text('SELECT nextval(CAST(:sequence AS regclass))'),
+            sequence=sequence).scalar()
+
+    def next_ids(self, sequence, count):
+        return [value for value, in db.engine.execute(
+            text('SELECT nextval(CAST(:sequence AS regclass)) '
+                 'FROM generate_series(1, :count)'),
+            sequence=sequence, count=count)]
+
+    def use_single_shard(self, venue_ids):
+        """Point db.session at the shard of these venues. Returns False
+        when they are in more than one shard; unknown ids are ignored."""
+        if not self.enabled:
+            return True
+        names = set()
+        for venue_id in venue_ids:
+            try:
+                names.add(self.venue_shard(int(venue_id)))
+            except (TypeError, ValueError):
+                continue
+        names.discard(None)
+        if len(names) > 1:
+            return False
+        self.use_shard(names.pop() if names else self.default)
+        return True
+
+    def register_venue(self, venue_id, shard):
+        db.engine.execute(VenueShard.__table__.insert(),
+                          venue_id=venue_id, shard=shard)
+        self._venues[venue_id] = shard
+
+    ##### Cross-shard reads #####
+    def fan_out(self, fn, *args):
+        if not self.enabled:
+            return [fn(*args)]
+        return list(self.fan_out_by_name(lambda name: fn(*args)).values())
+
+    def fan_out_by_name(self, fn, *args):
+        """``{shard: fn(shard, *args)}``, each call in its own app context
+        with db.session on that shard; with sharding off
+        ``{None: fn(None, *args)}`` on db.session."""
+        if not self.enabled:
+            return {None: fn(None, *args)}
+
+        def run(name):
+            with self.app.app_context():
+                self.use_shard(name)
+                try:
+                    return fn(name, *args)
+                finally:
+                    db.session.remove()
+
+        return dict(zip(self.names, self._executor.map(run, self.names)))
+
+    def merge(self, query, key):
+        """Iterate ``query(session)`` of every shard, merged by ``key``;
+        each shard's rows must already be sorted by it."""
+        if not self.enabled:
+            yield from query(db.session)
+            return
+        sessions = [self.session(name) for name in self.names]
+        try:
+            yield from heapq.merge(*[query(session) for session in sessions],
+                                   key=key)
+        finally:
+            for session in sessions:
+                session.close()
+
+    ##### Artist copies #####
+    def copy_artists(self, artist_ids):
+        """Upsert the current rows of these artists into every shard."""
+        if not self.enabled or not artist_ids:
+            return
+        table = Artist.__table__
+        rows = [dict(row) for row in db.engine.execute(
+            table.select().where(table.c.id.in_(list(artist_ids))))]
+        if not rows:
+            return
+        statement = _upsert(table)
+
+        def copy(name):
+            with self.engine(name).begin() as conn:
+                conn.execute(statement, rows)
+
+        list(self._executor.map(copy, self.names))
+
+
+@shards_cli.command('sync-artists')
+@click.option('--batch-size', default=1000, show_default=True)
+def sync_artists_command(batch_size):
+    """Copy every artist from the global database to all shards."""
+    shards = current_app.extensions['shards']
+    if not shards.enabled:
+        raise click.ClickException('SHARDS is not configured')
+    last_id = 0
+    while True:
+        ids = [artist_id for artist_id, in db.engine.execute(
+            text('SELECT id FROM artists WHERE id > :last ORDER BY id LIMIT :limit'),
+            last=last_id, limit=batch_size)]
+        if not ids:
+            break
+        shards.copy_artists(ids)
+        last_id = ids[-1]
+        click.echo('artists up to id {} copied'.format(last_id))
+
+
+@shards_cli.command('assign-venues')
+@click.option('--batch-size', default=100, show_default=True)
+def assign_venues_command(batch_size):
+    """Move venues missing from venue_shards, with their shows, from the
+    global database to the shard of their state."""
+    shards = current_app.extensions['shards']
+    if not shards.enabled:
+        raise click.ClickException('SHARDS is not configured')
+    venues, shows = Venue.__table__, Show.__table__
+    unassigned = ~exists().where(VenueShard.__table__.c.venue_id == venues.c.id)
+    last_id = 0
+    while True:
+        # FOR UPDATE keeps new shows of these venues out until they are
+        # moved (adding a show key-share locks its venue)
+        with db.engine.begin() as conn:
+            rows = [dict(row) for row in conn.execute(
+                venues.select().where(venues.c.id > last_id).where(unassigned).
+                order_by(venues.c.id).limit(batch_size).with_for_update())]
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            by_shard = {}
+            for row in rows:
+                by_shard.setdefault(shards.shard_for_state(row['state']), []).append(row)
+            for name, batch in sorted(by_shard.items()):
+                ids = [row['id'] for row in batch]
+                show_rows = [dict(row) for row in conn.execute(
+                    shows.select().where(shows.c.venue_id.in_(ids)))]
+                shards.copy_artists({row['artist_id'] for row in show_rows})
+                # Upserts, so a batch cut short is redone safely
+                with shards.engine(name).begin() as shard_conn:
+                    shard_conn.execute(_upsert(venues), batch)
+                    if show_rows:
+                        shard_conn.execute(_upsert(shows), show_rows)
+                conn.execute(VenueShard.__table__.insert(),
+                             [{'venue_id': venue_id, 'shard': name} for venue_id in ids])
+                conn.execute(shows.delete().where(shows.c.venue_id.in_(ids)))
+                conn.execute(venues.delete().where(venues.c.id.in_(ids)))
+                click.echo('{} venues ({} shows) moved to {}'.format(
+                    len(ids), len(show_rows), name))
@@ -0,0 +1,199 @@
+##### Booking statistics #####
+# The stats table holds show counts per (month, venue state, artist genre).
+# It is maintained incrementally in the same transaction as the write that
+# changes it:
+#   - new shows are added by id,
+#   - when an artist's genres or a venue's state change, that artist's or
+#     venue's shows are subtracted under the old values and added back
+#     under the new ones.
+# ``flask stats backfill`` rebuilds the table from scratch in id chunks.
+#
+# With sharding on, the table lives in the global database only, where
+# /stats reads it, while shows, venues and artist copies live in the
+# shards. The changes are then computed in the shard's transaction and
+# added to the global table once that commits; a crash in between loses
+# them until the next backfill. Artist genre changes are counted from
+# every shard, in the artist's own (global) transaction.
+import logging
+import time
+from collections import Counter
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event, inspect, text
+
+from models import db, Show
+
+logger = logging.getLogger(__name__)
+
+# Columns whose change moves an entity's shows to other rollup rows
+ARTIST_FIELDS = {'genres'}
+VENUE_FIELDS = {'state'}
+
+stats_cli = AppGroup('stats', help='Booking statistics rollups.')
+
+_COUNTS = """
+    SELECT CAST(date_trunc('month', s.start_time) AS date) AS month,
+           v.state, g.genre, :sign * count(*) AS shows
+    FROM shows s
+    JOIN venues v ON v.id = s.venue_id
+    JOIN artists a ON a.id = s.artist_id
+    CROSS JOIN LATERAL unnest(a.genres) AS g (genre)
+    WHERE {where}
+    GROUP BY 1, 2, 3
+"""
+
+_UPSERT = """
+    INSERT INTO stats (month, state, genre, shows)
+    {rows}
+    ON CONFLICT (month, state, genre)
+    DO UPDATE SET shows = stats.shows + EXCLUDED.shows
+"""
+
+_ARTIST_SHOWS = """
+    SELECT CAST(date_trunc('month', s.start_time) AS date), v.state, count(*)
+    FROM shows s
+    JOIN venues v ON v.id = s.venue_id
+    WHERE s.artist_id = :id
+    GROUP BY 1, 2
+"""
+
+
+def _sharded():
+    shards = current_app.extensions.get('shards')
+    return shards is not None and shards.enabled
+
+
+def _add(conn, counts):
+    """Add ``{(month, state, genre): shows}`` to the stats table."""
+    rows = [{'month': month, 'state': state, 'genre': genre, 'shows': shows}
+            for (month, state, genre), shows in sorted(counts.items())
+            if shows]
+    if rows:
+        conn.execute(text(_UPSERT.format(
+            rows='VALUES (:month, :state, :genre, :shows)')), rows)
+
+
+def _apply(where, params, sign=1, session=None):
+    session = session or db.session
+    params = dict(params, sign=sign)
+    # Raw SQL must see the rows as stored, not pending ORM changes
+    with session.no_autoflush:
+        if not _sharded():
+            session.execute(text(_UPSERT.format(
+                rows=_COUNTS.format(where=where))), params)
+            return
+        rows = session.execute(text(_COUNTS.format(where=where)), params)
+        pending = session.info.setdefault('stats_pending', Counter())
+        for month, state, genre, shows in rows:
+            pending[(month, state, genre)] += shows
+
+
+@event.listens_for(db.session, 'after_commit')
+def _commit_pending(session):
+    pending = session.info.pop('stats_pending', None)
+    if not pending:
+        return
+    try:
+        with db.engine.begin() as conn:
+            _add(conn, pending)
+    except Exception:
+        logger.exception('stats: lost %d changes, run "flask stats backfill"',
+                         len(pending))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_pending(session):
+    session.info.pop('stats_pending', None)
+
+
+def add_shows(show_ids, sign=1, session=None):
+    if show_ids:
+        _apply('s.id = ANY(:ids)', {'ids': list(show_ids)}, sign, session)
+
+
+def remove_shows(show_ids, session=None):
+    add_shows(show_ids, -1, session)
+
+
+def _artist_shows(shard, artist_id):
+    return db.session.execute(text(_ARTIST_SHOWS),
+                              {'id': artist_id}).fetchall()
+
+
+def update_artist(artist, changed):
+    """Re-bucket the artist's shows if ``changed`` affects the rollup.
+    Must run after the attributes were assigned and before the flush."""
+    if not changed & ARTIST_FIELDS:
+        return
+    if not _sharded():
+        _apply('s.artist_id = :id', {'id': artist.id}, -1)
+        db.session.flush()
+        _apply('s.artist_id = :id', {'id': artist.id}, 1)
+        return
+    # The shards' copies of the artist are only refreshed after this
+    # commits: count its shows per month and state there, and move the
+    # counts from the old genres to the new ones here
+    history = inspect(artist).attrs.genres.history
+    old = (history.deleted or history.unchanged or [None])[0] or ()
+    shards = current_app.extensions['shards']
+    counts = Counter()
+    for rows in shards.fan_out_by_name(_artist_shows, artist.id).values():
+        for month, state, shows in rows:
+            for genre in old:
+                counts[(month, state, genre)] -= shows
+            for genre in artist.genres or ():
+                counts[(month, state, genre)] += shows
+    _add(db.session, counts)
+
+
+def update_venue(venue, changed):
+    if changed & VENUE_FIELDS:
+        _apply('s.venue_id = :id', {'id': venue.id}, -1)
+        db.session.flush()
+        _apply('s.venue_id = :id', {'id': venue.id}, 1)
+
+
+def _backfill(session, chunk_size, pause, echo):
+    first, last = session.query(db.func.min(Show.id),
+                                db.func.max(Show.id)).one()
+    session.commit()
+    if first is None:
+        return
+    for low in range(first, last + 1, chunk_size):
+        high = min(low + chunk_size - 1, last)
+        _apply('s.id BETWEEN :low AND :high', {'low': low, 'high': high},
+               session=session)
+        session.commit()
+        echo('shows {}-{} of {} done'.format(low, high, last))
+        if pause:
+            time.sleep(pause)
+
+
+def backfill(chunk_size=50000, pause=0.0, echo=print):
+    """Rebuild the rollups, one committed chunk of show ids at a time.
+    Shows created meanwhile have higher ids and are counted by the
+    incremental path, so writes don't need to stop."""
+    db.session.execute(text('TRUNCATE stats'))
+    db.session.commit()
+    shards = current_app.extensions.get('shards')
+    if not _sharded():
+        _backfill(db.session, chunk_size, pause, echo)
+        return
+    for name in shards.names:
+        echo('shard {}'.format(name))
+        session = shards.session(name)
+        try:
+            _backfill(session, chunk_size, pause, echo)
+        finally:
+            session.close()
+
+
+@stats_cli.command('backfill')
+@click.option('--chunk-size', default=50000, show_default=True)
+@click.option('--pause', default=0.0, show_default=True,
+              help='Seconds to sleep between chunks.')
+def backfill_command(chunk_size, pause):
+    """Rebuild the stats table from existing shows."""
+    backfill(chunk_size=chunk_size, pause=pause, echo=click.echo)
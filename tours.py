@@ -0,0 +1,89 @@
+##### Tours #####
+# Booking many shows for one artist in a single request: every row is
+# validated in one pass (ids are looked up in batches) and the valid rows
+# are inserted with one multi-row INSERT inside a single transaction.
+import dateutil.parser
+from sqlalchemy import tuple_
+
+from models import db, Venue, Artist, Show
+from notify import publish_changes
+import audit
+import stats
+
+
+def parse_dates(text):
+    """Parse the textarea format, one ``venue_id, start_time`` per line.
+    Returns a list of ``{'venue_id': .., 'start_time': ..}`` dicts with the
+    raw strings; validation happens in ``validate_tour``."""
+    rows = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        venue_id, _, start_time = line.partition(',')
+        rows.append({'venue_id': venue_id.strip(),
+                     'start_time': start_time.strip()})
+    return rows
+
+
+def validate_tour(artist_id, rows):
+    """Validate all rows at once. Returns ``(values, errors)`` where
+    ``values`` are the rows ready to insert and ``errors`` maps the row
+    index to its error message."""
+    errors = {}
+    parsed = []
+    for i, row in enumerate(rows):
+        try:
+            venue_id = int(row.get('venue_id'))
+        except (TypeError, ValueError):
+            errors[i] = 'Invalid venue id.'
+            continue
+        try:
+            start_time = dateutil.parser.parse(str(row.get('start_time')))
+        except (ValueError, OverflowError):
+            errors[i] = 'Invalid start time.'
+            continue
+        parsed.append((i, venue_id, start_time))
+
+    # One lookup for the artist, one for all venues, one for clashing slots
+    if db.session.query(Artist.id).filter(
+            Artist.id == artist_id, Artist.deleted_at.is_(None)).first() is None:
+        return [], {i: 'Artist does not exist.' for i in range(len(rows))}
+
+    venue_ids = {venue_id for _, venue_id, _ in parsed}
+    known_venues = {venue_id for venue_id, in db.session.query(Venue.id).
+                    filter(Venue.id.in_(venue_ids),
+                           Venue.deleted_at.is_(None))} if venue_ids else set()
+
+    slots = [(venue_id, start_time) for _, venue_id, start_time in parsed]
+    taken = set(db.session.query(Show.venue_id, Show.start_time).filter(
+        tuple_(Show.venue_id, Show.start_time).in_(slots))) if slots else set()
+
+    values = []
+    seen = set()
+    for i, venue_id, start_time in parsed:
+        if venue_id not in known_venues:
+            errors[i] = 'Venue {} does not exist.'.format(venue_id)
+        elif (venue_id, start_time) in taken:
+            errors[i] = 'Venue {} already has a show at that time.'.format(venue_id)
+        elif (venue_id, start_time) in seen:
+            errors[i] = 'Duplicate of an earlier row.'
+        else:
+            seen.add((venue_id, start_time))
+            values.append({'artist_id': artist_id,
+                           'venue_id': venue_id,
+                           'start_time': start_time})
+    return values, errors
+
+
+def book_tour(values):
+    """Insert all rows with a single multi-row INSERT and commit once."""
+    if values:
+        result = db.session.execute(
+            Show.__table__.insert().values(values).returning(Show.id))
+        show_ids = [show_id for show_id, in result]
+        publish_changes([('show', show_id, None) for show_id in show_ids])
+        for show_id, value in zip(show_ids, values):
+            audit.record(db.session, 'show', show_id, 'create', value)
+        stats.add_shows(show_ids)
+    db.session.commit()
+    return len(values)
@@ -0,0 +1,278 @@
+##### Upcoming shows #####
+# /shows/upcoming lists the shows starting in a time range, optionally only
+# those at venues of one state and/or by artists of one genre.
+#
+# Shows of the next UPCOMING_CACHE_DAYS days are kept in process memory in
+# lists sorted by (start_time, id): one of all shows, one per venue state
+# and one per artist genre. A range is two bisects and a slice of the
+# narrowest list that applies, O(log n + k) without a query. The part of a
+# range beyond the cached window is read from the database through the
+# (start_time, venue_id, artist_id, id) index on shows.
+#
+# The window rolls forward as time passes: shows that have started are
+# dropped from the front and the next slice is loaded at the end. Shows
+# listed by create_show_submission are added at once; shows, artists and
+# venues changed anywhere (see notify.py) are reloaded on the next lookup.
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from functools import partial
+
+import dateutil.parser
+from sqlalchemy import or_
+
+from models import db, Artist, Show, Venue
+from notify import on_invalidate
+
+# Seconds between rolls of the window
+ROLL_INTERVAL = 60
+
+ALL = None
+
+# Columns of artists and venues the cached shows carry; changes to any
+# other column don't touch the cache. Every show column is cached.
+CACHED_COLUMNS = {
+    'artist': {'name', 'image_link', 'genres', 'deleted_at'},
+    'venue': {'name', 'city', 'state', 'deleted_at'},
+}
+
+
+def parse_time(value):
+    """Naive local datetime from an ISO-ish string ("2026-10-24",
+    "2026-10-24T20:00", "2026-10-24T20:00+02:00")."""
+    value = dateutil.parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+
+def shows_between(start, end, state=None, genre=None, limit=None,
+                  show_ids=(), artist_ids=(), venue_ids=()):
+    """Shows starting in [start, end) as dicts, by start time. With ids,
+    only the shows that are, or are of, one of them."""
+    query = db.session.query(
+        Show.id, Show.start_time, Show.venue_id, Show.artist_id,
+        Venue.name.label('venue_name'), Venue.city, Venue.state,
+        Artist.name.label('artist_name'),
+        Artist.image_link.label('artist_image_link'), Artist.genres).\
+        join(Venue, Venue.id == Show.venue_id).\
+        join(Artist, Artist.id == Show.artist_id).\
+        filter(Venue.deleted_at.is_(None), Artist.deleted_at.is_(None),
+               Show.start_time >= start, Show.start_time < end)
+    if state:
+        query = query.filter(Venue.state == state)
+    if genre:
+        query = query.filter(Artist.genres.any(genre))
+    ids = []
+    if show_ids:
+        ids.append(Show.id.in_(list(show_ids)))
+    if artist_ids:
+        ids.append(Show.artist_id.in_(list(artist_ids)))
+    if venue_ids:
+        ids.append(Show.venue_id.in_(list(venue_ids)))
+    if ids:
+        query = query.filter(or_(*ids))
+    query = query.order_by(Show.start_time, Show.id)
+    if limit is not None:
+        query = query.limit(limit)
+    rows = []
+    for row in query:
+        show = row._asdict()
+        show['genres'] = list(show['genres'] or ())
+        rows.append(show)
+    return rows
+
+
+def _public(show):
+    show = dict(show)
+    show['start_time'] = show['start_time'].isoformat()
+    return show
+
+
+class UpcomingShows(object):
+
+    def __init__(self, app=None):
+        self.days = 14
+        self.fan_out = lambda fn, *args: [fn(*args)]
+        self._lock = threading.Lock()
+        self._dirty_lock = threading.Lock()
+        self._loaded = False
+        self._dirty = self._no_changes()
+        self._rolled = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.days = app.config.get('UPCOMING_CACHE_DAYS', 14)
+        shards = app.extensions.get('shards')
+        if shards is not None:
+            self.fan_out = shards.fan_out
+        for entity in self._dirty:
+            on_invalidate(entity)(partial(self._invalidate, entity))
+        app.extensions['upcoming_shows'] = self
+
+    @staticmethod
+    def _no_changes():
+        return {'show': set(), 'artist': set(), 'venue': set()}
+
+    def _load(self, start, end, **ids):
+        return [show for shows in self.fan_out(
+                    partial(shows_between, start, end, **ids))
+                for show in shows]
+
+    ##### Sorted lists #####
+    @staticmethod
+    def _lists(show):
+        yield ALL
+        yield ('state', show['state'])
+        for genre in show['genres']:
+            yield ('genre', genre)
+
+    def _reset(self, now):
+        self.low = now
+        self.high = now + timedelta(days=self.days)
+        self.shows = {}
+        self.index = {ALL: []}
+
+    def _add(self, show):
+        self._remove(show['id'])
+        if not self.low <= show['start_time'] < self.high:
+            return
+        key = (show['start_time'], show['id'])
+        self.shows[show['id']] = show
+        for name in self._lists(show):
+            insort(self.index.setdefault(name, []), key)
+
+    def _remove(self, show_id):
+        show = self.shows.pop(show_id, None)
+        if show is None:
+            return
+        key = (show['start_time'], show_id)
+        for name in self._lists(show):
+            keys = self.index[name]
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+
+    def _roll(self, now):
+        # Drop the shows that have started, then load up to the new horizon
+        cut = bisect_left(self.index[ALL], (now,))
+        for _, show_id in self.index[ALL][:cut]:
+            self.shows.pop(show_id, None)
+        for keys in self.index.values():
+            del keys[:bisect_left(keys, (now,))]
+        self.low = now
+        high = now + timedelta(days=self.days)
+        if high > self.high:
+            shows = self._load(self.high, high)
+            self.high = high
+            for show in shows:
+                self._add(show)
+
+    def _reload_dirty(self):
+        with self._dirty_lock:
+            dirty = {entity: ids for entity, ids in self._dirty.items() if ids}
+            if not dirty:
+                return
+            self._dirty = self._no_changes()
+        shows = self._load(self.low, self.high,
+                           show_ids=dirty.get('show', ()),
+                           artist_ids=dirty.get('artist', ()),
+                           venue_ids=dirty.get('venue', ()))
+        stale = set(dirty.get('show', ()))
+        if 'artist' in dirty or 'venue' in dirty:
+            artists, venues = dirty.get('artist', ()), dirty.get('venue', ())
+            stale.update(show_id for show_id, show in self.shows.items()
+                         if show['artist_id'] in artists or
+                         show['venue_id'] in venues)
+        for show_id in stale:
+            self._remove(show_id)
+        for show in shows:
+            self._add(show)
+
+    def _refresh(self, now):
+        if not self._loaded:
+            with self._dirty_lock:
+                self._dirty = self._no_changes()
+            self._reset(now)
+            for show in self._load(self.low, self.high):
+                self._add(show)
+            self._loaded = True
+            self._rolled = time.time()
+        elif time.time() - self._rolled >= ROLL_INTERVAL:
+            self._roll(now)
+            self._rolled = time.time()
+        self._reload_dirty()
+
+    def _slice(self, start, end, state, genre):
+        # The narrowest of the lists that apply, filtered by the other
+        candidates = []
+        for name in (('state', state) if state else ALL,
+                     ('genre', genre) if genre else ALL):
+            keys = self.index.get(name, [])
+            i, j = bisect_left(keys, (start,)), bisect_left(keys, (end,))
+            candidates.append((j - i, keys, i, j))
+        _, keys, i, j = min(candidates, key=lambda candidate: candidate[0])
+        shows = (self.shows[show_id] for _, show_id in keys[i:j])
+        return [show for show in shows
+                if (not state or show['state'] == state) and
+                   (not genre or genre in show['genres'])]
+
+    ##### Lookups #####
+    def between(self, start, end, state=None, genre=None, limit=None):
+        """Shows starting in [start, end), by start time, as dicts."""
+        now = datetime.now()
+        start = max(start, now)
+        if start >= end:
+            return []
+        with self._lock:
+            self._refresh(now)
+            shows = [_public(show) for show in
+                     self._slice(start, min(end, self.high), state, genre)]
+            high = self.high
+        if limit is not None:
+            shows = shows[:limit]
+        if end > high and (limit is None or len(shows) < limit):
+            rest = sorted(self._load(max(start, high), end, state=state,
+                                     genre=genre, limit=limit and limit - len(shows)),
+                          key=lambda show: (show['start_time'], show['id']))
+            shows.extend(_public(show) for show in rest)
+            if limit is not None:
+                shows = shows[:limit]
+        return shows
+
+    def load(self):
+        """Load the window now rather than on the first lookup."""
+        with self._lock:
+            self._refresh(datetime.now())
+
+    def add(self, show):
+        """Add a show just committed in this worker."""
+        record = {
+            'id': show.id,
+            'start_time': show.start_time,
+            'venue_id': show.venue_id,
+            'venue_name': show.venue.name,
+            'city': show.venue.city,
+            'state': show.venue.state,
+            'artist_id': show.artist_id,
+            'artist_name': show.artist.name,
+            'artist_image_link': show.artist.image_link,
+            'genres': list(show.artist.genres or ()),
+        }
+        with self._lock:
+            if self._loaded:
+                self._add(record)
+
+    def _invalidate(self, entity, entity_id, version=None, changed=None):
+        # Called from the change listener thread: only note what to reload
+        columns = CACHED_COLUMNS.get(entity)
+        if changed is not None and columns is not None and \
+                not changed & columns:
+            return
+        if entity_id is None:
+            self._loaded = False
+            return
+        with self._dirty_lock:
+            self._dirty[entity].add(entity_id)
@@ -0,0 +1,93 @@
+##### Warm start #####
+# Work the first requests of a new worker would otherwise pay for, done
+# before the worker takes traffic (see gunicorn.conf.py):
+#   preload(app)       in the master, before forking; the workers share the
+#                      result copy-on-write: SQLAlchemy mappers configured,
+#                      the babel locale data used by format_datetime loaded
+#                      and every template under templates/ compiled
+#   prime_worker(app)  in each worker, after the fork: pool connections
+#                      opened (never inherited from the master), the change
+#                      listener started and the in-process caches (upcoming
+#                      shows, recommendations, geocoder) loaded
+# The master doesn't touch the database, so the workers start without
+# inherited connections or threads.
+import logging
+import time
+from datetime import datetime
+
+from babel.dates import format_datetime
+from sqlalchemy import text
+from sqlalchemy.orm import configure_mappers
+
+import geo
+from models import db
+from recommend import recommender
+
+logger = logging.getLogger(__name__)
+
+
+def preload(app):
+    started = time.perf_counter()
+    configure_mappers()
+    with app.app_context():
+        # Loads and caches the locale data of the app's datetime formats
+        format_datetime(datetime.now(), "EEEE MMMM, d, y 'at' h:mma")
+        format_datetime(datetime.now(), 'EE MM, dd, y h:mma')
+        templates = [name for name in app.jinja_env.list_templates()
+                     if name.endswith('.html')]
+        for name in templates:
+            app.jinja_env.get_template(name)
+    logger.info('preloaded %d templates in %.0f ms', len(templates),
+                (time.perf_counter() - started) * 1000)
+
+
+def _open_pool(engine, count):
+    # Held together so the pool really opens ``count`` connections
+    connections = [engine.connect() for _ in range(count)]
+    try:
+        for connection in connections:
+            connection.execute(text('SELECT 1'))
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def prime_worker(app):
+    config = app.config
+    started = time.perf_counter()
+    with app.app_context():
+        engines = [(db.engine, config.get('WARMUP_POOL_CONNECTIONS', 5))]
+        shards = app.extensions.get('shards')
+        if shards is not None and shards.enabled:
+            engines.extend((shards.engine(name), 1) for name in shards.names)
+        for engine, count in engines:
+            try:
+                _open_pool(engine, count)
+            except Exception:
+                # The worker still starts; requests connect as usual
+                logger.exception('could not open connections to %r', engine.url)
+
+        if config.get('WARMUP_PRIME_CACHES', True):
+            # Listen first, so nothing changed while loading is missed
+            notifier = app.extensions.get('change_notifier')
+            if notifier is not None and \
+                    config.get('CHANGE_LISTENER_ENABLED', True):
+                notifier.start()
+            for name, prime in _primers(app):
+                try:
+                    prime()
+                except Exception:
+                    # A cold cache is still correct: a request loads it
+                    logger.exception('priming %s failed', name)
+                finally:
+                    db.session.remove()
+    logger.info('worker primed in %.0f ms', (time.perf_counter() - started) * 1000)
+
+
+def _primers(app):
+    upcoming = app.extensions.get('upcoming_shows')
+    if upcoming is not None:
+        yield 'upcoming shows', upcoming.load
+    yield 'recommendations', recommender.refresh
+    if app.config.get('GEOCODE_FILE'):
+        yield 'geocoder', lambda: geo.geocoder(app.config['GEOCODE_FILE'])